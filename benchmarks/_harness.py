@@ -0,0 +1,33 @@
+""" Minimal request and response objects shared by the benchmarks, which
+run session factories without a Pyramid application."""
+
+
+class Request(object):
+    def __init__(self, cookie=None):
+        self.environ = {}
+        if cookie is not None:
+            self.environ['HTTP_COOKIE'] = cookie
+        self.callbacks = []
+
+    def add_response_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def finish(self):
+        response = Response()
+        for callback in self.callbacks:
+            callback(self, response)
+        return response
+
+
+class Response(object):
+    def __init__(self):
+        self.headerlist = []
+
+
+def session_cookie(factory):
+    """ Save a session with ``factory`` and return the ``Cookie`` header
+    sending it back."""
+    request = Request()
+    factory(request)['user'] = 'fred'
+    response = request.finish()
+    return response.headerlist[0][1].split(';')[0]
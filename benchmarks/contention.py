@@ -0,0 +1,234 @@
+""" Lock contention of the ``file`` and ``dbm`` session backends.
+
+Starts several worker processes, each running several threads, which send
+WSGI requests through a Pyramid application configured with
+``config.include('pyramid_beaker')``.  Every request increments a counter
+in one of a small set of shared sessions, so concurrent requests keep
+hitting the same session files and locks, as they do behind a
+multi-process server such as gunicorn.
+
+Reports throughput, p50/p99 request latency, the time spent waiting for
+the backend's session locks and the number of lost updates (increments
+overwritten by a concurrent request).
+
+Usage::
+
+    $ python benchmarks/contention.py [--backend file|dbm] [--processes N]
+          [--threads N] [--requests N] [--sessions N] [--data-dir DIR]
+          [--json results.json]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from beaker import cache
+from pyramid.config import Configurator
+from pyramid.response import Response
+from webob import Request
+
+_stats_lock = threading.Lock()
+_lock_wait = [0.0]
+
+
+class TimedLock(object):
+    """ Wraps a Beaker synchronizer, adding the time spent acquiring it to
+    the process's lock wait total."""
+    def __init__(self, lock):
+        self.lock = lock
+
+    def _timed(self, acquire, *args, **kw):
+        start = time.time()
+        result = acquire(*args, **kw)
+        elapsed = time.time() - start
+        with _stats_lock:
+            _lock_wait[0] += elapsed
+        return result
+
+    def acquire_read_lock(self, *args, **kw):
+        return self._timed(self.lock.acquire_read_lock, *args, **kw)
+
+    def acquire_write_lock(self, *args, **kw):
+        return self._timed(self.lock.acquire_write_lock, *args, **kw)
+
+    def __getattr__(self, name):
+        return getattr(self.lock, name)
+
+
+def register_timed_backend(backend):
+    """ Register ``timed_<backend>``, the namespace class of ``backend``
+    with its locks timed."""
+    base = cache.clsmap[backend]
+
+    class Timed(base):
+        def __init__(self, *args, **kw):
+            base.__init__(self, *args, **kw)
+            self.access_lock = TimedLock(self.access_lock)
+    cache.clsmap._clsmap['timed_' + backend] = Timed
+    return 'timed_' + backend
+
+
+def increment(request):
+    session = request.session
+    session['counter'] = session.get('counter', 0) + 1
+    return Response('%d' % session['counter'])
+
+
+def read(request):
+    return Response('%d' % request.session.get('counter', 0))
+
+
+def make_app(backend, data_dir):
+    settings = {
+        'session.type': register_timed_backend(backend),
+        'session.data_dir': data_dir + '/data',
+        'session.lock_dir': data_dir + '/lock',
+        'session.key': 'contention',
+        'session.secret': 'contention',
+        }
+    config = Configurator(settings=settings)
+    config.include('pyramid_beaker')
+    config.add_route('increment', '/increment')
+    config.add_route('read', '/read')
+    config.add_view(increment, route_name='increment')
+    config.add_view(read, route_name='read')
+    return config.make_wsgi_app()
+
+
+def create_sessions(app, count):
+    cookies = []
+    for i in range(count):
+        response = Request.blank('/increment').get_response(app)
+        cookie = response.headers['Set-Cookie'].split(';')[0]
+        cookies.append(cookie)
+    return cookies
+
+
+def counter(app, cookie):
+    request = Request.blank('/read', headers={'Cookie': cookie})
+    return int(request.get_response(app).text)
+
+
+def worker(backend, data_dir, cookies, threads, requests, results):
+    # forked workers inherit the parent's total
+    _lock_wait[0] = 0.0
+    app = make_app(backend, data_dir)
+    latencies = []
+    done = [0]
+    errors = [0]
+
+    def run():
+        rng = random.Random()
+        local = []
+        for i in range(requests):
+            cookie = rng.choice(cookies)
+            start = time.time()
+            try:
+                request = Request.blank('/increment',
+                                        headers={'Cookie': cookie})
+                response = request.get_response(app)
+                ok = response.status_int == 200
+            except Exception:
+                ok = False
+            local.append(time.time() - start)
+            with _stats_lock:
+                if ok:
+                    done[0] += 1
+                else:
+                    errors[0] += 1
+        with _stats_lock:
+            latencies.extend(local)
+
+    pool = [threading.Thread(target=run) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put({'latencies': latencies, 'increments': done[0],
+                 'errors': errors[0], 'lock_wait': _lock_wait[0]})
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', choices=('file', 'dbm'), default='file')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=100,
+                        help='requests per thread')
+    parser.add_argument('--sessions', type=int, default=4,
+                        help='number of shared sessions')
+    parser.add_argument('--data-dir',
+                        help='session directory (a temporary one by default)')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args(argv[1:])
+
+    data_dir = args.data_dir or tempfile.mkdtemp(
+        prefix='pyramid_beaker_contention')
+    try:
+        app = make_app(args.backend, data_dir)
+        cookies = create_sessions(app, args.sessions)
+        initial = sum(counter(app, cookie) for cookie in cookies)
+
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=worker, args=(
+                args.backend, data_dir, cookies, args.threads,
+                args.requests, results))
+            for i in range(args.processes)]
+        start = time.time()
+        for process in processes:
+            process.start()
+        reports = [results.get() for process in processes]
+        elapsed = time.time() - start
+        for process in processes:
+            process.join()
+
+        final = sum(counter(app, cookie) for cookie in cookies)
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    latencies = []
+    for report in reports:
+        latencies.extend(report['latencies'])
+    increments = sum(report['increments'] for report in reports)
+    summary = {
+        'backend': args.backend,
+        'processes': args.processes,
+        'threads': args.threads,
+        'sessions': args.sessions,
+        'requests': len(latencies),
+        'errors': sum(report['errors'] for report in reports),
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'lock_wait_s': sum(report['lock_wait'] for report in reports),
+        'lost_updates': increments - (final - initial),
+        }
+    for key in sorted(summary):
+        value = summary[key]
+        if isinstance(value, float):
+            print('%-12s %12.2f' % (key, value))
+        else:
+            print('%-12s %12s' % (key, value))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
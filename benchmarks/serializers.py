@@ -0,0 +1,70 @@
+""" Encode/decode time and payload size of session serializers.
+
+Runs every serializer available through ``session.serializer`` (plus
+Beaker's own ``pickle`` and ``json`` formats) over a few typical session
+shapes.  ``msgpack`` is skipped when it is not installed.
+
+Usage::
+
+    $ python benchmarks/serializers.py [number]
+"""
+from __future__ import print_function
+
+import sys
+import time
+import timeit
+
+from beaker.util import JsonSerializer as BeakerJsonSerializer
+from beaker.util import PickleSerializer as BeakerPickleSerializer
+
+from pyramid_beaker.serializers import make_serializer
+
+
+def shapes():
+    now = time.time()
+    base = {'_creation_time': now, '_accessed_time': now}
+    csrf = dict(base, _csrft_='0123456789abcdef0123456789abcdef01234567')
+    flash = dict(csrf, _f_=['Your changes were saved.'] * 3,
+                 _f_error=['Please correct the errors below.'])
+    user = dict(csrf, user={
+        'id': 42,
+        'login': 'fred',
+        'name': 'Fred Flintstone',
+        'email': 'fred@example.com',
+        'groups': ['editors', 'viewers'],
+        'preferences': {'lang': 'en', 'tz': 'UTC', 'page_size': 50},
+        })
+    return [('csrf token', csrf), ('flash queues', flash), ('user dict', user)]
+
+
+def serializers():
+    result = [
+        ('beaker pickle', BeakerPickleSerializer()),
+        ('beaker json', BeakerJsonSerializer()),
+        ]
+    for name in ('pickle', 'json', 'msgpack'):
+        try:
+            result.append((name, make_serializer(name, 'none')))
+        except Exception:
+            pass
+    return result
+
+
+def main(argv=sys.argv):
+    number = int(argv[1]) if len(argv) > 1 else 20000
+    print('%-14s %-14s %11s %11s %7s' % (
+        'shape', 'serializer', 'dumps (us)', 'loads (us)', 'bytes'))
+    for shape, data in shapes():
+        for name, serializer in serializers():
+            payload = serializer.dumps(data)
+            dumps = min(timeit.repeat(
+                lambda: serializer.dumps(data), number=number, repeat=3))
+            loads = min(timeit.repeat(
+                lambda: serializer.loads(payload), number=number, repeat=3))
+            print('%-14s %-14s %11.2f %11.2f %7d' % (
+                shape, name, dumps / number * 1e6, loads / number * 1e6,
+                len(payload)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+""" Per-request cost of pyramid_beaker sessions.
+
+Compares the default (eager) session factory with ``lazy=True`` for
+requests that never touch the session, requests that only read it and
+requests that write to it.  Uses Beaker's in-process ``memory`` backend so
+the numbers reflect pyramid_beaker's own overhead rather than I/O.
+
+Usage::
+
+    $ python benchmarks/session_overhead.py [number] [--check]
+
+With ``--check`` the script exits with status 1 if the lazy factory is
+slower than the eager one in any scenario, allowing ``TOLERANCE`` for
+timing noise.
+"""
+from __future__ import print_function
+
+import sys
+import timeit
+
+from pyramid_beaker import BeakerSessionFactoryConfig
+
+from _harness import Request
+from _harness import session_cookie
+
+
+def scenarios(factory):
+    cookie = session_cookie(factory)
+
+    def untouched():
+        request = Request()
+        factory(request)
+        request.finish()
+
+    def anonymous_read():
+        request = Request()
+        factory(request).get('user')
+        request.finish()
+
+    def read():
+        request = Request(cookie)
+        factory(request).get('user')
+        request.finish()
+
+    def write():
+        request = Request(cookie)
+        factory(request)['counter'] = 1
+        request.finish()
+
+    return [
+        ('untouched', untouched),
+        ('anonymous read', anonymous_read),
+        ('read', read),
+        ('write', write),
+        ]
+
+
+# how much slower than eager sessions lazy ones may be measured with --check
+TOLERANCE = 0.05
+
+
+def main(argv=sys.argv):
+    args = [arg for arg in argv[1:] if arg != '--check']
+    check = len(args) < len(argv) - 1
+    number = int(args[0]) if args else 10000
+    print('%-16s %12s %12s' % ('scenario', 'eager (us)', 'lazy (us)'))
+    eager = scenarios(BeakerSessionFactoryConfig(type='memory'))
+    lazy = scenarios(BeakerSessionFactoryConfig(type='memory', lazy=True))
+    slower = []
+    for (name, eager_fn), (_, lazy_fn) in zip(eager, lazy):
+        results = []
+        for fn in (eager_fn, lazy_fn):
+            best = min(timeit.repeat(fn, number=number, repeat=3))
+            results.append(best / number * 1e6)
+        print('%-16s %12.2f %12.2f' % (name, results[0], results[1]))
+        if results[1] > results[0] * (1 + TOLERANCE):
+            slower.append(name)
+    if check and slower:
+        print('lazy sessions are slower for: %s' % ', '.join(slower))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+""" Micro-benchmarks of pyramid_beaker's session and cache hot paths.
+
+Runs offline: sessions and caches use the in-process ``memory`` backend,
+temporary ``file`` and ``dbm`` directories or cookies.  Each benchmark
+reports the best of several timing rounds in microseconds per operation.
+
+Usage::
+
+    $ python benchmarks/suite.py [--number N] [--filter TEXT]
+          [--json results.json] [--compare baseline.json]
+
+``--json`` writes the results, with the Python, Beaker, Pyramid and
+pyramid_beaker versions they were measured with, so that runs of different
+releases can be compared; ``--compare`` prints the ratio of each result to
+a previous ``--json`` file.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+import beaker.cache
+
+from pyramid_beaker import BeakerSessionFactoryConfig
+from pyramid_beaker.regions import get_cache
+
+from _harness import Request
+from _harness import session_cookie
+
+
+def session_benchmarks(tmpdir):
+    factory = BeakerSessionFactoryConfig(type='memory')
+
+    def construct_factory():
+        BeakerSessionFactoryConfig(type='memory', key='bench')
+
+    def untouched_request():
+        request = Request()
+        factory(request)
+        request.finish()
+
+    def setitem():
+        request = Request()
+        factory(request)['a'] = 1
+
+    def setdefault_existing():
+        request = Request()
+        session = factory(request)
+        session['a'] = 1
+        session.setdefault('a', 2)
+
+    def update():
+        request = Request()
+        factory(request).update({'a': 1, 'b': 2})
+
+    def flash_roundtrip():
+        request = Request()
+        session = factory(request)
+        session.flash('saved')
+        session.pop_flash()
+
+    def csrf():
+        request = Request()
+        session = factory(request)
+        session.check_csrf_token(session.get_csrf_token())
+
+    result = [
+        ('factory.construct', construct_factory),
+        ('request.untouched', untouched_request),
+        ('session.setitem', setitem),
+        ('session.setdefault_existing', setdefault_existing),
+        ('session.update', update),
+        ('session.flash_roundtrip', flash_roundtrip),
+        ('session.csrf', csrf),
+        ]
+
+    backends = [
+        ('memory', dict(type='memory')),
+        ('file', dict(type='file', data_dir=tmpdir + '/file',
+                      lock_dir=tmpdir + '/file_lock')),
+        ('dbm', dict(type='dbm', data_dir=tmpdir + '/dbm',
+                     lock_dir=tmpdir + '/dbm_lock')),
+        ('cookie', dict(type='cookie', validate_key='bench')),
+        ]
+    for name, options in backends:
+        result.append(('persist.%s' % name, persist(options)))
+    return result
+
+
+def persist(options):
+    factory = BeakerSessionFactoryConfig(**options)
+    cookie = session_cookie(factory)
+    counter = [0]
+
+    def write():
+        counter[0] += 1
+        request = Request(cookie)
+        factory(request)['counter'] = counter[0]
+        request.finish()
+    return write
+
+
+def cache_benchmarks(tmpdir):
+    beaker.cache.cache_regions.update({
+        'bench_memory': {'type': 'memory', 'expire': 3600},
+        'bench_bounded': {'type': 'bounded_memory', 'expire': 3600,
+                          'max_items': 1000},
+        'bench_file': {'type': 'file', 'expire': 3600,
+                       'data_dir': tmpdir + '/cache',
+                       'lock_dir': tmpdir + '/cache_lock'},
+        })
+    value = {'id': 42, 'name': 'Fred Flintstone', 'groups': ['editors']}
+    result = []
+    for region in ('bench_memory', 'bench_bounded', 'bench_file'):
+        cache = get_cache(region, 'benchmarks')
+        cache.put('key', value)
+        name = region[len('bench_'):]
+
+        def get(cache=cache):
+            cache.get('key')
+
+        def put(cache=cache):
+            cache.put('key', value)
+        result.append(('region.%s.get' % name, get))
+        result.append(('region.%s.set' % name, put))
+    return result
+
+
+def versions():
+    try:
+        from importlib.metadata import version
+    except ImportError: # pragma: no cover
+        import pkg_resources
+        version = lambda name: pkg_resources.get_distribution(name).version
+    result = {'python': platform.python_version()}
+    for name in ('beaker', 'pyramid', 'pyramid_beaker'):
+        try:
+            result[name] = version(name)
+        except Exception:
+            result[name] = None
+    return result
+
+
+def run(benchmarks, number, repeat):
+    results = {}
+    for name, fn in benchmarks:
+        best = min(timeit.repeat(fn, number=number, repeat=repeat))
+        results[name] = best / number * 1e6
+        print('%-32s %12.2f' % (name, results[name]))
+    return results
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=2000,
+                        help='operations per timing round')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timing rounds per benchmark')
+    parser.add_argument('--filter', default='',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare',
+                        help='compare with the results in this file')
+    args = parser.parse_args(argv[1:])
+
+    tmpdir = tempfile.mkdtemp(prefix='pyramid_beaker_bench')
+    try:
+        benchmarks = session_benchmarks(tmpdir) + cache_benchmarks(tmpdir)
+        benchmarks = [(name, fn) for name, fn in benchmarks
+                      if args.filter in name]
+        print('%-32s %12s' % ('benchmark', 'us/op'))
+        results = run(benchmarks, args.number, args.repeat)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'versions': versions(), 'number': args.number,
+                       'repeat': args.repeat, 'results': results},
+                      f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        print('%-32s %12s %12s %8s' % ('benchmark', 'baseline', 'current',
+                                       'ratio'))
+        for name in sorted(results):
+            before = baseline['results'].get(name)
+            if before:
+                print('%-32s %12.2f %12.2f %8.2f' % (
+                    name, before, results[name], results[name] / before))
+
+
+if __name__ == '__main__':
+    main()
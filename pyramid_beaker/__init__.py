@@ -1,16 +1,160 @@
+import hashlib
+import hmac
+import logging
 import os
+import re
+import time
 
 from beaker import cache
+from beaker.container import OpenResourceNamespaceManager
+from beaker.cookie import SimpleCookie
+from beaker.exceptions import BeakerException
+from beaker.ext.memcached import MemcachedNamespaceManager
+from beaker.session import CookieSession
+from beaker.session import InvalidSignature
+from beaker.session import SignedCookie
 from beaker.session import SessionObject
 from beaker.util import coerce_cache_params
 from beaker.util import coerce_session_params
 
+from pyramid.exceptions import ConfigurationError
 from pyramid.interfaces import ISession
+from pyramid.interfaces import ISessionFactory
 from pyramid.settings import asbool
+from pyramid.settings import aslist
+from pyramid.util import strings_differ
 from zope.interface import implementer
 
 from binascii import hexlify
 
+from pyramid_beaker.instrumentation import InstrumentedSerializer
+from pyramid_beaker.instrumentation import active as instrumentation_active
+from pyramid_beaker.instrumentation import add_sink
+from pyramid_beaker.instrumentation import emit
+from pyramid_beaker.instrumentation import sinks_from_settings
+from pyramid_beaker.pool import configure_pools
+from pyramid_beaker.pool import pool_options_from_settings
+from pyramid_beaker.principals import INDEX_KEY
+from pyramid_beaker.principals import PrincipalIndex
+from pyramid_beaker.regions import region_cache
+from pyramid_beaker.regions import set_tag_region
+from pyramid_beaker.serializers import CompressingSerializer
+from pyramid_beaker.serializers import SpillingSerializer
+from pyramid_beaker.serializers import beaker_serializer
+from pyramid_beaker.serializers import make_serializer
+from pyramid_beaker.split import SplitStore
+from pyramid_beaker.split import placeholder
+from pyramid_beaker.tiered import SessionL1
+from pyramid_beaker.tiered import tiered_namespace
+from pyramid_beaker.writebehind import WriteBehindQueue
+from pyramid_beaker.writebehind import session_write_job
+
+
+log = logging.getLogger(__name__)
+
+# Keys Beaker itself keeps in every session dictionary.
+_BEAKER_KEYS = frozenset(
+    ['_creation_time', '_accessed_time', '_domain', '_path', '_id',
+     '_expires'])
+
+# Metadata keys: Beaker's own and those optimistic saves add to them.
+_SESSION_METADATA = _BEAKER_KEYS | frozenset(['_version', '_key_versions'])
+
+# Values of these types cannot be changed in place, so comparing them with
+# the value loaded from the backend tells whether a key really changed.
+_IMMUTABLE_TYPES = (type(None), bool, int, float, complex, str, bytes,
+                    frozenset)
+
+_marker = object()
+
+_csrf_nonce_re = re.compile('^[0-9a-f]{32}$')
+
+# derives the key of csrf = hmac tokens from their secret
+_CSRF_LABEL = b'pyramid_beaker.csrf_token'
+
+# Room left in a cookie for its name, attributes and signature when
+# estimating how large the session payload itself may get.
+_COOKIE_OVERHEAD = 300
+
+# Where a lazy session registers itself so the shared response callback
+# can find it again.
+_ENVIRON_KEY = 'pyramid_beaker.session'
+
+
+def _lazy_session_callback(request, response):
+    """ Shared response callback used by lazy sessions; a single
+    module-level function is registered instead of a per-request
+    closure."""
+    session = request.environ.pop(_ENVIRON_KEY)
+    session._session_callback(request, response)
+
+
+class ReadOnlySessionError(RuntimeError):
+    """ Raised when a read-only session is modified."""
+
+
+class CookieTooLargeError(ValueError):
+    """ Raised when a session cookie exceeds ``cookie_max_size``."""
+
+
+class SessionConflictError(RuntimeError):
+    """ Raised when an optimistic session save finds that a concurrent
+    request changed a key this request changed too.  ``keys`` holds the
+    conflicting keys."""
+    def __init__(self, keys):
+        self.keys = sorted(keys)
+        RuntimeError.__init__(
+            self, 'Session keys changed concurrently: %s'
+            % ', '.join(map(str, self.keys)))
+
+
+class _LockFreeReads(object):
+    """ Namespace mixin which loads session data without taking the
+    backend's read lock.  Falls back to the locked read if the lock-free
+    one fails, e.g. because a write was in progress."""
+    def acquire_read_lock(self):
+        if isinstance(self, OpenResourceNamespaceManager):
+            try:
+                self.open('r', checkcount=True)
+            except Exception:
+                super(_LockFreeReads, self).acquire_read_lock()
+                self._read_locked = True
+
+    def release_read_lock(self):
+        if getattr(self, '_read_locked', False):
+            del self._read_locked
+            super(_LockFreeReads, self).release_read_lock()
+        elif isinstance(self, OpenResourceNamespaceManager):
+            self.close(checkcount=True)
+
+_lockfree_classes = {}
+
+
+def _namespace_class(params):
+    """ Return the namespace class a Beaker session created with
+    ``params`` would use."""
+    cls = params.get('namespace_class')
+    if cls is None:
+        session_type = params.get('type') or (
+            'file' if params.get('data_dir') else 'memory')
+        cls = cache.clsmap[session_type]
+    return cls
+
+
+def _lockfree_namespace(params):
+    """ Return the lock-free variant of the namespace class a Beaker
+    session created with ``params`` would use."""
+    cls = _namespace_class(params)
+    if issubclass(cls, _LockFreeReads):
+        # e.g. optimistic sessions, whose reads are always lock-free
+        return cls
+    try:
+        return _lockfree_classes[cls]
+    except KeyError:
+        lockfree = type('LockFree' + cls.__name__, (_LockFreeReads, cls), {})
+        _lockfree_classes[cls] = lockfree
+        return lockfree
+
 
 def BeakerSessionFactoryConfig(**options):
     """ Return a Pyramid session factory using Beaker session settings
@@ -20,60 +164,736 @@ def BeakerSessionFactoryConfig(**options):
         _options = options
         _cookie_on_exception = _options.pop('cookie_on_exception', True)
         _constant_csrf_token = _options.pop('constant_csrf_token', False)
+        _lazy = _options.pop('lazy', False)
+        _auto = _options.get('auto', False)
+        _touch_interval = _options.pop('touch_interval', None)
+        if (_touch_interval and _options.get('timeout')
+            and _touch_interval >= _options['timeout']):
+            raise ConfigurationError(
+                'Session touch_interval must be shorter than timeout')
+        _serializer = _options.pop('serializer', None)
+        _serializer_fallback = _options.pop('serializer_fallback', 'pickle')
+        if _serializer is not None:
+            _options['data_serializer'] = make_serializer(
+                _serializer, _serializer_fallback)
+        _compress_threshold = _options.pop('compress_threshold', None)
+        _compress_level = _options.pop('compress_level', 6)
+        if _compress_threshold is not None:
+            _options['data_serializer'] = CompressingSerializer(
+                beaker_serializer(_options.get('data_serializer', 'pickle')),
+                _compress_threshold, _compress_level)
+        _cookie_max_size = _options.pop('cookie_max_size', None)
+        _cookie_overflow = _options.pop('cookie_overflow', 'raise')
+        _cookie_spill_region = _options.pop('cookie_spill_region', None)
+        if _cookie_overflow not in ('raise', 'log', 'spill'):
+            raise ConfigurationError(
+                'Unknown cookie_overflow policy %r' % (_cookie_overflow,))
+        if _cookie_overflow == 'spill':
+            if not (_cookie_max_size and _cookie_spill_region):
+                raise ConfigurationError(
+                    'cookie_overflow = spill requires cookie_max_size and '
+                    'cookie_spill_region')
+            _options['data_serializer'] = SpillingSerializer(
+                beaker_serializer(_options.get('data_serializer', 'pickle')),
+                _cookie_spill_region,
+                (_cookie_max_size - _COOKIE_OVERHEAD) * 3 // 4)
+        _optimistic = _options.pop('optimistic', False)
+        if _optimistic:
+            if _options.get('type') == 'cookie':
+                raise ConfigurationError(
+                    'Optimistic saves cannot be used with cookie sessions')
+            if (issubclass(_namespace_class(_options),
+                           MemcachedNamespaceManager) and
+                not (_options.get('lock_dir') or _options.get('data_dir'))):
+                # the lock would be a file in each host's own tempdir, so
+                # saves from different hosts could overwrite each other
+                raise ConfigurationError(
+                    'Optimistic saves with memcached sessions require a '
+                    'lock_dir shared by every host')
+            _options['namespace_class'] = _lockfree_namespace(_options)
+        _instrument = _options.pop('instrument', False)
+        if _instrument:
+            _options['data_serializer'] = InstrumentedSerializer(
+                beaker_serializer(_options.get('data_serializer', 'pickle')))
+        session_cache = None
+        _tiered_max_items = _options.pop('tiered_max_items', 1000)
+        if _options.pop('tiered', False):
+            if _options.get('type') == 'cookie':
+                raise ConfigurationError(
+                    'Tiered sessions cannot be used with cookie sessions')
+            session_cache = SessionL1(_tiered_max_items)
+            _options['namespace_class'] = tiered_namespace(
+                _namespace_class(_options), session_cache)
+        _write_behind_options = dict(
+            workers=_options.pop('write_behind_workers', 2),
+            queue_size=_options.pop('write_behind_queue_size', 1000),
+            policy=_options.pop('write_behind_policy', 'sync'),
+            )
+        write_behind = None
+        if _options.pop('write_behind', False):
+            if _optimistic:
+                raise ConfigurationError(
+                    'Optimistic saves cannot be combined with write_behind')
+            write_behind = WriteBehindQueue(**_write_behind_options)
+        _split_threshold = _options.pop('split_threshold', None)
+        split_store = None
+        if _split_threshold:
+            if _options.get('type') == 'cookie':
+                raise ConfigurationError(
+                    'split_threshold cannot be used with cookie sessions')
+            if _optimistic:
+                raise ConfigurationError(
+                    'Optimistic saves cannot be combined with '
+                    'split_threshold')
+            split_store = SplitStore(_split_threshold)
+        _readonly_methods = frozenset(
+            m.upper() for m in aslist(_options.pop('readonly_methods', ())))
+        _readonly_violation = _options.pop('readonly_violation', 'raise')
+        _cookie_key = _options.get('key', 'beaker.session.id')
+        # finds the session cookie in a Cookie header without parsing it,
+        # which Beaker does again when the session is loaded
+        _cookie_re = re.compile(
+            r'(?:^|[;,])\s*%s\s*=' % re.escape(_cookie_key))
+        _csrf = _options.pop('csrf', 'session')
+        _csrf_cookie = _options.pop('csrf_cookie', _cookie_key + '.csrf')
+        _csrf_secret = (_options.pop('csrf_secret', None)
+                        or _options.get('secret')
+                        or _options.get('validate_key'))
+        if _csrf not in ('session', 'hmac'):
+            raise ConfigurationError('Unknown csrf mode %r' % (_csrf,))
+        if _csrf == 'hmac':
+            if not _csrf_secret:
+                raise ConfigurationError(
+                    'csrf = hmac requires csrf_secret, secret or '
+                    'validate_key to be set')
+            _csrf_secret = _csrf_secret.encode('utf-8')
+            # tokens are not signed with the secret itself, which also
+            # signs session cookies
+            _csrf_key = hmac.new(_csrf_secret, _CSRF_LABEL,
+                                 hashlib.sha256).digest()
+        _principal_key = _options.pop('principal_key', None)
+        principal_index = None
+        if _principal_key:
+            if _options.get('type') == 'cookie':
+                raise ConfigurationError(
+                    'principal_key cannot be used with cookie sessions')
+            principal_index = PrincipalIndex(
+                _options, write_behind or WriteBehindQueue(workers=1))
+        write_stats = {'writes': 0, 'writes_avoided': 0, 'touches_avoided': 0,
+                       'cookies': 0, 'cookie_bytes': 0, 'cookies_dropped': 0,
+                       'merges': 0, 'conflicts': 0}
 
         def __init__(self, request):
             SessionObject.__init__(self, request.environ, **self._options)
-            def session_callback(request, response):
-                exception = getattr(request, 'exception', None)
-                if (
-                    (exception is None or self._cookie_on_exception)
-                    and self.accessed()
-                ):
+            self.__dict__['_request'] = request
+            if not self._lazy:
+                request.add_response_callback(self._session_callback)
+
+        def _session(self):
+            sess = self.__dict__['_sess']
+            if sess is None:
+                request = self.__dict__['_request']
+                if self._readonly_request(request):
+                    self.__dict__['_readonly'] = True
+                    params = self.__dict__['_params']
+                    if params.get('type') != 'cookie':
+                        self.__dict__['_params'] = dict(
+                            params,
+                            namespace_class=_lockfree_namespace(params))
+                if self._instrument and instrumentation_active():
+                    start = time.time()
+                    sess = SessionObject._session(self)
+                    emit('session.load', time.time() - start)
+                else:
+                    sess = SessionObject._session(self)
+                if self.principal_index is not None:
+                    indexed = sess.get(INDEX_KEY)
+                    if (indexed is not None and
+                        self.principal_index.invalidated(indexed)):
+                        # saved again by a request which loaded it before
+                        # it was invalidated
+                        sess.delete()
+                        sess.invalidate()
+                        indexed = None
+                    self.__dict__['_loaded_index'] = indexed
+                self.__dict__['_loaded_id'] = _session_id(sess)
+                if self._lazy:
+                    # nothing is registered until the session is first used
+                    request.environ[_ENVIRON_KEY] = self
+                    request.add_response_callback(_lazy_session_callback)
+            return sess
+
+        def _readonly_request(self, request):
+            if getattr(request, 'session_readonly', False):
+                return True
+            return getattr(request, 'method', None) in self._readonly_methods
+
+        def _writable_session(self):
+            """ Return the Beaker session for modification, enforcing the
+            read-only mode."""
+            sess = self._session()
+            if (self.__dict__.get('_readonly') or
+                self._readonly_request(self.__dict__['_request'])):
+                if self._readonly_violation == 'raise':
+                    raise ReadOnlySessionError(
+                        'The session is read-only for this request')
+                log.warning('Read-only session modified; the change will '
+                            'not be saved')
+            return sess
+
+        def _session_callback(self, request, response):
+            if '_saved' in self.__dict__:
+                # already saved by persist_async()
+                cookie_out = self.__dict__.pop('_saved')
+            else:
+                cookie_out = self._save(request)
+            if cookie_out:
+                response.headerlist.append(('Set-Cookie', cookie_out))
+
+        def _save(self, request):
+            """ Persist the session as required at the end of ``request``,
+            and return the ``Set-Cookie`` value to send, if any."""
+            exception = getattr(request, 'exception', None)
+            if (
+                (exception is None or self._cookie_on_exception)
+                and self.accessed()
+                and (self.__dict__.get('_readonly')
+                     or self._readonly_request(request))
+            ):
+                return self._save_access_time()
+            if (
+                (exception is None or self._cookie_on_exception)
+                and self.accessed()
+            ):
+                if self.principal_index is not None:
+                    self._index_principal()
+                if self.dirty() and not self._auto:
+                    if self._modified():
+                        self.write_stats['writes'] += 1
+                    else:
+                        # only no-op mutations happened; don't rewrite
+                        # the session content
+                        self.__dict__['_dirty'] = False
+                        self.write_stats['writes_avoided'] += 1
+                if self._touch_throttled():
+                    self.write_stats['touches_avoided'] += 1
+                    return
+                removals = ()
+                if self.split_store is not None:
+                    writes, removals = self._split_values()
+                    self._split_jobs(writes)
+                start = time.time()
+                if isinstance(self.__dict__['_sess'], CookieSession):
+                    try:
+                        self.persist()
+                    except BeakerException:
+                        # Beaker refuses cookie values over 4064 bytes
+                        if self._cookie_overflow == 'raise':
+                            raise
+                        self._drop_cookie(None)
+                        return
+                elif self._optimistic:
+                    self._persist_optimistic()
+                elif self.write_behind is not None:
+                    self._persist_behind()
+                else:
                     self.persist()
-                    headers = self.__dict__['_headers']
-                    if headers['set_cookie'] and headers['cookie_out']:
-                        response.headerlist.append(
-                            ('Set-Cookie', headers['cookie_out']))
-            request.add_response_callback(session_callback)
+                self._split_jobs(removals)
+                if self._instrument:
+                    emit('session.persist', time.time() - start)
+                headers = self.__dict__['_headers']
+                if headers['set_cookie'] and headers['cookie_out']:
+                    cookie_out = headers['cookie_out']
+                    size = len(cookie_out)
+                    if self._cookie_max_size and size > self._cookie_max_size:
+                        if self._cookie_overflow == 'raise':
+                            raise CookieTooLargeError(
+                                'Session cookie of %d bytes exceeds '
+                                'cookie_max_size' % size)
+                        self._drop_cookie(size)
+                        return
+                    self.write_stats['cookies'] += 1
+                    self.write_stats['cookie_bytes'] += size
+                    request.environ['pyramid_beaker.cookie_bytes'] = size
+                    if self._instrument:
+                        emit('session.cookie', size=size)
+                    return cookie_out
+
+        def load_async(self):
+            """ Return an awaitable loading the session from its backend
+            in a thread of :mod:`pyramid_beaker.aio`'s executor, and
+            resolving to the session."""
+            from pyramid_beaker.aio import run_sync
+            def load():
+                self._session()
+                return self
+            return run_sync(load)
+
+        def persist_async(self):
+            """ Return an awaitable saving the session as the response
+            callback would, in a thread of :mod:`pyramid_beaker.aio`'s
+            executor.  The response callback then only adds the session
+            cookie; later changes to the session are not saved."""
+            from pyramid_beaker.aio import run_sync
+            def persist():
+                self.__dict__['_saved'] = self._save(
+                    self.__dict__['_request'])
+            return run_sync(persist)
+
+        def _drop_cookie(self, size):
+            self.write_stats['cookies_dropped'] += 1
+            log.error('Session cookie%s exceeds the size limit and was not '
+                      'sent', size and ' of %d bytes' % size or '')
+
+        def _save_access_time(self):
+            """ Record the access time of a read-only session which expires
+            after ``timeout``, so that it does not expire while only being
+            read, and return the ``Set-Cookie`` value to send, if any.  The
+            data is saved as it was loaded, without this request's
+            changes."""
+            sess = self.__dict__['_sess']
+            if not sess.timeout or sess.is_new or not sess.save_atime:
+                return
+            if self._touch_throttled(readonly=True):
+                self.write_stats['touches_avoided'] += 1
+                return
+            if isinstance(sess, CookieSession):
+                sess.save(accessed_only=True)
+                headers = self.__dict__['_headers']
+                if headers['set_cookie'] and headers['cookie_out']:
+                    return headers['cookie_out']
+            elif self.write_behind is not None:
+                payload = sess._encrypt_data(dict(sess.accessed_dict.items()))
+                self.write_behind.submit(
+                    sess.id, session_write_job(sess, payload))
+            else:
+                sess.save(accessed_only=True)
+
+        def _touch_throttled(self, readonly=False):
+            """ Return ``True`` if persisting would only record the access
+            time (as it always does for ``readonly`` sessions) and the
+            recorded access time is less than ``touch_interval`` seconds
+            old."""
+            if not self._touch_interval:
+                return False
+            if not readonly and (self._auto or self.dirty()):
+                return False
+            sess = self.__dict__['_sess']
+            if sess.is_new:
+                return False
+            if isinstance(sess, CookieSession):
+                last_accessed = sess.accessed_dict.get('_accessed_time')
+            else:
+                last_accessed = sess.last_accessed
+            if last_accessed is None:
+                return False
+            return time.time() - last_accessed < self._touch_interval
+
+        def _persist_behind(self):
+            """ Serialize the session as ``persist()`` would and hand the
+            backend write to the write-behind queue."""
+            sess = self.__dict__['_sess']
+            accessed_only = not (self._auto or self.dirty())
+            if accessed_only and (sess.is_new or not sess.save_atime):
+                return
+            if accessed_only:
+                data = dict(sess.accessed_dict.items())
+            else:
+                data = dict(sess.items())
+                if sess.use_cookies and sess.is_new:
+                    self.__dict__['_headers']['set_cookie'] = True
+            payload = sess._encrypt_data(data)
+            self.write_behind.submit(
+                sess.id, session_write_job(sess, payload))
+
+        def _split_value(self, key, value, default=_marker):
+            """ Return ``value``, or the value stored apart it stands for,
+            fetching it if it was not read yet during this request."""
+            ref = placeholder(value)
+            if ref is None:
+                return value
+            loaded = self.__dict__.setdefault('_split_loaded', {})
+            if key not in loaded:
+                sess = self.__dict__['_sess']
+                try:
+                    loaded[key] = self.split_store.load(sess, key, ref[0])
+                except KeyError:
+                    # the key is gone for the rest of the request, and
+                    # from the session if it is saved
+                    sess.pop(key, None)
+                    if default is _marker:
+                        raise
+                    return default
+            return loaded[key]
+
+        def _split_values(self):
+            """ Replace the values about to be saved which reach the
+            ``split_threshold`` by placeholders, and return the jobs
+            writing their entries and the jobs removing the entries no
+            longer referenced."""
+            store = self.split_store
+            sess = self.__dict__['_sess']
+            accessed_only = not (self._auto or self.dirty())
+            if accessed_only and (sess.is_new or not sess.save_atime):
+                return (), ()
+            loaded = self.__dict__.setdefault('_split_loaded', {})
+            accessed = sess.accessed_dict
+            now = time.time()
+            writes = []
+            removals = []
+            if not accessed_only:
+                if (self.__dict__.get('_forced') or
+                    _session_id(sess) != self.__dict__.get('_loaded_id')):
+                    keys = (set(sess) | set(accessed)) - _SESSION_METADATA
+                else:
+                    keys = self._changed_keys()
+                for key in keys:
+                    value = sess.get(key, _marker)
+                    old = placeholder(accessed.get(key))
+                    payload = None
+                    if value is not _marker:
+                        if placeholder(value) is not None:
+                            if key not in loaded:
+                                # never read, so unchanged
+                                continue
+                            value = loaded[key]
+                            sess[key] = value
+                        payload = store.payload(sess, key, value)
+                    if payload is not None:
+                        name = old and old[0] or store.namespace_name(
+                            sess, key)
+                        writes.append(store.store(sess, name, payload))
+                        sess[key] = store.reference(name, now)
+                        loaded[key] = value
+                    elif old is not None:
+                        removals.append(store.remove(sess, old[0]))
+            for key, value in list(sess.items()):
+                ref = placeholder(value)
+                if ref is None or not store.needs_refresh(sess, ref[1], now):
+                    continue
+                value = self._split_value(key, value, None)
+                if value is None:
+                    continue
+                writes.append(store.store(
+                    sess, ref[0], sess._encrypt_data({key: value}),
+                    refresh=True))
+                sess[key] = store.reference(ref[0], now)
+                if placeholder(accessed.get(key)) == ref:
+                    accessed[key] = sess[key]
+            return writes, removals
+
+        def _split_jobs(self, jobs):
+            """ Run ``jobs`` now, or queue them behind the session write
+            with ``write_behind``."""
+            sess = self.__dict__['_sess']
+            for job in jobs:
+                if self.write_behind is not None:
+                    self.write_behind.submit(sess.id, job)
+                else:
+                    job()
+
+        def _index_principal(self):
+            """ Record the session under its principal in the
+            ``principal_index``, and remove the entry of the principal and
+            session id it was loaded with if either changed."""
+            sess = self.__dict__['_sess']
+            principal = sess.get(self._principal_key)
+            indexed = sess.get(INDEX_KEY)
+            loaded = self.__dict__.get('_loaded_index')
+            loaded_id = self.__dict__.get('_loaded_id')
+            moved = _session_id(sess) != loaded_id
+            if principal is None:
+                if indexed is not None:
+                    del self[INDEX_KEY]
+            elif (indexed is None or indexed[0] != principal or moved or
+                  self.principal_index.needs_refresh(indexed[1])):
+                self[INDEX_KEY] = self.principal_index.entry(
+                    principal, indexed)
+                self.principal_index.add(principal, sess.id)
+            if loaded is not None and (moved or loaded[0] != principal):
+                self.principal_index.discard(loaded[0], loaded_id)
+
+        @classmethod
+        def invalidate_sessions_for(cls, principal):
+            """ Delete every session whose ``principal_key`` holds
+            ``principal``, and return their number."""
+            if cls.principal_index is None:
+                raise ConfigurationError(
+                    'invalidate_sessions_for requires principal_key')
+            return cls.principal_index.invalidate(principal)
+
+        def _persist_optimistic(self):
+            """ Save the session as ``persist()`` would, but merge this
+            request's changes into the stored session if another request
+            saved it since it was loaded."""
+            sess = self.__dict__['_sess']
+            accessed_only = not (self._auto or self.dirty())
+            if accessed_only and (sess.is_new or not sess.save_atime):
+                return
+            if (_session_id(sess) != self.__dict__.get('_loaded_id') or
+                getattr(sess, 'namespace', None) is None or
+                sess.namespace.namespace != sess.id):
+                # a new or regenerated id has nothing to merge with
+                if not accessed_only:
+                    version = sess.get('_version', 0) + 1
+                    sess['_key_versions'] = dict.fromkeys(
+                        set(sess) - _SESSION_METADATA, version)
+                    sess['_version'] = version
+                self.persist()
+                return
+            loaded = sess.accessed_dict
+            if accessed_only:
+                ours = dict(loaded.items())
+                changed = set()
+            else:
+                ours = dict(sess.items())
+                if self.__dict__.get('_forced'):
+                    changed = (set(ours) | set(loaded)) - _SESSION_METADATA
+                else:
+                    changed = self._changed_keys()
+            namespace = sess.namespace
+            # the write lock of file-like backends covers the whole
+            # compare-and-swap; others use the creation lock of the key
+            lock = None
+            if not isinstance(namespace, OpenResourceNamespaceManager):
+                lock = namespace.get_creation_lock('session')
+                lock.acquire()
+            namespace.acquire_write_lock()
+            try:
+                try:
+                    stored = namespace['session']
+                except KeyError:
+                    stored = None
+                stored = stored and sess._decrypt_data(stored) or {}
+                version = stored.get('_version', 0)
+                if version == loaded.get('_version', 0):
+                    data = ours
+                else:
+                    data = self._merge(stored, ours, loaded, changed)
+                key_versions = dict(data.get('_key_versions', {}))
+                for key in changed:
+                    key_versions[key] = version + 1
+                data['_key_versions'] = key_versions
+                data['_version'] = version + 1
+                namespace['session'] = sess._encrypt_data(data)
+            finally:
+                namespace.release_write_lock()
+                if lock is not None:
+                    lock.release()
+            if sess.use_cookies and sess.is_new:
+                sess.request['set_cookie'] = True
+
+        def _merge(self, stored, ours, loaded, changed):
+            """ Apply the ``changed`` keys of ``ours`` to ``stored``, a
+            session saved by another request since ``loaded``."""
+            self.write_stats['merges'] += 1
+            stored_versions = stored.get('_key_versions', {})
+            loaded_versions = loaded.get('_key_versions', {})
+            conflicts = []
+            data = dict(stored)
+            for key in changed:
+                value = ours.get(key, _marker)
+                if (stored_versions.get(key) != loaded_versions.get(key) and
+                    stored.get(key, _marker) != value):
+                    conflicts.append(key)
+                elif value is _marker:
+                    data.pop(key, None)
+                else:
+                    data[key] = value
+            if conflicts:
+                self.write_stats['conflicts'] += 1
+                raise SessionConflictError(conflicts)
+            data['_accessed_time'] = max(
+                ours.get('_accessed_time', 0), stored.get('_accessed_time', 0))
+            return data
+
+        def _cookieless(self):
+            """ Return ``True`` if this is a lazy session which has not
+            been loaded yet and the request carries no session cookie, in
+            which case reads can be answered without creating a Beaker
+            session at all."""
+            if not self._lazy or self.__dict__['_sess'] is not None:
+                return False
+            return not self._session_cookie()
+
+        def _session_cookie(self):
+            """ Return ``True`` if the request carries a session
+            cookie."""
+            cookie = self.__dict__['_environ'].get('HTTP_COOKIE')
+            if not cookie or self._cookie_key not in cookie:
+                return False
+            # the key may be a prefix of another cookie's, e.g. the CSRF
+            # nonce cookie
+            return self._cookie_re.search(cookie) is not None
+
+        # non-modifying dictionary methods
+
+        def __getitem__(self, key):
+            if key not in _BEAKER_KEYS and self._cookieless():
+                raise KeyError(key)
+            value = self._session()[key]
+            if self.split_store is not None:
+                value = self._split_value(key, value)
+            return value
+
+        def __contains__(self, key):
+            if key not in _BEAKER_KEYS and self._cookieless():
+                return False
+            return key in self._session()
+
+        def get(self, key, default=None):
+            if key not in _BEAKER_KEYS and self._cookieless():
+                return default
+            value = self._session().get(key, default)
+            if self.split_store is not None:
+                value = self._split_value(key, value, default)
+            return value
+
+        def items(self):
+            sess = self._session()
+            if self.split_store is None:
+                return sess.items()
+            return [(k, self._split_value(k, v, None))
+                    for k, v in sess.items()]
+
+        def values(self):
+            return [v for k, v in self.items()]
 
         # ISession API
 
         @property
         def new(self):
+            if self._cookieless():
+                return True
             return self.last_accessed is None
 
-        changed = SessionObject.save
+        def changed(self):
+            self._writable_session()
+            self.__dict__['_forced'] = True
+            SessionObject.save(self)
+
+        save = changed
+
+        def delete(self):
+            self._writable_session()
+            self.__dict__['_forced'] = True
+            SessionObject.delete(self)
+
+        # change tracking
+
+        def _track(self, sess, key):
+            """ Remember the value ``key`` had before it was first modified
+            during this request."""
+            originals = self.__dict__.setdefault('_originals', {})
+            if key not in originals:
+                originals[key] = sess.get(key, _marker)
+
+        def _modified(self):
+            """ Return ``True`` if the session content differs from what
+            was loaded.  Keys holding mutable values which were touched are
+            always considered modified, since they may have been changed in
+            place."""
+            if not self.dirty():
+                return False
+            if self.__dict__.get('_forced'):
+                return True
+            sess = self.__dict__['_sess']
+            if _session_id(sess) != self.__dict__.get('_loaded_id'):
+                return True
+            return bool(self._changed_keys())
+
+        def _changed_keys(self):
+            """ Return the set of keys whose values may differ from those
+            loaded."""
+            sess = self.__dict__['_sess']
+            changed = set()
+            for key, original in self.__dict__.get('_originals', {}).items():
+                current = sess.get(key, _marker)
+                if current is _marker or original is _marker:
+                    if current is not original:
+                        changed.add(key)
+                elif not (isinstance(current, _IMMUTABLE_TYPES)
+                          and type(current) is type(original)
+                          and current == original):
+                    changed.add(key)
+            return changed
 
         # modifying dictionary methods
 
-        @call_save
         def clear(self):
-            return self._session().clear()
+            sess = self._session()
+            keys = [k for k in sess if k not in _BEAKER_KEYS]
+            if keys:
+                self._writable_session()
+            for k in keys:
+                self._track(sess, k)
+            sess.clear()
+            if keys:
+                SessionObject.save(self)
 
-        @call_save
         def update(self, d, **kw):
-            return self._session().update(d, **kw)
+            items = dict(d, **kw)
+            if not items:
+                return
+            sess = self._writable_session()
+            for k in items:
+                self._track(sess, k)
+            sess.update(items)
+            SessionObject.save(self)
 
-        @call_save
         def setdefault(self, k, d=None):
-            return self._session().setdefault(k, d)
+            sess = self._session()
+            if k in sess:
+                return self[k]
+            self._writable_session()
+            self._track(sess, k)
+            SessionObject.save(self)
+            return sess.setdefault(k, d)
 
-        @call_save
         def pop(self, k, d=None):
-            return self._session().pop(k, d)
+            if self._cookieless():
+                return d
+            sess = self._session()
+            if k not in sess:
+                return d
+            self._writable_session()
+            self._track(sess, k)
+            SessionObject.save(self)
+            value = sess.pop(k)
+            if self.split_store is not None:
+                value = self._split_value(k, value, d)
+            return value
 
-        @call_save
         def popitem(self):
-            return self._session().popitem()
+            sess = self._writable_session()
+            item = sess.popitem()
+            originals = self.__dict__.setdefault('_originals', {})
+            originals.setdefault(item[0], item[1])
+            SessionObject.save(self)
+            if self.split_store is not None:
+                item = (item[0], self._split_value(item[0], item[1], None))
+            return item
+
+        def __setitem__(self, key, value):
+            sess = self._writable_session()
+            self._track(sess, key)
+            sess[key] = value
+            SessionObject.save(self)
 
-        __setitem__ = call_save(SessionObject.__setitem__)
-        __delitem__ = call_save(SessionObject.__delitem__)
+        def __delitem__(self, key):
+            sess = self._writable_session()
+            self._track(sess, key)
+            del sess[key]
+            SessionObject.save(self)
 
         # Flash API methods
         def flash(self, msg, queue='', allow_duplicate=True):
-            storage = self.setdefault('_f_' + queue, [])
+            key = '_f_' + queue
+            storage = self.setdefault(key, [])
             if allow_duplicate or (msg not in storage):
+                self._track(self._writable_session(), key)
                 storage.append(msg)
+                SessionObject.save(self)
 
         def pop_flash(self, queue=''):
             storage = self.pop('_f_' + queue, [])
@@ -85,36 +905,130 @@ def BeakerSessionFactoryConfig(**options):
 
         # CSRF API methods
         def new_csrf_token(self):
+            if self._csrf == 'hmac':
+                return self._constant_csrf_token or self._hmac_csrf_token()
             token = (self._constant_csrf_token
                      or hexlify(os.urandom(20)).decode('ascii'))
             self['_csrft_'] = token
             return token
 
         def get_csrf_token(self):
+            if self._csrf == 'hmac':
+                return self._constant_csrf_token or self._hmac_csrf_token(
+                    self._request_csrf_nonce())
             token = self.get('_csrft_', None)
             if token is None:
                 token = self.new_csrf_token()
             return token
 
+        def check_csrf_token(self, supplied_token):
+            """ Return ``True`` if ``supplied_token`` matches the current
+            CSRF token, comparing in constant time."""
+            return not strings_differ(
+                self.get_csrf_token(), supplied_token or '')
+
+        # stateless (csrf = hmac) tokens
+
+        def _request_csrf_nonce(self):
+            """ Return the CSRF nonce of this request, if any."""
+            nonce = self.__dict__.get('_csrf_nonce')
+            if nonce is None:
+                cookie = self.__dict__['_environ'].get('HTTP_COOKIE')
+                if cookie and self._csrf_cookie in cookie:
+                    morsel = SimpleCookie(cookie).get(self._csrf_cookie)
+                    if (morsel is not None and
+                        _csrf_nonce_re.match(morsel.value)):
+                        nonce = morsel.value
+            return nonce
+
+        def _hmac_csrf_token(self, nonce=None):
+            """ Derive the CSRF token from ``nonce`` and the session id;
+            without a nonce a new one is created and sent to the browser in
+            a cookie."""
+            if nonce is None:
+                nonce = hexlify(os.urandom(16)).decode('ascii')
+                if not self.__dict__.get('_csrf_cookie_out'):
+                    self.__dict__['_csrf_cookie_out'] = True
+                    self.__dict__['_request'].add_response_callback(
+                        self._set_csrf_cookie)
+            self.__dict__['_csrf_nonce'] = nonce
+            # a nonce planted by whoever can set cookies for the site is
+            # useless with another visitor's session
+            message = '%s\0%s' % (nonce, self._csrf_session_id() or '')
+            return hmac.new(self._csrf_key, message.encode('utf-8'),
+                            hashlib.sha256).hexdigest()
+
+        def _csrf_session_id(self):
+            """ Return the id of the session of this request, without
+            reading the session backend, or ``None`` if there is none
+            yet."""
+            sess = self.__dict__['_sess']
+            if sess is None:
+                if self._options.get('type') != 'cookie':
+                    return self._request_session_id()
+                if not self._session_cookie():
+                    return None
+                # cookie-only sessions keep their id in the cookie data
+                sess = self._session()
+            return _session_id(sess)
+
+        def _request_session_id(self):
+            """ Return the session id carried by the session cookie of
+            this request, if it is valid."""
+            if not self._session_cookie():
+                return None
+            cookie = self.__dict__['_environ']['HTTP_COOKIE']
+            secret = self._options.get('secret')
+            if secret:
+                cookie = SignedCookie(secret, input=cookie)
+            else:
+                cookie = SimpleCookie(cookie)
+            value = cookie[self._cookie_key].value
+            if value is InvalidSignature:
+                return None
+            return value
+
+        def _set_csrf_cookie(self, request, response):
+            options = self._options
+            cookie = ['%s=%s' % (self._csrf_cookie,
+                                 self.__dict__['_csrf_nonce']),
+                      'Path=%s' % options.get('cookie_path', '/')]
+            if options.get('cookie_domain'):
+                cookie.append('Domain=%s' % options['cookie_domain'])
+            if options.get('secure'):
+                cookie.append('secure')
+            cookie.append('HttpOnly')
+            samesite = options.get('samesite', 'Lax')
+            if samesite:
+                cookie.append('SameSite=%s' % samesite)
+            response.headerlist.append(('Set-Cookie', '; '.join(cookie)))
+
     return implementer(ISession)(PyramidBeakerSessionObject)
 
 
-def call_save(wrapped):
-    """ By default, in non-auto-mode beaker badly wants people to
-    call save even though it should know something has changed when
-    a mutating method is called.  This hack should be removed if
-    Beaker ever starts to do this by default. """
-    def save(session, *arg, **kw):
-        value = wrapped(session, *arg, **kw)
-        session.save()
-        return value
-    save.__doc__ = wrapped.__doc__
-    return save
+def _session_id(sess):
+    # cookie-only sessions keep their id in the dictionary itself
+    try:
+        return sess.id
+    except KeyError:
+        return None
+
+
+# pyramid_beaker specific session settings which need coercion
+_bool_options = ('cookie_on_exception', 'lazy', 'write_behind', 'tiered',
+                 'instrument', 'optimistic')
+_int_options = ('write_behind_workers', 'write_behind_queue_size',
+                'touch_interval', 'compress_threshold', 'compress_level',
+                'cookie_max_size', 'tiered_max_items', 'split_threshold')
 
 
 def session_factory_from_settings(settings):
     """ Return a Pyramid session factory using Beaker session settings
     supplied from a Paste configuration file"""
+    return BeakerSessionFactoryConfig(**_parse_session_options(settings))
+
+def _parse_session_options(settings):
+    """ Return the session options found in ``settings``."""
     prefixes = ('session.', 'beaker.session.')
     options = {}
 
@@ -123,12 +1037,18 @@ def session_factory_from_settings(settings):
         for prefix in prefixes:
             if k.startswith(prefix):
                 option_name = k[len(prefix):]
-                if option_name == 'cookie_on_exception':
+                if option_name in _bool_options:
                     v = asbool(v)
+                elif option_name in _int_options:
+                    v = int(v)
                 options[option_name] = v
 
-    options = coerce_session_params(options)
-    return BeakerSessionFactoryConfig(**options)
+    return coerce_session_params(options)
+
+# Region options added by pyramid_beaker which Beaker does not coerce.
+_region_int_options = ('stale_ttl',)
+_region_float_options = ('singleflight_timeout',)
+_region_bool_options = ('singleflight',)
 
 def set_cache_regions_from_settings(settings):
     """ Add cache support to the Pylons application.
@@ -138,6 +1058,18 @@ def set_cache_regions_from_settings(settings):
     with either 'beaker.cache.' or 'cache.'.
 
     """
+    cache.cache_regions.update(_parse_cache_regions(settings))
+    for prefix in ('beaker.cache.', 'cache.'):
+        if prefix + 'tag_region' in settings:
+            region = settings[prefix + 'tag_region'].strip() or None
+            if region is not None and region not in cache.cache_regions:
+                raise ConfigurationError(
+                    'Unknown cache.tag_region %r' % (region,))
+            set_tag_region(region)
+
+def _parse_cache_regions(settings):
+    """ Return a dictionary mapping the cache regions configured in
+    ``settings`` to their options."""
     cache_settings = {'regions':None}
     for key in settings.keys():
         for prefix in ['beaker.cache.', 'cache.']:
@@ -149,6 +1081,7 @@ def set_cache_regions_from_settings(settings):
     if 'enabled' not in cache_settings:
         cache_settings['enabled'] = True
 
+    result = {}
     regions = cache_settings['regions']
     if regions:
         for region in regions:
@@ -168,9 +1101,49 @@ def set_cache_regions_from_settings(settings):
                 if key.startswith(region_prefix):
                     region_settings[key[region_len:]] = cache_settings.pop(key)
             coerce_cache_params(region_settings)
-            cache.cache_regions[region] = region_settings
+            for key in _region_int_options:
+                if key in region_settings:
+                    region_settings[key] = int(region_settings[key])
+            for key in _region_float_options:
+                if key in region_settings:
+                    region_settings[key] = float(region_settings[key])
+            for key in _region_bool_options:
+                if key in region_settings:
+                    region_settings[key] = asbool(region_settings[key])
+            result[region] = region_settings
+    return result
+
+def invalidate_sessions_for(request, principal):
+    """ Delete every session of ``principal`` using the session factory
+    of ``request``'s registry, which must be configured with a
+    ``principal_key``.  Return the number of sessions deleted."""
+    factory = request.registry.getUtility(ISessionFactory)
+    return factory.invalidate_sessions_for(principal)
+
+def session_readonly_view(view, info):
+    """ View deriver making the session read-only for views configured
+    with ``session_readonly=True``."""
+    if info.options.get('session_readonly'):
+        def wrapper(context, request):
+            request.session_readonly = True
+            return view(context, request)
+        return wrapper
+    return view
+
+session_readonly_view.options = ('session_readonly',)
 
 def includeme(config):
+    configure_pools(**pool_options_from_settings(config.registry.settings))
     session_factory = session_factory_from_settings(config.registry.settings)
     config.set_session_factory(session_factory)
     set_cache_regions_from_settings(config.registry.settings)
+    config.add_view_deriver(session_readonly_view)
+    config.add_view_deriver(
+        'pyramid_beaker.viewcache.response_cache_view')
+    config.add_request_method(region_cache)
+    sinks = sinks_from_settings(config.registry.settings)
+    for sink in sinks:
+        add_sink(sink)
+    if sinks or asbool(config.registry.settings.get('session.instrument')):
+        config.add_tween(
+            'pyramid_beaker.instrumentation.instrumentation_tween_factory')
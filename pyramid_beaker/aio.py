@@ -0,0 +1,250 @@
+""" asyncio support for sessions and cache regions (Python 3.5+).
+
+Beaker's backends are synchronous.  The awaitables here run them in an
+executor thread (the event loop's default executor unless
+:func:`set_executor` names another), so that the event loop keeps running
+while a session or cache value is read or written.  Cache namespaces with
+an async-capable storage adapter, listed in :data:`async_backends`, are
+instead read and written with native async I/O.
+
+Sessions created by :func:`pyramid_beaker.BeakerSessionFactoryConfig` have
+``load_async()`` and ``persist_async()`` methods returning such
+awaitables; :class:`AsyncRegionCache` offers awaitable versions of the
+region cache operations::
+
+    cache = get_async_cache('short_term', 'myapp.users')
+    user = await cache.get(user_id, createfunc=lambda: load_user(user_id))
+
+where ``load_user`` is a coroutine function.
+"""
+import asyncio
+import functools
+import inspect
+import pickle
+import time
+import weakref
+
+from beaker.ext.redisnm import RedisNamespaceManager
+
+from pyramid_beaker.regions import TaggedValue
+from pyramid_beaker.regions import _marker
+from pyramid_beaker.regions import get_cache
+from pyramid_beaker.regions import tag_generations
+
+_executor = [None]
+
+
+def set_executor(executor):
+    """ Run synchronous backend operations in ``executor`` (a
+    :class:`concurrent.futures.Executor`), or in the event loop's default
+    executor if ``None``."""
+    _executor[0] = executor
+
+
+async def run_sync(fn, *args, **kw):
+    """ Call ``fn(*args, **kw)`` in the executor and return its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _executor[0], functools.partial(fn, *args, **kw))
+
+
+class AsyncRedisAdapter(object):
+    """ Native async access to Beaker's ``ext:redis`` namespaces with a
+    ``redis.asyncio`` client, reading and writing values in the format of
+    :class:`pyramid_beaker.regions.RedisMulti`."""
+    def __init__(self, namespace, client):
+        self.namespace = namespace
+        self.client = client
+
+    @classmethod
+    def from_cache(cls, cache):
+        url = cache.nsargs.get('url')
+        if not isinstance(url, str):
+            return None
+        try:
+            from redis import asyncio as aioredis
+        except ImportError:
+            return None
+        clients = _clients.setdefault(asyncio.get_running_loop(), {})
+        client = clients.get(url)
+        if client is None:
+            client = clients[url] = aioredis.from_url(url)
+        return cls(cache.namespace, client)
+
+    async def get(self, keys):
+        values = await self.client.mget(
+            [self.namespace._format_key(key) for key in keys])
+        return dict((key, pickle.loads(value))
+                    for key, value in zip(keys, values) if value is not None)
+
+    async def set(self, mapping, expiretime):
+        if expiretime is None:
+            expiretime = self.namespace.timeout
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in mapping.items():
+            key = self.namespace._format_key(key)
+            value = pickle.dumps(value)
+            if expiretime is not None:
+                pipe.setex(key, int(expiretime), value)
+            else:
+                pipe.set(key, value)
+        await pipe.execute()
+
+    async def delete(self, keys):
+        if keys:
+            await self.client.delete(
+                *[self.namespace._format_key(key) for key in keys])
+
+
+# clients of async adapters, per event loop
+_clients = weakref.WeakKeyDictionary()
+
+# Namespace manager classes with an async-capable storage adapter.  Other
+# backends run in the executor.
+async_backends = [
+    (RedisNamespaceManager, AsyncRedisAdapter),
+    ]
+
+
+def async_adapter(cache):
+    """ Return the async storage adapter for the namespace of the
+    :class:`pyramid_beaker.regions.RegionCache` ``cache``, or ``None``."""
+    for namespace_class, adapter in async_backends:
+        if isinstance(cache.namespace, namespace_class):
+            return adapter.from_cache(cache)
+    return None
+
+
+class AsyncRegionCache(object):
+    """ Awaitable operations on the
+    :class:`pyramid_beaker.regions.RegionCache` ``cache``, through
+    ``adapter`` (by default the one :func:`async_adapter` finds) or in the
+    executor.  Values are read and written in the format of the
+    synchronous cache, so both can share a region."""
+    def __init__(self, cache, adapter=None):
+        self.cache = cache
+        if adapter is None:
+            adapter = async_adapter(cache)
+        self.adapter = adapter
+        self._creating = {}
+
+    async def get(self, key, createfunc=None, tags=None):
+        """ Return the value of ``key``, creating it with ``createfunc``
+        if it is missing or expired.  Raises :exc:`KeyError` if it is
+        missing and there is no ``createfunc``.
+
+        ``createfunc`` is called in the event loop, and its result awaited
+        if it is awaitable; blocking creation functions should be wrapped
+        with :func:`run_sync`.  Concurrent misses of ``key`` await a single
+        call of it, tagged with ``tags`` if given."""
+        found = await self.get_multi([key])
+        if key in found:
+            return found[key]
+        if createfunc is None:
+            raise KeyError(key)
+        future = self._creating.get(key)
+        if future is None:
+            future = self._creating[key] = asyncio.ensure_future(
+                self._create(key, createfunc, tags))
+            future.add_done_callback(
+                lambda future: self._creating.pop(key, None))
+        return await asyncio.shield(future)
+    get_value = get
+
+    async def _create(self, key, createfunc, tags):
+        if tags:
+            # read before createfunc, so that invalidations racing with it
+            # leave the new value stale
+            generations = await run_sync(tag_generations, tags)
+        value = createfunc()
+        if inspect.isawaitable(value):
+            value = await value
+        if tags:
+            await self._store({key: TaggedValue(generations, value)})
+        else:
+            await self._store({key: value})
+        return value
+
+    async def put(self, key, value, tags=None):
+        """ Store ``value`` under ``key``, tagged with ``tags`` if
+        given."""
+        await self.set_multi({key: value}, tags)
+    set_value = put
+
+    async def get_multi(self, keys):
+        """ Return a dictionary mapping those of ``keys`` which have a
+        current value to it."""
+        keys = list(keys)
+        if self.adapter is None:
+            return await run_sync(self.cache.get_multi, keys)
+        cache = self.cache
+        entries = await self.adapter.get([cache._key(key) for key in keys])
+        result = {}
+        tagged = []
+        for key in keys:
+            value = cache._current(entries.get(cache._key(key)))
+            if isinstance(value, TaggedValue):
+                tagged.append((key, value))
+            elif value is not _marker:
+                result[key] = value
+        if tagged:
+            tags = set()
+            for key, value in tagged:
+                tags.update(value.generations)
+            generations = await run_sync(tag_generations, tags)
+            for key, value in tagged:
+                if value.current(generations):
+                    result[key] = value.value
+        return result
+
+    async def set_multi(self, mapping, tags=None):
+        """ Store every key and value of the dictionary ``mapping``, tagged
+        with ``tags`` if given."""
+        if self.adapter is None:
+            await run_sync(self.cache.set_multi, mapping, tags)
+            return
+        if tags:
+            generations = await run_sync(tag_generations, tags)
+            mapping = dict((key, TaggedValue(generations, value))
+                           for key, value in mapping.items())
+        await self._store(mapping)
+
+    async def _store(self, mapping):
+        if self.adapter is None:
+            await run_sync(self.cache.set_multi, mapping)
+            return
+        cache = self.cache
+        now = time.time()
+        await self.adapter.set(
+            dict((cache._key(key), (now, cache.expiretime, value))
+                 for key, value in mapping.items()),
+            cache._backend_expire())
+
+    async def delete_multi(self, keys):
+        """ Remove ``keys`` from the cache."""
+        keys = list(keys)
+        if self.adapter is None:
+            await run_sync(self.cache.delete_multi, keys)
+        else:
+            await self.adapter.delete([self.cache._key(key) for key in keys])
+
+    async def remove_value(self, key):
+        """ Remove ``key`` from the cache."""
+        await self.delete_multi([key])
+
+
+# AsyncRegionCache instances, per event loop
+_async_caches = weakref.WeakKeyDictionary()
+
+
+def get_async_cache(region, namespace):
+    """ Return the :class:`AsyncRegionCache` of ``namespace`` in the cache
+    ``region`` for the running event loop; raises :exc:`RuntimeError` when
+    called outside one."""
+    caches = _async_caches.setdefault(asyncio.get_running_loop(), {})
+    try:
+        return caches[(region, namespace)]
+    except KeyError:
+        async_cache = caches[(region, namespace)] = AsyncRegionCache(
+            get_cache(region, namespace))
+        return async_cache
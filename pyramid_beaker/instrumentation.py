@@ -0,0 +1,221 @@
+""" Timing and size events for sessions and cache regions.
+
+pyramid_beaker emits an :class:`Event` at the points it owns:
+
+``session.load``
+  Loading a session from its backend (``duration``).
+
+``session.serialize`` / ``session.deserialize``
+  Encoding or decoding session data (``duration`` and payload ``size``).
+
+``session.persist``
+  Saving a session in the response callback (``duration``).
+
+``session.cookie``
+  Emitting a session cookie (``size`` of the ``Set-Cookie`` value).
+
+``cache.hit`` / ``cache.miss``
+  Reading a key of a :mod:`pyramid_beaker.regions` cache (``duration``).
+
+``cache.set``
+  Storing a key in a region cache (``duration``).
+
+``cache.regenerate``
+  Computing a missing or expired value with ``createfunc``
+  (``duration``).
+
+``cache.get_multi`` / ``cache.set_multi``
+  Bulk operations on a region cache (``duration``, with the number of
+  ``hits`` and ``misses`` or of ``keys`` as tags).
+
+Cache events are tagged with their ``region`` and ``namespace``.
+
+Events are handed to every sink registered with :func:`add_sink`; sinks
+are callables accepting an :class:`Event`.  When the
+:func:`instrumentation_tween_factory` tween is installed, the events of a
+request are also summed up in ``request.environ['pyramid_beaker.metrics']``.
+Nothing is measured while there is neither a sink nor a tween-managed
+request.
+"""
+import logging
+import socket
+import threading
+import time
+
+from pyramid.path import DottedNameResolver
+from pyramid.settings import aslist
+
+log = logging.getLogger(__name__)
+
+ENVIRON_KEY = 'pyramid_beaker.metrics'
+
+_sinks = []
+_local = threading.local()
+
+
+class Event(object):
+    """ A measurement: ``name``, ``duration`` in seconds and ``size`` in
+    bytes (either may be ``None``) and a dictionary of ``tags``."""
+    __slots__ = ('name', 'duration', 'size', 'tags')
+
+    def __init__(self, name, duration=None, size=None, tags=None):
+        self.name = name
+        self.duration = duration
+        self.size = size
+        self.tags = tags or {}
+
+    def __repr__(self):
+        return '<Event %s duration=%r size=%r tags=%r>' % (
+            self.name, self.duration, self.size, self.tags)
+
+
+def add_sink(sink):
+    """ Send all events to ``sink``."""
+    _sinks.append(sink)
+
+
+def remove_sink(sink):
+    """ Stop sending events to ``sink``."""
+    _sinks.remove(sink)
+
+
+def active():
+    """ Return whether anybody listens to events in this thread."""
+    return bool(_sinks) or getattr(_local, 'totals', None) is not None
+
+
+def emit(name, duration=None, size=None, totals=None, **tags):
+    """ Hand an event to the sinks and add it to ``totals`` (by default
+    those of the request the current thread is handling)."""
+    if totals is None:
+        totals = getattr(_local, 'totals', None)
+    if totals is not None:
+        entry = totals.get(name)
+        if entry is None:
+            entry = totals[name] = {'count': 0, 'duration': 0.0, 'size': 0}
+        entry['count'] += 1
+        if duration is not None:
+            entry['duration'] += duration
+        if size is not None:
+            entry['size'] += size
+    if _sinks:
+        event = Event(name, duration, size, tags)
+        for sink in list(_sinks):
+            try:
+                sink(event)
+            except Exception:
+                log.exception('Instrumentation sink %r failed', sink)
+
+
+class MemorySink(object):
+    """ Keep every event in the ``events`` list."""
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event):
+        self.events.append(event)
+
+    def clear(self):
+        del self.events[:]
+
+
+class LoggingSink(object):
+    """ Log every event to ``logger`` (``pyramid_beaker.instrumentation``
+    by default) at ``level``."""
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or log
+        self.level = level
+
+    def __call__(self, event):
+        self.logger.log(self.level, '%s duration=%s size=%s %s', event.name,
+                        event.duration, event.size, event.tags)
+
+
+class StatsdSink(object):
+    """ Send events to a statsd server over UDP: durations as timers (in
+    milliseconds), sizes as histograms and one counter per event."""
+    def __init__(self, host='127.0.0.1', port=8125, prefix='pyramid_beaker'):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, event):
+        name = '%s.%s' % (self.prefix, event.name) if self.prefix else \
+            event.name
+        lines = ['%s:1|c' % name]
+        if event.duration is not None:
+            lines.append('%s.time:%.3f|ms' % (name, event.duration * 1000))
+        if event.size is not None:
+            lines.append('%s.size:%d|h' % (name, event.size))
+        try:
+            self.socket.sendto('\n'.join(lines).encode('ascii'), self.address)
+        except socket.error:
+            pass
+
+
+class InstrumentedSerializer(object):
+    """ Emit ``session.serialize`` and ``session.deserialize`` events for
+    the payloads of ``serializer``."""
+    def __init__(self, serializer):
+        self.serializer = serializer
+
+    def dumps(self, data):
+        if not active():
+            return self.serializer.dumps(data)
+        start = time.time()
+        payload = self.serializer.dumps(data)
+        emit('session.serialize', time.time() - start, len(payload))
+        return payload
+
+    def loads(self, payload):
+        if not active():
+            return self.serializer.loads(payload)
+        start = time.time()
+        data = self.serializer.loads(payload)
+        emit('session.deserialize', time.time() - start, len(payload))
+        return data
+
+
+def _end_request(request):
+    _local.totals = None
+
+
+def instrumentation_tween_factory(handler, registry):
+    """ A tween collecting the events of each request in
+    ``request.environ['pyramid_beaker.metrics']``, a dictionary mapping
+    event names to their ``count`` and total ``duration`` and ``size``."""
+    def instrumentation_tween(request):
+        totals = request.environ[ENVIRON_KEY] = {}
+        _local.totals = totals
+        request.add_finished_callback(_end_request)
+        return handler(request)
+    return instrumentation_tween
+
+
+_sink_names = {
+    'logging': LoggingSink,
+    'memory': MemorySink,
+    }
+
+
+def sinks_from_settings(settings):
+    """ Return the sinks named by the ``pyramid_beaker.sinks`` setting:
+    ``logging``, ``memory``, ``statsd`` (configured with
+    ``pyramid_beaker.statsd_host``, ``pyramid_beaker.statsd_port`` and
+    ``pyramid_beaker.statsd_prefix``) or dotted names of sinks."""
+    sinks = []
+    for name in aslist(settings.get('pyramid_beaker.sinks', '')):
+        if name == 'statsd':
+            sinks.append(StatsdSink(
+                settings.get('pyramid_beaker.statsd_host', '127.0.0.1'),
+                settings.get('pyramid_beaker.statsd_port', 8125),
+                settings.get('pyramid_beaker.statsd_prefix',
+                             'pyramid_beaker')))
+        elif name in _sink_names:
+            sinks.append(_sink_names[name]())
+        else:
+            sink = DottedNameResolver(None).resolve(name)
+            if isinstance(sink, type):
+                sink = sink()
+            sinks.append(sink)
+    return sinks
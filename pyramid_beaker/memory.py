@@ -0,0 +1,208 @@
+""" A bounded in-memory cache backend.
+
+Beaker's ``memory`` backend keeps every key until it is explicitly removed,
+so a region with many distinct keys grows without limit.  The
+``bounded_memory`` backend defined here caps each namespace at
+``max_items`` entries and ``max_bytes`` bytes, evicting the least recently
+(``eviction = lru``, the default) or least frequently (``eviction = lfu``)
+used entry first:
+
+.. code-block:: ini
+
+   cache.regions = short_term
+   cache.short_term.type = bounded_memory
+   cache.short_term.max_items = 10000
+   cache.short_term.max_bytes = 67108864
+   cache.short_term.eviction = lru
+
+Sizes are measured as the pickled length of each stored value.
+"""
+import pickle
+import threading
+from collections import OrderedDict
+
+from beaker.container import AbstractDictionaryNSManager
+from beaker.util import SyncDict
+
+
+def _sizeof(value):
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        # unpicklable values are only limited by max_items
+        return 0
+
+
+class LRUDict(object):
+    """ A thread-safe mapping holding at most ``max_items`` entries and
+    ``max_bytes`` bytes, evicting the least recently used entry first.
+    Either limit may be ``None``."""
+    def __init__(self, max_items=None, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                value, size = self._data[key]
+            except KeyError:
+                self.stats['misses'] += 1
+                raise
+            self._hit(key)
+            self.stats['hits'] += 1
+            return value
+
+    def __setitem__(self, key, value):
+        size = _sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                # would evict everything else and still not fit
+                self.stats['evictions'] += 1
+                return
+            # make room first, so the new entry is never the victim
+            while self._data and self._full(size):
+                self._remove(self._victim())
+                self.stats['evictions'] += 1
+            self._add(key, value, size)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def _full(self, size):
+        return ((self.max_items is not None and
+                 len(self._data) >= self.max_items) or
+                (self.max_bytes is not None and
+                 self.size + size > self.max_bytes))
+
+    def _add(self, key, value, size):
+        self._data[key] = (value, size)
+        self.size += size
+
+    def _remove(self, key):
+        value, size = self._data.pop(key)
+        self.size -= size
+
+    def _hit(self, key):
+        self._data[key] = self._data.pop(key)
+
+    def _victim(self):
+        return next(iter(self._data))
+
+
+class LFUDict(LRUDict):
+    """ Like :class:`LRUDict`, but evicts the least frequently used entry
+    first, and the least recently used one among entries used equally
+    often."""
+    def __init__(self, max_items=None, max_bytes=None):
+        LRUDict.__init__(self, max_items, max_bytes)
+        self._counts = {}
+        # use count -> keys with that count, oldest first
+        self._buckets = {}
+        self._min_count = 0
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._counts.clear()
+            self._buckets.clear()
+            self.size = 0
+
+    def _add(self, key, value, size):
+        LRUDict._add(self, key, value, size)
+        self._counts[key] = 1
+        self._buckets.setdefault(1, OrderedDict())[key] = None
+        self._min_count = 1
+
+    def _remove(self, key):
+        LRUDict._remove(self, key)
+        self._unlink(key, self._counts.pop(key))
+
+    def _unlink(self, key, count):
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+            if self._min_count == count:
+                self._min_count = count + 1
+
+    def _hit(self, key):
+        count = self._counts[key]
+        self._unlink(key, count)
+        self._counts[key] = count + 1
+        self._buckets.setdefault(count + 1, OrderedDict())[key] = None
+
+    def _victim(self):
+        if self._min_count not in self._buckets:
+            self._min_count = min(self._buckets)
+        return next(iter(self._buckets[self._min_count]))
+
+
+_policies = {'lru': LRUDict, 'lfu': LFUDict}
+
+
+def _limit(value):
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+class BoundedMemoryNamespaceManager(AbstractDictionaryNSManager):
+    """ A Beaker namespace manager storing each namespace in an
+    :class:`LRUDict` or :class:`LFUDict` shared by the whole process.
+
+    The limits of a namespace are fixed by the first manager created for
+    it."""
+    namespaces = SyncDict()
+
+    def __init__(self, namespace, max_items=None, max_bytes=None,
+                 eviction='lru', **kwargs):
+        AbstractDictionaryNSManager.__init__(self, namespace)
+        try:
+            policy = _policies[eviction]
+        except KeyError:
+            raise ValueError('Unknown eviction policy %r' % (eviction,))
+        max_items = _limit(max_items)
+        max_bytes = _limit(max_bytes)
+        self.dictionary = self.namespaces.get(
+            self.namespace, policy, max_items, max_bytes)
+
+
+def cache_stats():
+    """ Return a dictionary mapping the name of every ``bounded_memory``
+    namespace in this process to its ``hits``, ``misses`` and
+    ``evictions`` counters, item count (``items``) and size in bytes
+    (``bytes``)."""
+    result = {}
+    namespaces = BoundedMemoryNamespaceManager.namespaces
+    for name in list(namespaces.dict):
+        try:
+            dictionary = namespaces.dict[name]
+        except KeyError: # pragma: no cover
+            continue
+        stats = dict(dictionary.stats)
+        stats['items'] = len(dictionary)
+        stats['bytes'] = dictionary.size
+        result[name] = stats
+    return result
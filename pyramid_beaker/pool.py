@@ -0,0 +1,391 @@
+""" Connection pools shared by network session and cache backends.
+
+The ``pooled_redis`` and ``pooled_memcached`` backends defined here are
+Beaker's ``ext:redis`` and ``ext:memcached`` backends taking their
+connections from one pool per backend URL, shared by the sessions and
+every cache region of the process using that URL.  Pools are sized and
+health-checked according to the ``pyramid_beaker.pool_*`` settings, and
+start over without connections in a forked process.
+
+``pooled_redis`` pools are redis-py ``BlockingConnectionPool`` objects,
+pooling the sockets of one shared client (pipelines included);
+``pooled_memcached`` pools are :class:`ConnectionPool` objects holding
+client objects of the ``memcache_module``, each used by one thread at a
+time.
+"""
+import importlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from beaker.container import NamespaceManager
+from beaker.exceptions import InvalidCacheBackendError
+from beaker.exceptions import MissingCacheParameter
+from beaker.ext.memcached import MemcachedNamespaceManager
+from beaker.ext.redisnm import RedisNamespaceManager
+from beaker.util import verify_directory
+from pyramid.exceptions import ConfigurationError
+
+
+class PoolTimeoutError(RuntimeError):
+    """ Raised when no connection of a pool became available within its
+    ``timeout``."""
+
+
+class ConnectionPool(object):
+    """ A thread-safe pool of at most ``size`` connections opened by
+    calling ``connect``.
+
+    ``timeout`` is the number of seconds :meth:`acquire` waits for a
+    connection when all of them are in use (forever if ``None``).
+    Connections idle for more than ``health_check_interval`` seconds are
+    passed to ``check``, which returns a false value or raises if the
+    connection is unusable; ``close`` is called with connections which are
+    discarded.  Exceptions of the ``errors`` classes raised while a
+    connection of :meth:`connection` is in use discard it.
+
+    ``stats`` counts the connections ``created``, ``reused`` and
+    ``discarded``, the health ``checks`` and ``failed_checks``, the
+    acquisitions which ``waited`` or hit the ``timeouts`` and the
+    ``forks`` noticed."""
+    def __init__(self, connect, size=10, timeout=None, check=None,
+                 health_check_interval=30, close=None, errors=(OSError,)):
+        if int(size) < 1:
+            raise ValueError('Connection pool size must be at least 1')
+        self.connect = connect
+        self.size = int(size)
+        self.timeout = timeout
+        self.check = check
+        self.health_check_interval = health_check_interval
+        self.close = close
+        self.errors = errors
+        self.stats = {'created': 0, 'reused': 0, 'discarded': 0,
+                      'checks': 0, 'failed_checks': 0, 'waited': 0,
+                      'timeouts': 0, 'forks': 0}
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        # (connection, returned at), the most recently returned last
+        self._idle = []
+        # connections open or being opened
+        self._open = 0
+
+    def _forked(self):
+        if self.pid != os.getpid():
+            # the parent's connections are left to the parent
+            self._reset()
+            self.stats['forks'] += 1
+
+    def acquire(self):
+        """ Return a connection, which must be given back with
+        :meth:`release`."""
+        self._forked()
+        cond = self._cond
+        deadline = None
+        cond.acquire()
+        try:
+            while not self._idle and self._open >= self.size:
+                if deadline is None:
+                    self.stats['waited'] += 1
+                    if self.timeout is not None:
+                        deadline = time.time() + self.timeout
+                if deadline is None:
+                    cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise PoolTimeoutError(
+                        'No connection available within %s seconds'
+                        % self.timeout)
+                cond.wait(remaining)
+            if self._idle:
+                conn, returned_at = self._idle.pop()
+            else:
+                conn = None
+                self._open += 1
+        finally:
+            cond.release()
+        if conn is not None and self._healthy(conn, returned_at):
+            self.stats['reused'] += 1
+            return conn
+        try:
+            conn = self.connect()
+        except Exception:
+            self._closed()
+            raise
+        self.stats['created'] += 1
+        return conn
+
+    def _healthy(self, conn, returned_at):
+        if (self.check is None or self.health_check_interval is None or
+            time.time() - returned_at < self.health_check_interval):
+            return True
+        self.stats['checks'] += 1
+        try:
+            healthy = self.check(conn)
+        except Exception:
+            healthy = False
+        if not healthy:
+            self.stats['failed_checks'] += 1
+            self._close(conn)
+        return healthy
+
+    def release(self, conn, discard=False):
+        """ Give back ``conn``, closing it if ``discard`` is true."""
+        if self.pid != os.getpid():
+            # a connection acquired before the process was forked
+            return
+        if discard:
+            self._close(conn)
+            self._closed()
+            return
+        cond = self._cond
+        cond.acquire()
+        try:
+            self._idle.append((conn, time.time()))
+            cond.notify()
+        finally:
+            cond.release()
+
+    @contextmanager
+    def connection(self):
+        """ Return a context manager acquiring a connection and releasing
+        it on exit, discarding it after an exception of ``errors``."""
+        conn = self.acquire()
+        try:
+            yield conn
+        except self.errors:
+            self.release(conn, discard=True)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        self.release(conn)
+
+    def _close(self, conn):
+        self.stats['discarded'] += 1
+        if self.close is not None:
+            try:
+                self.close(conn)
+            except Exception:
+                pass
+
+    def _closed(self):
+        cond = self._cond
+        cond.acquire()
+        try:
+            self._open -= 1
+            cond.notify()
+        finally:
+            cond.release()
+
+    def dispose(self):
+        """ Close the idle connections."""
+        self._forked()
+        cond = self._cond
+        cond.acquire()
+        try:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            cond.notify_all()
+        finally:
+            cond.release()
+        for conn, returned_at in idle:
+            self._close(conn)
+
+    def __len__(self):
+        return self._open
+
+
+class PooledClient(object):
+    """ A client calling each method on a client acquired from ``pool``
+    for the duration of the call."""
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __getattr__(self, name):
+        pool = self.pool
+        def call(*args, **kw):
+            with pool.connection() as client:
+                return getattr(client, name)(*args, **kw)
+        call.__name__ = name
+        return call
+
+
+# options of new pools; see configure_pools()
+_pool_options = {'size': 10, 'timeout': None, 'connect_timeout': None,
+                 'socket_timeout': None, 'health_check_interval': 30}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def configure_pools(**options):
+    """ Set the ``size``, ``timeout``, ``connect_timeout``,
+    ``socket_timeout`` and ``health_check_interval`` of the pools created
+    from now on."""
+    unknown = set(options) - set(_pool_options)
+    if unknown:
+        raise TypeError('Unknown pool options: %s' % ', '.join(
+            sorted(unknown)))
+    _pool_options.update(options)
+
+
+def get_pool(key, create):
+    """ Return the pool of ``key``, e.g. a backend URL, created with
+    ``create(options)`` on first use in the process."""
+    _pools_lock.acquire()
+    try:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = create(dict(_pool_options))
+        return pool
+    finally:
+        _pools_lock.release()
+
+
+def pools():
+    """ Return a dictionary mapping the keys of the pools of the process
+    to them."""
+    return dict(_pools)
+
+
+def dispose_pools():
+    """ Close the idle connections of every pool and forget the pools."""
+    _pools_lock.acquire()
+    try:
+        disposed = list(_pools.values())
+        _pools.clear()
+    finally:
+        _pools_lock.release()
+    for pool in disposed:
+        if isinstance(pool, ConnectionPool):
+            pool.dispose()
+        else:
+            pool.disconnect()
+
+
+def _after_fork():
+    # the pools' locks may have been held by other threads of the parent
+    global _pools_lock
+    _pools_lock = threading.Lock()
+    for pool in _pools.values():
+        if isinstance(pool, ConnectionPool):
+            pool._forked()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+_int_settings = ('size',)
+_float_settings = ('timeout', 'connect_timeout', 'socket_timeout',
+                   'health_check_interval')
+
+
+def pool_options_from_settings(settings):
+    """ Return the pool options set by the ``pyramid_beaker.pool_*``
+    settings, for :func:`configure_pools`."""
+    options = {}
+    for name in _int_settings + _float_settings:
+        value = settings.get('pyramid_beaker.pool_' + name)
+        if value is None or value == '':
+            continue
+        try:
+            options[name] = (int if name in _int_settings else float)(value)
+        except ValueError:
+            raise ConfigurationError(
+                'Invalid pyramid_beaker.pool_%s: %r' % (name, value))
+    return options
+
+
+def _redis_pool(url, options):
+    import redis
+    return redis.BlockingConnectionPool.from_url(
+        url, max_connections=options['size'], timeout=options['timeout'],
+        socket_connect_timeout=options['connect_timeout'],
+        socket_timeout=options['socket_timeout'],
+        health_check_interval=int(options['health_check_interval'] or 0))
+
+
+def redis_client(url):
+    """ Return a redis client using the shared pool of ``url``."""
+    try:
+        import redis
+    except ImportError:
+        raise RuntimeError('redis is not available')
+    pool = get_pool(('redis', url), lambda options: _redis_pool(url, options))
+    return redis.StrictRedis(connection_pool=pool)
+
+
+def _memcached_alive(client):
+    get_stats = getattr(client, 'get_stats', None)
+    return get_stats is None or bool(get_stats())
+
+
+def _memcached_close(client):
+    disconnect = getattr(client, 'disconnect_all', None)
+    if disconnect is not None:
+        disconnect()
+
+
+# client libraries tried, in order, when memcache_module is auto
+_memcache_modules = ('cmemcache', 'memcache', 'bmemcached')
+
+
+def _memcache_module(name):
+    """ Import the client library named by ``memcache_module``, as
+    Beaker's ``ext:memcached`` backend does."""
+    if name != 'auto':
+        return importlib.import_module(name)
+    for name in _memcache_modules:
+        try:
+            return importlib.import_module(name)
+        except ImportError:
+            pass
+    raise InvalidCacheBackendError(
+        'Memcached cache backend requires one memcache to be installed.')
+
+
+def memcached_client(url, memcache_module='auto'):
+    """ Return a memcached client using the shared pool of ``url``."""
+    module = _memcache_module(memcache_module)
+    servers = url.split(';')
+    def create(options):
+        return ConnectionPool(
+            lambda: module.Client(servers), size=options['size'],
+            timeout=options['timeout'], check=_memcached_alive,
+            health_check_interval=options['health_check_interval'],
+            close=_memcached_close)
+    return PooledClient(get_pool(('memcached', memcache_module, url),
+                                 create))
+
+
+class PooledRedisNamespaceManager(RedisNamespaceManager):
+    """ Beaker's ``ext:redis`` namespace using the shared pool of its
+    ``url``."""
+    def __init__(self, namespace, url, timeout=None, **kw):
+        if isinstance(url, str):
+            url = redis_client(url)
+        RedisNamespaceManager.__init__(self, namespace, url, timeout, **kw)
+
+
+class PooledMemcachedNamespaceManager(MemcachedNamespaceManager):
+    """ Beaker's ``ext:memcached`` namespace using the shared pool of its
+    ``url``."""
+    def __init__(self, namespace, url, memcache_module='auto',
+                 data_dir=None, lock_dir=None, **kw):
+        NamespaceManager.__init__(self, namespace)
+        if not url:
+            raise MissingCacheParameter("url is required")
+        self.lock_dir = None
+        if lock_dir:
+            self.lock_dir = lock_dir
+        elif data_dir:
+            self.lock_dir = data_dir + "/container_mcd_lock"
+        if self.lock_dir:
+            verify_directory(self.lock_dir)
+        self.mc = memcached_client(url, memcache_module)
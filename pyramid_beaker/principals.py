@@ -0,0 +1,212 @@
+""" An index from principals to the ids of their sessions.
+
+When the session factory is configured with a ``principal_key``, every
+session holding a value under that key is recorded in an index namespace
+of the session backend, named after a digest of the principal.  The index
+is written by a background worker, and only when a session's principal
+changes or its entry is due for a refresh, so the response path never
+waits for it.  :meth:`PrincipalIndex.invalidate` deletes every session of
+a principal without scanning the backend.
+
+A request which loaded a session before it was invalidated may still save
+it afterwards.  Invalidating the sessions of a principal therefore also
+increments its generation, kept in the index namespace: sessions record
+the generation of their principal when they are indexed, and a session
+found to carry an older one is deleted when it is loaded.  Loading a
+session holding a principal thus reads the index of the principal too.
+
+Entries follow the sessions' expiry: backends such as ``ext:memcached``
+expire the index like the sessions themselves, each session refreshes its
+entry once half of the session ``timeout`` has passed, and entries whose
+session no longer exists are dropped whenever the index is written.
+"""
+import hashlib
+import time
+
+from beaker.container import OpenResourceNamespaceManager
+from beaker.session import Session
+
+# the principal a session is indexed under, when, and the generation of the
+# principal's sessions then, stored in the session
+INDEX_KEY = '_principal'
+
+# prefix of the names of index namespaces
+NAMESPACE_PREFIX = 'pyramid_beaker.principal.'
+
+# entries younger than this are never pruned, as their session may not
+# have been written yet
+_PRUNE_GRACE = 60
+
+
+def _entry_generation(entry):
+    # entries written before generations were recorded hold two items
+    return entry[2] if len(entry) > 2 else 0
+
+
+def _digest(principal):
+    if not isinstance(principal, bytes):
+        principal = ('%s' % (principal,)).encode('utf-8')
+    return hashlib.sha1(principal).hexdigest()
+
+
+class PrincipalIndex(object):
+    """ The index of the sessions created with the Beaker session
+    ``options``, written by the ``queue``, a
+    :class:`pyramid_beaker.writebehind.WriteBehindQueue`.
+
+    ``stats`` counts the ``added``, ``removed`` and ``pruned`` entries, the
+    ``invalidated`` sessions and the sessions ``rejected`` on load because
+    they were invalidated."""
+    def __init__(self, options, queue):
+        options = dict(options)
+        options.pop('auto', None)
+        template = Session({}, use_cookies=False, **options)
+        self.namespace_class = template.namespace_class
+        self.namespace_args = template.namespace_args
+        self.data_dir = template.data_dir
+        self.timeout = template.timeout
+        self.queue = queue
+        self.stats = {'added': 0, 'removed': 0, 'pruned': 0,
+                      'invalidated': 0, 'rejected': 0}
+
+    def _namespace(self, name):
+        return self.namespace_class(name, data_dir=self.data_dir,
+                                    digest_filenames=False,
+                                    **self.namespace_args)
+
+    def _index(self, principal):
+        return self._namespace(NAMESPACE_PREFIX + _digest(principal))
+
+    def needs_refresh(self, indexed_at, now=None):
+        """ Return whether an entry written at ``indexed_at`` should be
+        written again to keep it from expiring before its session."""
+        if not self.timeout:
+            return False
+        return (now or time.time()) - indexed_at > self.timeout / 2
+
+    def add(self, principal, session_id):
+        """ Queue recording ``session_id`` as a session of ``principal``."""
+        self.queue.submit(principal, lambda: self._update(
+            principal, add=session_id))
+
+    def discard(self, principal, session_id):
+        """ Queue removing ``session_id`` from the sessions of
+        ``principal``."""
+        self.queue.submit(principal, lambda: self._update(
+            principal, discard=session_id))
+
+    def _get(self, principal, key, default):
+        namespace = self._index(principal)
+        namespace.acquire_read_lock()
+        try:
+            try:
+                return namespace[key]
+            except KeyError:
+                return default
+        finally:
+            namespace.release_read_lock()
+
+    def session_ids(self, principal):
+        """ Return the ids of the sessions indexed for ``principal``."""
+        return sorted(self._get(principal, 'sessions', ()))
+
+    def generation(self, principal):
+        """ Return the number of times the sessions of ``principal`` were
+        invalidated."""
+        return self._get(principal, 'generation', 0)
+
+    def entry(self, principal, previous=None):
+        """ Return the value a session of ``principal`` keeps under
+        ``INDEX_KEY``, with the current generation of ``principal``.  The
+        generation of ``previous``, the entry the session held, is kept if
+        it was indexed under the same principal, so that a session saved
+        again after being invalidated stays invalid."""
+        if previous is not None and previous[0] == principal:
+            generation = _entry_generation(previous)
+        else:
+            generation = self.generation(principal)
+        return (principal, time.time(), generation)
+
+    def invalidated(self, entry):
+        """ Return whether a session whose ``INDEX_KEY`` holds ``entry``
+        was invalidated since it was indexed."""
+        if _entry_generation(entry) < self.generation(entry[0]):
+            self.stats['rejected'] += 1
+            return True
+        return False
+
+    def invalidate(self, principal):
+        """ Delete every session of ``principal``, empty its index and
+        increment its generation, and return the number of sessions
+        deleted."""
+        count = 0
+        for session_id in self._update(principal, clear=True):
+            namespace = self._namespace(session_id)
+            # no replace=True: file namespaces must be loaded to find the
+            # session
+            namespace.acquire_write_lock()
+            try:
+                try:
+                    del namespace['session']
+                except KeyError:
+                    continue
+                count += 1
+            finally:
+                namespace.release_write_lock()
+        self.stats['invalidated'] += count
+        return count
+
+    def _update(self, principal, add=None, discard=None, clear=False):
+        """ Apply a change to the index of ``principal`` under its lock,
+        pruning the entries of sessions which no longer exist, and return
+        the session ids indexed before the change."""
+        namespace = self._index(principal)
+        lock = None
+        if not isinstance(namespace, OpenResourceNamespaceManager):
+            lock = namespace.get_creation_lock('sessions')
+            lock.acquire()
+        namespace.acquire_write_lock()
+        try:
+            try:
+                sessions = dict(namespace['sessions'])
+            except KeyError:
+                sessions = {}
+            before = list(sessions)
+            if clear:
+                sessions = {}
+                try:
+                    generation = namespace['generation']
+                except KeyError:
+                    generation = 0
+                namespace['generation'] = generation + 1
+            if discard is not None and sessions.pop(discard, None):
+                self.stats['removed'] += 1
+            if add is not None:
+                self._prune(sessions, add)
+                sessions[add] = time.time()
+                self.stats['added'] += 1
+            if sessions:
+                namespace['sessions'] = sessions
+            elif before:
+                del namespace['sessions']
+            return before
+        finally:
+            namespace.release_write_lock()
+            if lock is not None:
+                lock.release()
+
+    def _prune(self, sessions, keep):
+        cutoff = time.time() - _PRUNE_GRACE
+        for session_id, indexed_at in list(sessions.items()):
+            if (session_id != keep and indexed_at < cutoff and
+                not self._exists(session_id)):
+                del sessions[session_id]
+                self.stats['pruned'] += 1
+
+    def _exists(self, session_id):
+        namespace = self._namespace(session_id)
+        namespace.acquire_read_lock()
+        try:
+            return namespace.has_key('session')
+        finally:
+            namespace.release_read_lock()
@@ -0,0 +1,716 @@
+""" Cache regions with pyramid_beaker's extensions.
+
+Regions are configured as usual with
+:func:`pyramid_beaker.set_cache_regions_from_settings`.  The caches
+returned by :func:`get_cache` and used by the :func:`cache_region`
+decorator here honour region options which Beaker itself ignores:
+
+``stale_ttl``
+  Seconds an expired value may still be served while a single caller
+  regenerates it.
+
+``singleflight``
+  Whether threads of a process missing the same key at once share a single
+  call of its creation function (``false`` by default).
+
+``singleflight_timeout``
+  Seconds a thread waits for another thread's creation function before
+  calling it itself (no limit by default).
+
+They also offer bulk operations (:meth:`RegionCache.get_multi` and
+friends), which use a single round trip on the ``ext:memcached`` and
+``ext:redis`` backends, and tagged values, which :func:`invalidate_tags`
+makes stale in every region at once.
+"""
+import pickle
+import time
+import uuid
+from functools import wraps
+from hashlib import sha1
+
+from beaker import cache
+from beaker import util
+from beaker.container import Value
+from beaker.exceptions import BeakerException
+from beaker.ext.memcached import MemcachedNamespaceManager
+from beaker.ext.redisnm import RedisNamespaceManager
+from pyramid.exceptions import ConfigurationError
+from pyramid.threadlocal import get_current_request
+
+from pyramid_beaker import instrumentation
+from pyramid_beaker.singleflight import SingleFlight
+
+
+class StaleValue(Value):
+    """ A Beaker :class:`beaker.container.Value` which keeps its value
+    ``stale_ttl`` seconds past its expiry.
+
+    While a stale value is regenerated by the caller holding the
+    namespace's creation lock, other callers are handed the stale value
+    instead of waiting.  The creation lock is the backend's own, so the
+    election spans processes for backends whose locks do (``file`` and
+    ``dbm`` using ``lock_dir``, ``ext:redis``, ``ext:mongodb``).  Values
+    older than ``expire + stale_ttl`` are treated as missing, and all
+    callers wait for the new value."""
+    __slots__ = ('stale_ttl',)
+
+    def __init__(self, key, namespace, createfunc=None, expiretime=None,
+                 starttime=None, stale_ttl=0):
+        Value.__init__(self, key, namespace, createfunc, expiretime,
+                       starttime)
+        self.stale_ttl = stale_ttl
+
+    def _get_value(self):
+        stored, expired, value = Value._get_value(self)
+        if (expired is not None and
+            time.time() >= stored + expired + self.stale_ttl):
+            raise KeyError(self.key)
+        return stored, expired, value
+
+    def set_value(self, value, storedtime=None):
+        self.namespace.acquire_write_lock()
+        try:
+            if storedtime is None:
+                storedtime = time.time()
+            expiretime = self.expire_argument
+            if expiretime is not None:
+                # keep the value in the backend through the grace period
+                expiretime += self.stale_ttl
+            self.namespace.set_value(
+                self.key, (storedtime, self.expire_argument, value),
+                expiretime=expiretime)
+        finally:
+            self.namespace.release_write_lock()
+
+
+class CoalescingValue(StaleValue):
+    """ A :class:`StaleValue` whose creation is coalesced with concurrent
+    creations of the same ``flight_key`` in this process by ``flights``, a
+    :class:`pyramid_beaker.singleflight.SingleFlight`.
+
+    Callers finding no value join the flight before taking the
+    namespace's creation lock, so that only the leader waits for it;
+    followers giving up after ``flight_timeout`` call the creation function
+    and store its result without the lock.  Callers finding a stale value
+    bypass the flight, as they need not wait."""
+    __slots__ = ('flights', 'flight_key', 'flight_timeout')
+
+    def __init__(self, key, namespace, createfunc=None, expiretime=None,
+                 starttime=None, stale_ttl=0, flights=None, flight_key=None,
+                 flight_timeout=None):
+        StaleValue.__init__(self, key, namespace, createfunc, expiretime,
+                            starttime, stale_ttl)
+        self.flights = flights
+        self.flight_key = flight_key
+        self.flight_timeout = flight_timeout
+
+    def get_value(self):
+        self.namespace.acquire_read_lock()
+        try:
+            has_value = self.has_value()
+            if has_value:
+                try:
+                    stored, expired, value = self._get_value()
+                    if not self._is_expired(stored, expired):
+                        return value
+                except KeyError:
+                    has_value = False
+            if not self.createfunc:
+                raise KeyError(self.key)
+        finally:
+            self.namespace.release_read_lock()
+        if has_value:
+            return StaleValue.get_value(self)
+        value, leader = self.flights.do(
+            self.flight_key, lambda: StaleValue.get_value(self),
+            self.flight_timeout, fallback=self._create)
+        return value
+
+    def _create(self):
+        value = self.createfunc()
+        self.set_value(value)
+        return value
+
+
+# Creations coalesced by regions with the ``singleflight`` option.
+flights = SingleFlight()
+
+
+class RegionCache(cache.Cache):
+    """ A Beaker :class:`beaker.cache.Cache` honouring pyramid_beaker's
+    region options."""
+    region = None
+
+    def __init__(self, namespace, stale_ttl=None, singleflight=False,
+                 singleflight_timeout=None, **kw):
+        cache.Cache.__init__(self, namespace, **kw)
+        self.stale_ttl = int(stale_ttl or 0)
+        self.singleflight = singleflight
+        self.singleflight_timeout = singleflight_timeout
+
+    def _emit(self, name, duration, **tags):
+        instrumentation.emit(name, duration, region=self.region,
+                             namespace=self.namespace_name, **tags)
+
+    def get(self, key, **kw):
+        """ Return the value of ``key``, calling ``createfunc`` if it is
+        missing, expired or stale.  Values created with ``tags`` are
+        tagged like those stored by :meth:`put`."""
+        tags = kw.pop('tags', None)
+        createfunc = kw.get('createfunc')
+        if tags and createfunc is not None:
+            kw['createfunc'] = lambda: _tagged(tags, createfunc)
+        value = self._get(key, **kw)
+        if isinstance(value, TaggedValue):
+            if value.current(tag_generations(value.generations)):
+                return value.value
+            self.remove_value(key)
+            if createfunc is None:
+                raise KeyError(key)
+            value = self._get(key, **kw)
+            if isinstance(value, TaggedValue):
+                value = value.value
+        return value
+    get_value = get
+
+    def _get(self, key, **kw):
+        if not instrumentation.active():
+            return cache.Cache.get(self, key, **kw)
+        createfunc = kw.get('createfunc')
+        regenerated = []
+        if createfunc is not None:
+            def regenerate():
+                start = time.time()
+                value = createfunc()
+                self._emit('cache.regenerate', time.time() - start)
+                regenerated.append(True)
+                return value
+            kw['createfunc'] = regenerate
+        start = time.time()
+        try:
+            value = cache.Cache.get(self, key, **kw)
+        except KeyError:
+            self._emit('cache.miss', time.time() - start)
+            raise
+        self._emit('cache.miss' if regenerated else 'cache.hit',
+                   time.time() - start)
+        return value
+
+    def put(self, key, value, **kw):
+        """ Store ``value`` under ``key``.  If ``tags`` are given, the value
+        becomes stale once any of them is passed to
+        :func:`invalidate_tags`."""
+        tags = kw.pop('tags', None)
+        if tags:
+            value = _tagged(tags, lambda: value)
+        if not instrumentation.active():
+            return cache.Cache.put(self, key, value, **kw)
+        start = time.time()
+        cache.Cache.put(self, key, value, **kw)
+        self._emit('cache.set', time.time() - start)
+    set_value = put
+
+    def _get_value(self, key, **kw):
+        if not (self.stale_ttl or self.singleflight) or 'type' in kw:
+            return cache.Cache._get_value(self, key, **kw)
+        kw.setdefault('expiretime', self.expiretime)
+        kw.setdefault('starttime', self.starttime)
+        if self.singleflight:
+            return CoalescingValue(
+                self._key(key), self.namespace, stale_ttl=self.stale_ttl,
+                flights=flights,
+                flight_key=(self.region, self.namespace_name, key),
+                flight_timeout=self.singleflight_timeout, **kw)
+        return StaleValue(self._key(key), self.namespace,
+                          stale_ttl=self.stale_ttl, **kw)
+
+    def _key(self, key):
+        if isinstance(key, str):
+            key = key.encode('ascii', 'backslashreplace')
+        return key
+
+    def _backend_expire(self):
+        if self.expiretime is None:
+            return None
+        return self.expiretime + self.stale_ttl
+
+    def _current(self, entry):
+        try:
+            stored, expired, value = entry
+        except (TypeError, ValueError):
+            return _marker
+        if ((self.starttime is not None and stored < self.starttime) or
+            (expired is not None and time.time() >= stored + expired)):
+            return _marker
+        return value
+
+    def get_multi(self, keys):
+        """ Return a dictionary mapping those of ``keys`` which have a
+        current value to it.  Expired and missing keys are left out."""
+        keys = list(keys)
+        if instrumentation.active():
+            start = time.time()
+            result = self._get_multi(keys)
+            self._emit('cache.get_multi', time.time() - start,
+                       hits=len(result), misses=len(keys) - len(result))
+            return result
+        return self._get_multi(keys)
+
+    def _get_multi(self, keys):
+        multi = _multi_backend(self.namespace)
+        result = {}
+        if multi is None:
+            for key in keys:
+                try:
+                    result[key] = self._get_value(key).get_value()
+                except KeyError:
+                    pass
+        else:
+            entries = multi.get([self._key(key) for key in keys])
+            for key in keys:
+                value = self._current(entries.get(self._key(key)))
+                if value is not _marker:
+                    result[key] = value
+        tagged = [(key, value) for key, value in result.items()
+                  if isinstance(value, TaggedValue)]
+        if tagged:
+            tags = set()
+            for key, value in tagged:
+                tags.update(value.generations)
+            generations = tag_generations(tags)
+            for key, value in tagged:
+                if value.current(generations):
+                    result[key] = value.value
+                else:
+                    del result[key]
+        return result
+
+    def set_multi(self, mapping, tags=None):
+        """ Store every key and value of the dictionary ``mapping``, tagged
+        with ``tags`` if given."""
+        if tags:
+            generations = tag_generations(tags)
+            mapping = dict((key, TaggedValue(generations, value))
+                           for key, value in mapping.items())
+        if instrumentation.active():
+            start = time.time()
+            self._set_multi(mapping)
+            self._emit('cache.set_multi', time.time() - start,
+                       keys=len(mapping))
+        else:
+            self._set_multi(mapping)
+
+    def _set_multi(self, mapping):
+        multi = _multi_backend(self.namespace)
+        if multi is None:
+            for key, value in mapping.items():
+                cache.Cache.put(self, key, value)
+            return
+        now = time.time()
+        multi.set(
+            dict((self._key(key), (now, self.expiretime, value))
+                 for key, value in mapping.items()),
+            self._backend_expire())
+
+    def delete_multi(self, keys):
+        """ Remove ``keys`` from the cache."""
+        multi = _multi_backend(self.namespace)
+        if multi is None:
+            for key in keys:
+                self.remove_value(key)
+            return
+        multi.delete([self._key(key) for key in keys])
+
+
+_marker = object()
+
+
+class TaggedValue(object):
+    """ A cached ``value`` with the ``generations`` its tags had when it
+    was created."""
+    def __init__(self, generations, value):
+        self.generations = generations
+        self.value = value
+
+    def current(self, generations):
+        """ Return whether none of the value's tags has been invalidated
+        since, given their current ``generations``."""
+        for tag, generation in self.generations.items():
+            if generations.get(tag) != generation:
+                return False
+        return True
+
+
+def _tagged(tags, createfunc):
+    # generations are read first, so that an invalidation racing with
+    # createfunc leaves the new value stale
+    generations = tag_generations(tags)
+    return TaggedValue(generations, createfunc())
+
+
+# The region holding tag generations, set by the ``cache.tag_region``
+# setting.  Tags cannot be used without one.
+tag_region = None
+
+_TAG_NAMESPACE = 'pyramid_beaker.tags'
+_GENERATIONS_ENVIRON_KEY = 'pyramid_beaker.tag_generations'
+
+
+def set_tag_region(region):
+    """ Keep tag generations in the cache region named ``region``, which
+    should be shared by every process.  Generations are stored without
+    expiry."""
+    global tag_region
+    tag_region = region
+
+
+def _generation_cache():
+    if tag_region is None:
+        # generations kept in each process would let invalidations miss
+        # every other process
+        raise ConfigurationError(
+            'Tagged cache values require the cache.tag_region setting')
+    return get_cache(tag_region, _TAG_NAMESPACE)
+
+
+def _request_generations():
+    request = get_current_request()
+    if request is None:
+        return None
+    return request.environ.setdefault(_GENERATIONS_ENVIRON_KEY, {})
+
+
+def _new_generation():
+    return uuid.uuid4().hex
+
+
+def tag_generations(tags):
+    """ Return a dictionary mapping each of ``tags`` to its current
+    generation.  Generations missing from the backend are fetched with one
+    bulk read, and remembered until the end of the current request."""
+    memo = _request_generations()
+    result = {}
+    missing = []
+    for tag in tags:
+        if memo is not None and tag in memo:
+            result[tag] = memo[tag]
+        else:
+            missing.append(tag)
+    if missing:
+        generations = _generation_cache()
+        found = generations.get_multi(missing)
+        for tag in missing:
+            if tag not in found:
+                # never seen or evicted; values tagged with an older
+                # generation become stale, which is safe
+                found[tag] = _new_generation()
+                generations.put(tag, found[tag], expiretime=None)
+        result.update(found)
+        if memo is not None:
+            memo.update(found)
+    return result
+
+
+def invalidate_tags(*tags):
+    """ Make every value tagged with any of ``tags`` stale, in all
+    regions, by giving the tags new generations."""
+    generations = _generation_cache()
+    memo = _request_generations()
+    for tag in tags:
+        generation = _new_generation()
+        generations.put(tag, generation, expiretime=None)
+        if memo is not None:
+            memo[tag] = generation
+
+
+class MemcachedMulti(object):
+    """ Bulk operations for Beaker's ``ext:memcached`` namespaces."""
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.client = namespace.mc
+
+    def _keys(self, keys):
+        return dict((self.namespace._format_key(key), key) for key in keys)
+
+    def get(self, keys):
+        keys = self._keys(keys)
+        found = self.client.get_multi(list(keys))
+        return dict((keys[key], value) for key, value in found.items()
+                    if value is not None)
+
+    def set(self, mapping, expiretime):
+        mapping = dict((self.namespace._format_key(key), value)
+                       for key, value in mapping.items())
+        self.client.set_multi(mapping, time=expiretime or 0)
+
+    def delete(self, keys):
+        self.client.delete_multi(list(self._keys(keys)))
+
+
+class RedisMulti(object):
+    """ Bulk operations for Beaker's ``ext:redis`` namespaces."""
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.client = namespace.client
+
+    def get(self, keys):
+        values = self.client.mget(
+            [self.namespace._format_key(key) for key in keys])
+        return dict((key, pickle.loads(value))
+                    for key, value in zip(keys, values) if value is not None)
+
+    def set(self, mapping, expiretime):
+        if expiretime is None:
+            expiretime = self.namespace.timeout
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in mapping.items():
+            key = self.namespace._format_key(key)
+            value = pickle.dumps(value)
+            if expiretime is not None:
+                pipe.setex(key, int(expiretime), value)
+            else:
+                pipe.set(key, value)
+        pipe.execute()
+
+    def delete(self, keys):
+        if keys:
+            self.client.delete(
+                *[self.namespace._format_key(key) for key in keys])
+
+
+# Namespace manager classes with native bulk operations.  Other backends
+# fall back to one operation per key.
+multi_backends = [
+    (MemcachedNamespaceManager, MemcachedMulti),
+    (RedisNamespaceManager, RedisMulti),
+    ]
+
+
+def _multi_backend(namespace):
+    for namespace_class, multi in multi_backends:
+        if isinstance(namespace, namespace_class):
+            return multi(namespace)
+    return None
+
+
+_caches = {}
+
+
+def _region_settings(region):
+    try:
+        return cache.cache_regions[region]
+    except KeyError:
+        raise BeakerException('Cache region not configured: %s' % region)
+
+
+def get_cache(region, namespace):
+    """ Return the :class:`RegionCache` for ``namespace`` in the cache
+    region named ``region``."""
+    settings = _region_settings(region)
+    key = namespace + str(settings)
+    try:
+        return _caches[key]
+    except KeyError:
+        _caches[key] = region_cache = RegionCache(namespace, **settings)
+        region_cache.region = region
+        return region_cache
+
+
+def _cache_key(deco_args, args, kwargs, namespace, key_length):
+    parts = list(deco_args) + list(args)
+    parts.extend('%s:%s' % item for item in sorted(kwargs.items()))
+    key = ' '.join(map(str, parts))
+    if len(key) + len(namespace) > int(key_length):
+        key = sha1(key.encode('utf-8')).hexdigest()
+    return key
+
+
+def cache_region(region, *deco_args, **options):
+    """ Cache the results of the decorated function in the cache region
+    named ``region``, like Beaker's own :func:`beaker.cache.cache_region`
+    (including ignoring a leading ``self`` or ``cls`` argument), but with
+    pyramid_beaker's region options applied.
+
+    ``deco_args`` are prepended to the function's arguments to form the
+    cache key.  The cache can be cleared with
+    :func:`beaker.cache.region_invalidate`.
+
+    ``tags``, a list of tags or a function returning one when called with
+    the decorated function's arguments, tags the cached results::
+
+        @cache_region('long_term', tags=lambda id: ['product:%s' % id])
+        def product_page(id):
+            ...
+    """
+    tags = options.pop('tags', None)
+    if options:
+        raise TypeError('Unexpected arguments: %s' % ', '.join(options))
+
+    def decorate(func):
+        namespace = util.func_namespace(func)
+        skip_self = util.has_self_arg(func)
+
+        @wraps(func)
+        def cached(*args, **kwargs):
+            settings = _region_settings(region)
+            if not settings.get('enabled', True):
+                return func(*args, **kwargs)
+            key = _cache_key(
+                deco_args, args[1:] if skip_self else args, kwargs,
+                namespace, settings.get('key_length',
+                                        util.DEFAULT_CACHE_KEY_LENGTH))
+
+            def go():
+                return func(*args, **kwargs)
+            value_tags = tags(*args, **kwargs) if callable(tags) else tags
+            return get_cache(region, namespace).get_value(
+                key, createfunc=go, tags=value_tags)
+        cached._arg_namespace = namespace
+        cached._arg_region = region
+        return cached
+    return decorate
+
+
+def cache_region_multi(region, *deco_args):
+    """ Cache the per-element results of a batch function in the cache
+    region named ``region``.
+
+    The decorated function is called with a list of elements (plus any
+    further arguments) and must return a dictionary mapping elements to
+    their results.  Each element is cached under its own key; on later
+    calls the function only receives the elements missing from the cache,
+    all of them fetched with a single :meth:`RegionCache.get_multi`::
+
+        @cache_region_multi('short_term', 'users')
+        def load_users(ids):
+            return dict((user.id, user) for user in query_users(ids))
+
+    Elements absent from the function's result are not cached."""
+    def decorate(func):
+        namespace = util.func_namespace(func)
+        skip_self = util.has_self_arg(func)
+
+        @wraps(func)
+        def cached(*args, **kwargs):
+            settings = _region_settings(region)
+            if skip_self:
+                head, (elements,), rest = args[:1], args[1:2], args[2:]
+            else:
+                head, (elements,), rest = (), args[:1], args[1:]
+            if not settings.get('enabled', True):
+                return func(*args, **kwargs)
+            key_length = settings.get('key_length',
+                                      util.DEFAULT_CACHE_KEY_LENGTH)
+            keys = dict(
+                (_cache_key(deco_args, (element,) + rest, kwargs,
+                            namespace, key_length), element)
+                for element in elements)
+            region_cache = get_cache(region, namespace)
+            found = region_cache.get_multi(keys)
+            result = dict((keys[key], value) for key, value in found.items())
+            missing = [element for element in elements
+                       if element not in result]
+            if missing:
+                loaded = func(*(head + (missing,) + rest), **kwargs)
+                region_cache.set_multi(dict(
+                    (key, loaded[element]) for key, element in keys.items()
+                    if element in loaded and element not in result))
+                result.update(loaded)
+            return result
+        cached._arg_namespace = namespace
+        cached._arg_region = region
+        return cached
+    return decorate
+
+
+class RequestCache(object):
+    """ A front-end to a :class:`RegionCache` which remembers the values
+    read or written through it, so that repeated reads of a key return the
+    same object without going back to the backend.
+
+    Writes and removals go to the region cache as well.  Instances are
+    created per request by :func:`region_cache` and discarded when the
+    request ends."""
+    def __init__(self, cache):
+        self.cache = cache
+        self.values = {}
+
+    def get(self, key, **kw):
+        try:
+            return self.values[key]
+        except KeyError:
+            value = self.values[key] = self.cache.get(key, **kw)
+            return value
+    get_value = get
+
+    def put(self, key, value, **kw):
+        self.cache.put(key, value, **kw)
+        self.values[key] = value
+    set_value = put
+
+    def remove_value(self, key, **kw):
+        self.values.pop(key, None)
+        self.cache.remove_value(key, **kw)
+    remove = remove_value
+
+    def get_multi(self, keys):
+        keys = list(keys)
+        result = dict((key, self.values[key]) for key in keys
+                      if key in self.values)
+        missing = [key for key in keys if key not in result]
+        if missing:
+            found = self.cache.get_multi(missing)
+            self.values.update(found)
+            result.update(found)
+        return result
+
+    def set_multi(self, mapping, tags=None):
+        self.cache.set_multi(mapping, tags)
+        self.values.update(mapping)
+
+    def delete_multi(self, keys):
+        keys = list(keys)
+        for key in keys:
+            self.values.pop(key, None)
+        self.cache.delete_multi(keys)
+
+    def clear(self):
+        self.values.clear()
+        self.cache.clear()
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __delitem__(self, key):
+        self.remove_value(key)
+
+    def __contains__(self, key):
+        return key in self.values or key in self.cache
+
+
+_ENVIRON_KEY = 'pyramid_beaker.region_caches'
+
+
+def _discard_request_caches(request):
+    request.environ.pop(_ENVIRON_KEY, None)
+
+
+def region_cache(request, region, namespace):
+    """ Return the :class:`RequestCache` for ``namespace`` in the cache
+    region named ``region`` local to ``request``.  Added to requests as
+    ``request.region_cache(region, namespace)`` by including
+    ``pyramid_beaker``."""
+    try:
+        caches = request.environ[_ENVIRON_KEY]
+    except KeyError:
+        caches = request.environ[_ENVIRON_KEY] = {}
+        request.add_finished_callback(_discard_request_caches)
+    try:
+        return caches[region, namespace]
+    except KeyError:
+        cache = caches[region, namespace] = RequestCache(
+            get_cache(region, namespace))
+        return cache
@@ -0,0 +1,280 @@
+""" Serializers for session payloads.
+
+Beaker accepts any object with ``loads`` and ``dumps`` methods as its
+``data_serializer``.  The serializers here are selected with the
+``session.serializer`` setting; see :func:`make_serializer`.
+"""
+import hashlib
+import json
+import pickle
+import time
+import uuid
+import zlib
+
+from beaker import cache
+from beaker.util import JsonSerializer as BeakerJsonSerializer
+from beaker.util import PickleSerializer as BeakerPickleSerializer
+
+from pyramid.exceptions import ConfigurationError
+from pyramid.path import DottedNameResolver
+
+
+class PickleSerializer(object):
+    """ Pickle session data using ``protocol`` (the highest protocol
+    available by default)."""
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        self.protocol = protocol
+
+    def dumps(self, data):
+        return pickle.dumps(data, self.protocol)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JSONSerializer(object):
+    """ Encode session data as compact, uncompressed UTF-8 JSON.  Only
+    JSON-compatible values (strings, numbers, lists, dicts, booleans and
+    ``None``) survive a round trip."""
+    def dumps(self, data):
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data.decode('utf-8'))
+
+
+class MsgpackSerializer(object):
+    """ Encode session data with `msgpack <https://msgpack.org/>`_, which
+    must be installed separately."""
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise ConfigurationError(
+                'The msgpack session serializer requires the msgpack '
+                'package to be installed')
+        self.msgpack = msgpack
+
+    def dumps(self, data):
+        return self.msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data, raw=False)
+
+
+class FallbackSerializer(object):
+    """ Serialize with ``serializer``; payloads it cannot decode, such as
+    sessions written before the serializer was changed, are decoded with
+    ``fallback``."""
+    def __init__(self, serializer, fallback):
+        self.serializer = serializer
+        self.fallback = fallback
+
+    def dumps(self, data):
+        return self.serializer.dumps(data)
+
+    def loads(self, data):
+        try:
+            value = self.serializer.loads(data)
+        except Exception:
+            return self.fallback.loads(data)
+        if not isinstance(value, dict):
+            return self.fallback.loads(data)
+        return value
+
+
+# Prefix marking compressed payloads; none of the supported formats can
+# start with a NUL byte when encoding a dictionary.
+_COMPRESSED = b'\x00Z'
+
+
+class CompressingSerializer(object):
+    """ zlib-compress payloads of ``serializer`` that are at least
+    ``threshold`` bytes long.  Uncompressed payloads, including those
+    written before compression was enabled, are read as they are."""
+    def __init__(self, serializer, threshold, level=6):
+        self.serializer = serializer
+        self.threshold = threshold
+        self.level = level
+
+    def dumps(self, data):
+        payload = self.serializer.dumps(data)
+        if len(payload) >= self.threshold:
+            compressed = _COMPRESSED + zlib.compress(payload, self.level)
+            if len(compressed) < len(payload):
+                return compressed
+        return payload
+
+    def loads(self, data):
+        if data[:len(_COMPRESSED)] == _COMPRESSED:
+            data = zlib.decompress(data[len(_COMPRESSED):])
+        return self.serializer.loads(data)
+
+
+# Key marking a value moved out of the session by SpillingSerializer, and
+# under which loaded sessions keep the references of their spilled values.
+_SPILLED = '_pyramid_beaker_spilled_'
+
+
+class SpillingSerializer(object):
+    """ Keep payloads of ``serializer`` below ``max_size`` bytes by moving
+    the largest session values to the Beaker cache region named
+    ``region``; they are replaced by a reference in the session and
+    fetched again when it is loaded.  Spilled values live as long as the
+    region's ``expire`` allows, so it should exceed the session lifetime.
+
+    References are derived from the session id, the key and the value, so
+    that a value spilled again unchanged is not rewritten until half of
+    the region's ``expire`` has passed.  Loaded sessions keep the
+    references of their spilled values under a private key, and the
+    entries of references which are no longer used are deleted when the
+    session is saved.
+
+    ``stats`` counts the values ``spilled`` (written to the region),
+    ``reused`` without a write, ``removed`` from the region and
+    ``missing`` when loaded."""
+    namespace = 'pyramid_beaker.spilled'
+
+    def __init__(self, serializer, region, max_size):
+        self.serializer = serializer
+        self.region = region
+        self.max_size = max_size
+        self.stats = {'spilled': 0, 'reused': 0, 'removed': 0, 'missing': 0}
+
+    def _cache(self):
+        return cache.Cache._get_cache(
+            self.namespace, cache.cache_regions[self.region])
+
+    def _reference(self, data, key, payload):
+        session_id = data.get('_id')
+        if session_id is None:
+            return uuid.uuid4().hex
+        digest = hashlib.sha1(('%s\0%s\0' % (session_id, key)).encode(
+            'utf-8'))
+        digest.update(payload)
+        return digest.hexdigest()
+
+    def _fresh(self, stored_at, now):
+        expire = cache.cache_regions[self.region].get('expire')
+        return not expire or now - stored_at < int(expire) / 2.0
+
+    def dumps(self, data):
+        data = dict(data)
+        loaded = data.pop(_SPILLED, None) or {}
+        payload = self.serializer.dumps(data)
+        if len(payload) <= self.max_size:
+            self._remove(ref for ref, stored_at in loaded.values())
+            return payload
+        sizes = []
+        for key, value in data.items():
+            if not key.startswith('_') or key.startswith('_f_'):
+                value_payload = self.serializer.dumps({key: value})
+                sizes.append((len(value_payload), key, value_payload))
+        sizes.sort(reverse=True)
+        spilled = self._cache()
+        now = time.time()
+        kept = set()
+        for size, key, value_payload in sizes:
+            ref = self._reference(data, key, value_payload)
+            previous = loaded.get(key)
+            if previous is not None and previous[0] == ref and self._fresh(
+                    previous[1], now):
+                stored_at = previous[1]
+                self.stats['reused'] += 1
+            else:
+                spilled.put(ref, data[key])
+                stored_at = now
+                self.stats['spilled'] += 1
+            kept.add(ref)
+            data[key] = {_SPILLED: ref, 'stored': stored_at}
+            payload = self.serializer.dumps(data)
+            if len(payload) <= self.max_size:
+                break
+        self._remove(ref for ref, stored_at in loaded.values()
+                     if ref not in kept)
+        return payload
+
+    def _remove(self, refs):
+        spilled = None
+        for ref in refs:
+            if spilled is None:
+                spilled = self._cache()
+            spilled.remove_value(ref)
+            self.stats['removed'] += 1
+
+    def loads(self, data):
+        data = self.serializer.loads(data)
+        spilled = None
+        loaded = {}
+        for key, value in list(data.items()):
+            if isinstance(value, dict) and _SPILLED in value:
+                if spilled is None:
+                    spilled = self._cache()
+                ref = value[_SPILLED]
+                try:
+                    data[key] = spilled.get(ref)
+                except KeyError:
+                    self.stats['missing'] += 1
+                    del data[key]
+                else:
+                    loaded[key] = (ref, value.get('stored', 0))
+        if loaded:
+            data[_SPILLED] = loaded
+        return data
+
+
+# Serializers Beaker itself may have written old sessions with.
+_fallbacks = {
+    'pickle': BeakerPickleSerializer,
+    'json': BeakerJsonSerializer,
+    }
+
+
+def beaker_serializer(data_serializer):
+    """ Return the serializer object for a Beaker ``data_serializer``
+    option, which may be the name of one of Beaker's formats."""
+    if isinstance(data_serializer, str):
+        try:
+            return _fallbacks[data_serializer]()
+        except KeyError:
+            raise ConfigurationError(
+                'Unknown data_serializer %r' % (data_serializer,))
+    return data_serializer
+
+
+def make_serializer(serializer, fallback='pickle'):
+    """ Return a session serializer from a ``session.serializer`` setting.
+
+    ``serializer`` may be ``json``, ``msgpack``, ``pickle`` or
+    ``pickle:<protocol>``, a dotted Python name of an object (or class)
+    with ``loads`` and ``dumps`` methods, or such an object itself.
+
+    ``fallback`` names the serializer used for payloads ``serializer``
+    cannot read: ``pickle`` (Beaker's default format), ``json`` (Beaker's
+    ``json`` format) or ``none`` to disable the fallback."""
+    if isinstance(serializer, str):
+        name = serializer.strip()
+        if name == 'json':
+            serializer = JSONSerializer()
+        elif name == 'msgpack':
+            serializer = MsgpackSerializer()
+        elif name == 'pickle':
+            serializer = PickleSerializer()
+        elif name.startswith('pickle:'):
+            serializer = PickleSerializer(int(name[len('pickle:'):]))
+        else:
+            serializer = DottedNameResolver(None).resolve(name)
+    if isinstance(serializer, type):
+        serializer = serializer()
+    if not (hasattr(serializer, 'loads') and hasattr(serializer, 'dumps')):
+        raise ConfigurationError(
+            'Session serializer %r must have loads and dumps methods'
+            % (serializer,))
+    if fallback is None or fallback == 'none':
+        return serializer
+    try:
+        fallback = _fallbacks[fallback]()
+    except KeyError:
+        raise ConfigurationError(
+            'Unknown session serializer fallback %r' % (fallback,))
+    return FallbackSerializer(serializer, fallback)
@@ -0,0 +1,78 @@
+""" Coalescing of concurrent computations within a process.
+
+When several threads ask a :class:`SingleFlight` for the same key at once,
+the first one (the leader) runs the computation and the others wait for
+it, receiving its result or re-raising its exception.  Used by cache
+regions with the ``singleflight`` option, so that threads missing the same
+key run its creation function once.
+"""
+import threading
+
+
+class _Flight(object):
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """ A group of keyed computations.
+
+    ``stats`` counts the computations run by ``leaders``, the ``followers``
+    handed a leader's result and the followers which gave up waiting after
+    a ``timeout`` and ran the computation themselves (``timeouts``)."""
+    def __init__(self):
+        self.stats = {'leaders': 0, 'followers': 0, 'timeouts': 0}
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def _count(self, key):
+        self._lock.acquire()
+        try:
+            self.stats[key] += 1
+        finally:
+            self._lock.release()
+
+    def do(self, key, fn, timeout=None, fallback=None):
+        """ Return ``(value, leader)``: the result of ``fn()``, computed by
+        this thread if ``leader`` is true or by a concurrent call with the
+        same ``key`` otherwise.  Waits at most ``timeout`` seconds for a
+        concurrent call before calling ``fallback`` (by default ``fn``)
+        itself."""
+        self._lock.acquire()
+        try:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.stats['leaders'] += 1
+        finally:
+            self._lock.release()
+        if not leader:
+            flight.done.wait(timeout)
+            if not flight.done.is_set():
+                self._count('timeouts')
+                return (fallback or fn)(), True
+            self._count('followers')
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, False
+        try:
+            flight.value = fn()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._flights[key]
+            finally:
+                self._lock.release()
+            flight.done.set()
+        return flight.value, True
+
+    def __len__(self):
+        return len(self._flights)
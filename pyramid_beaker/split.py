@@ -0,0 +1,128 @@
+""" Storage of large session values apart from the session.
+
+With the ``split_threshold`` session option, each value whose serialized
+size reaches the threshold is stored as a separate backend entry, in a
+namespace of its own, and the session itself only keeps a small
+placeholder naming it.  Requests using only the small keys of a session
+(its CSRF token, its user id) then neither read nor deserialize the large
+values; a large value is fetched the first time it is accessed during a
+request and written again only when it changed.
+
+Entries are written with twice the session ``timeout`` as their expiry,
+and rewritten once they are older than the ``timeout``, so that they
+outlive the session on backends which expire them on their own.  Entries
+of keys removed from the session, or whose values shrank below the
+threshold, are deleted when the session is saved.
+"""
+import hashlib
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# key of the placeholders standing for split values in the session
+SPLIT_KEY = '_pyramid_beaker_split_'
+
+# part of the names of the namespaces holding split values; file names
+# keep it, so that the sweeper can recognise them
+NAMESPACE_INFIX = '-split-'
+
+
+def placeholder(value):
+    """ Return the ``(namespace, stored_at)`` of the split value
+    placeholder ``value``, or ``None`` if it is not one."""
+    if isinstance(value, dict) and len(value) == 1 and SPLIT_KEY in value:
+        namespace, stored_at = value[SPLIT_KEY]
+        return namespace, stored_at
+    return None
+
+
+class SplitStore(object):
+    """ Stores the session values whose serialized size reaches
+    ``threshold`` bytes apart from their session.
+
+    ``stats`` counts the values ``loaded``, ``stored``, ``refreshed`` and
+    ``removed``, and the placeholders whose entry was ``missing``."""
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.stats = {'loaded': 0, 'stored': 0, 'refreshed': 0,
+                      'removed': 0, 'missing': 0}
+
+    def namespace_name(self, sess, key):
+        digest = hashlib.sha1(('%s' % (key,)).encode('utf-8')).hexdigest()
+        return sess.id + NAMESPACE_INFIX + digest
+
+    def _namespace(self, sess, name):
+        return sess.namespace_class(name, data_dir=sess.data_dir,
+                                    digest_filenames=False,
+                                    **sess.namespace_args)
+
+    def payload(self, sess, key, value):
+        """ Return the serialized (and, if the session is encrypted,
+        encrypted) ``value`` of ``key`` if it should be stored apart, or
+        ``None`` if it should stay in the session."""
+        payload = sess._encrypt_data({key: value})
+        if len(payload) >= self.threshold:
+            return payload
+        return None
+
+    def load(self, sess, key, name):
+        """ Return the value of ``key`` stored in the namespace ``name``.
+        Raises :exc:`KeyError` if the entry is missing."""
+        namespace = self._namespace(sess, name)
+        namespace.acquire_read_lock()
+        try:
+            try:
+                payload = namespace['value']
+            except KeyError:
+                payload = None
+        finally:
+            namespace.release_read_lock()
+        # memcached returns None for missing keys
+        data = payload is not None and sess._decrypt_data(payload) or {}
+        if key not in data:
+            self.stats['missing'] += 1
+            log.warning('Split session value %r of session %s is missing',
+                        key, sess.id)
+            raise KeyError(key)
+        self.stats['loaded'] += 1
+        return data[key]
+
+    def store(self, sess, name, payload, refresh=False):
+        """ Return a job writing ``payload`` to the namespace ``name``."""
+        expiretime = sess.timeout and 2 * sess.timeout or None
+        def job():
+            namespace = self._namespace(sess, name)
+            namespace.acquire_write_lock(replace=True)
+            try:
+                namespace.set_value('value', payload, expiretime=expiretime)
+            finally:
+                namespace.release_write_lock()
+            self.stats['refreshed' if refresh else 'stored'] += 1
+        return job
+
+    def remove(self, sess, name):
+        """ Return a job deleting the entry of the namespace ``name``."""
+        def job():
+            namespace = self._namespace(sess, name)
+            namespace.acquire_write_lock()
+            try:
+                try:
+                    del namespace['value']
+                except KeyError:
+                    return
+            finally:
+                namespace.release_write_lock()
+            self.stats['removed'] += 1
+        return job
+
+    def needs_refresh(self, sess, stored_at, now=None):
+        """ Return whether an entry written at ``stored_at`` should be
+        written again to keep it from expiring before its session."""
+        if not sess.timeout:
+            return False
+        return (now or time.time()) - stored_at > sess.timeout
+
+    def reference(self, name, now=None):
+        """ Return the placeholder of a value stored in ``name``."""
+        return {SPLIT_KEY: [name, now or time.time()]}
@@ -0,0 +1,397 @@
+""" Removal of expired session files, cache files and lock files.
+
+Beaker's ``file`` and ``dbm`` backends keep one file (or, for ``dbm``, a
+few files sharing a name) per session or cache namespace, and never
+delete them.  The :class:`Sweeper` walks such directories one directory
+at a time and removes the files which have not been written for longer
+than their maximum age, using a pool of threads.
+
+Expiry is decided from the file's modification time alone, without
+reading it: every save of a session rewrites its file, and records an
+access time no later than the write, so a session file older than the
+session ``timeout`` holds an expired session.  Likewise a cache file
+older than its region's ``expire`` (plus ``stale_ttl``) holds only expired
+values.  Session values stored apart with ``split_threshold`` are kept
+for twice the session maximum age, as they are rewritten only once they
+are older than the session ``timeout``.
+
+Beaker never updates the modification time of lock files, so their age
+says nothing about their use, and removing a lock file which a process
+has opened but not locked yet would let two processes lock the same
+namespace.  Lock files are therefore only removed when the data file of
+their namespace is gone or expired, and nobody holds them: once the data
+files have been swept, the lock files of the namespaces just removed are,
+and in session lock directories, so are those of sessions whose file no
+longer exists.  Cache lock directories also hold the creation locks of
+cache keys, which cannot be told apart from the locks of removed
+namespaces and are kept.
+
+The ``pyramid_beaker_sweep`` console script sweeps the directories named
+by the ``session.`` and ``cache.`` settings of a Paste configuration
+file::
+
+    $ pyramid_beaker_sweep development.ini [--max-age SECONDS]
+          [--workers N] [--batch-size N] [--rate N] [--dry-run]
+"""
+from __future__ import print_function
+
+import argparse
+import errno
+import hashlib
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError: # pragma: no cover
+    import Queue as queue
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    fcntl = None
+
+from pyramid_beaker.principals import NAMESPACE_PREFIX
+from pyramid_beaker.split import NAMESPACE_INFIX
+
+log = logging.getLogger(__name__)
+
+_DATA_DIRS = ('container_file', 'container_dbm')
+_LOCK_DIRS = ('container_file_lock', 'container_dbm_lock')
+
+
+def _group(name):
+    """ Return the name of the namespace file ``name`` belongs to, or
+    ``None`` if it is not a Beaker data file."""
+    if name.endswith('.cache'):
+        return name
+    index = name.find('.dbm')
+    if index != -1:
+        # dbm modules may add their own suffixes (.db, .dir, .dat, .bak)
+        return name[:index + 4]
+    return None
+
+
+def _lock_name(kind, group):
+    """ Return the name of the lock file of the namespace whose data file
+    is named ``group``."""
+    name = os.path.basename(group).rsplit('.', 1)[0]
+    if kind == 'cache':
+        # cache file names are already the digest of their namespace
+        return name + '.lock'
+    # session file names are their namespace without dots
+    prefix = NAMESPACE_PREFIX.replace('.', '')
+    if name.startswith(prefix):
+        name = NAMESPACE_PREFIX + name[len(prefix):]
+    return hashlib.sha1(name.encode('utf-8')).hexdigest() + '.lock'
+
+
+class Sweeper(object):
+    """ Removes expired files from the directories added with
+    :meth:`add_sessions`, :meth:`add_cache` and :meth:`add_locks`.
+
+    ``workers`` threads remove files in batches of ``batch_size``; ``rate``,
+    if given, limits the number of files removed per second.  With
+    ``dry_run`` nothing is removed, but the ``stats`` are collected as if
+    it had been."""
+    def __init__(self, workers=4, batch_size=500, rate=None, dry_run=False):
+        self.workers = int(workers)
+        self.batch_size = int(batch_size)
+        self.rate = rate
+        self.dry_run = dry_run
+        self.targets = []
+        self.stats = {'scanned': 0, 'sessions': 0, 'cache': 0, 'locks': 0,
+                      'bytes': 0, 'errors': 0}
+        self._lock = threading.Lock()
+        # lock directories whose unknown lock files are session locks
+        self._session_locks = set()
+        self._cache_locks = set()
+        # lock file names of the namespaces found current, and of those
+        # removed with the data files they lock
+        self._live = set()
+        self._removed = {}
+
+    def _add(self, kind, root, max_age):
+        root = os.path.abspath(root)
+        for target in self.targets:
+            if target[1] == root:
+                # directories shared by several targets are swept once,
+                # with the longest maximum age
+                if max_age > target[2]:
+                    self.targets[self.targets.index(target)] = (
+                        target[0], root, max_age)
+                return
+        self.targets.append((kind, root, max_age))
+
+    def add_sessions(self, data_dir, max_age, lock_dir=None):
+        """ Sweep the session files under ``data_dir`` older than
+        ``max_age`` seconds, and their lock files."""
+        for name in _DATA_DIRS:
+            self._add('sessions', os.path.join(data_dir, name), max_age)
+        self._add_lock_dirs(data_dir, lock_dir, max_age, sessions=True)
+
+    def add_cache(self, data_dir, max_age, lock_dir=None):
+        """ Sweep the cache files under ``data_dir`` older than ``max_age``
+        seconds, and their lock files."""
+        for name in _DATA_DIRS:
+            self._add('cache', os.path.join(data_dir, name), max_age)
+        self._add_lock_dirs(data_dir, lock_dir, max_age)
+
+    def add_locks(self, lock_dir, max_age, sessions=False):
+        """ Sweep the unused lock files under ``lock_dir`` of the
+        namespaces removed.  If ``sessions`` is true, ``lock_dir`` holds
+        session locks only, and the lock files older than ``max_age``
+        seconds of sessions without a file are removed as well."""
+        self._add('locks', lock_dir, max_age)
+        root = os.path.abspath(lock_dir)
+        (self._session_locks if sessions else self._cache_locks).add(root)
+
+    def _add_lock_dirs(self, data_dir, lock_dir, max_age, sessions=False):
+        if lock_dir:
+            self.add_locks(lock_dir, max_age, sessions)
+        else:
+            for name in _LOCK_DIRS:
+                self.add_locks(os.path.join(data_dir, name), max_age,
+                               sessions)
+
+    def _candidates(self, kind, root, max_age):
+        """ Yield the ``(kind, paths, cutoff, lock)`` of each expired
+        namespace under ``root``, one directory at a time.  ``lock`` is the
+        name of the namespace's lock file."""
+        if kind == 'locks':
+            for candidate in self._lock_candidates(root, max_age):
+                yield candidate
+            return
+        cutoff = time.time() - max_age
+        split_cutoff = time.time() - 2 * max_age
+        for dirpath, dirnames, filenames in os.walk(root):
+            groups = {}
+            for name in filenames:
+                group = _group(name)
+                if group is not None:
+                    groups.setdefault(group, []).append(
+                        os.path.join(dirpath, name))
+            for group, paths in groups.items():
+                self._count('scanned')
+                group_cutoff = cutoff
+                if kind == 'sessions' and NAMESPACE_INFIX in group:
+                    group_cutoff = split_cutoff
+                lock = _lock_name(kind, group)
+                if self._expired(paths, group_cutoff):
+                    yield kind, paths, group_cutoff, lock
+                else:
+                    self._live.add(lock)
+
+    def _lock_candidates(self, root, max_age):
+        orphans = root in self._session_locks and root not in self._cache_locks
+        cutoff = time.time() - max_age
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in filenames:
+                if not name.endswith('.lock'):
+                    continue
+                self._count('scanned')
+                path = os.path.join(dirpath, name)
+                if name in self._removed:
+                    yield 'locks', [path], self._removed[name], name
+                elif (orphans and name not in self._live and
+                      self._expired([path], cutoff)):
+                    yield 'locks', [path], (), name
+
+    def _expired(self, paths, cutoff):
+        try:
+            return all(os.stat(path).st_mtime < cutoff for path in paths)
+        except OSError:
+            # removed by somebody else meanwhile
+            return False
+
+    def _count(self, key, value=1):
+        self._lock.acquire()
+        try:
+            self.stats[key] += value
+        finally:
+            self._lock.release()
+
+    def _remove(self, kind, paths, cutoff, lock):
+        """ Remove the ``paths`` of a namespace if they are older than
+        ``cutoff``, or, for lock files, the lock file if the data
+        ``cutoff`` lists no longer exist."""
+        size = 0
+        try:
+            for path in paths:
+                size += os.stat(path).st_size
+            if self.dry_run:
+                pass
+            elif kind == 'locks':
+                if not self._remove_lock(paths[0], cutoff):
+                    return
+            else:
+                # the namespace may have been written since it was scanned
+                if not self._expired(paths, cutoff):
+                    return
+                for path in paths:
+                    os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                self._count('errors')
+                log.warning('Could not remove %s: %s', paths[0], e)
+            return
+        if kind != 'locks':
+            self._lock.acquire()
+            try:
+                self._removed[lock] = paths
+            finally:
+                self._lock.release()
+        self._count(kind)
+        self._count('bytes', size)
+
+    def _remove_lock(self, path, data_paths):
+        if fcntl is None: # pragma: no cover
+            return False
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # held by a running process
+                return False
+            # writers hold the lock while writing, so a data file written
+            # since it was removed exists by now
+            for data_path in data_paths:
+                if os.path.exists(data_path):
+                    return False
+            os.unlink(path)
+            return True
+        finally:
+            os.close(fd)
+
+    def _run(self, q):
+        while True:
+            batch = q.get()
+            try:
+                if batch is None:
+                    return
+                for candidate in batch:
+                    self._remove(*candidate)
+            finally:
+                q.task_done()
+
+    def sweep(self):
+        """ Remove the expired files of every directory added, and return
+        the ``stats``: the number of namespaces ``scanned``, the number of
+        ``sessions``, ``cache`` and ``locks`` files removed, the ``bytes``
+        reclaimed and the number of ``errors``."""
+        start = time.time()
+        # lock files are swept once the data files they lock have been
+        submitted = self._sweep(
+            [target for target in self.targets if target[0] != 'locks'],
+            start, 0)
+        self._sweep([target for target in self.targets
+                     if target[0] == 'locks'], start, submitted)
+        return self.stats
+
+    def _sweep(self, targets, start, submitted):
+        q = queue.Queue(self.workers * 2)
+        threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, args=(q,),
+                                      name='pyramid_beaker-sweeper-%d' % i)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            batch = []
+            for kind, root, max_age in targets:
+                for candidate in self._candidates(kind, root, max_age):
+                    batch.append(candidate)
+                    if len(batch) >= self.batch_size:
+                        submitted = self._submit(q, batch, submitted, start)
+                        batch = []
+            if batch:
+                submitted = self._submit(q, batch, submitted, start)
+        finally:
+            for thread in threads:
+                q.put(None)
+            for thread in threads:
+                thread.join()
+        return submitted
+
+    def _submit(self, q, batch, submitted, start):
+        if self.rate:
+            delay = start + submitted / float(self.rate) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        q.put(batch)
+        return submitted + len(batch)
+
+
+def _file_backend(options):
+    backend = options.get('type') or (
+        'file' if options.get('data_dir') else None)
+    return backend in ('file', 'dbm')
+
+
+def sweeper_from_settings(settings, max_age=None, **kw):
+    """ Return a :class:`Sweeper` for the session and cache directories
+    configured by ``settings``, as parsed by
+    :func:`pyramid_beaker.session_factory_from_settings` and
+    :func:`pyramid_beaker.set_cache_regions_from_settings`.
+
+    Sessions are swept after their ``timeout``, or ``max_age`` seconds if
+    given; cache regions after their ``expire`` and ``stale_ttl``.  Other
+    keyword arguments are passed to :class:`Sweeper`."""
+    from pyramid_beaker import _parse_cache_regions
+    from pyramid_beaker import _parse_session_options
+    sweeper = Sweeper(**kw)
+    options = _parse_session_options(settings)
+    if _file_backend(options):
+        session_max_age = max_age or options.get('timeout')
+        if session_max_age:
+            sweeper.add_sessions(options['data_dir'], session_max_age,
+                                 options.get('lock_dir'))
+        else:
+            log.warning('Sessions never expire without session.timeout; '
+                        'not sweeping %s', options['data_dir'])
+    for region, region_options in _parse_cache_regions(settings).items():
+        if not _file_backend(region_options):
+            continue
+        expire = region_options.get('expire')
+        if expire:
+            sweeper.add_cache(region_options['data_dir'],
+                              expire + region_options.get('stale_ttl', 0),
+                              region_options.get('lock_dir'))
+        else:
+            log.warning('Cache region %s never expires; not sweeping %s',
+                        region, region_options['data_dir'])
+    return sweeper
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description='Remove expired Beaker session, cache and lock files.')
+    parser.add_argument('config_uri',
+                        help='the configuration file, e.g. development.ini')
+    parser.add_argument('--max-age', type=int,
+                        help='session age in seconds (session.timeout by '
+                             'default)')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--rate', type=float,
+                        help='maximum number of files removed per second')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only report what would be removed')
+    args = parser.parse_args(argv[1:])
+
+    from pyramid.paster import get_appsettings
+    from pyramid.paster import setup_logging
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    sweeper = sweeper_from_settings(
+        settings, args.max_age, workers=args.workers,
+        batch_size=args.batch_size, rate=args.rate, dry_run=args.dry_run)
+    stats = sweeper.sweep()
+    for key in sorted(stats):
+        print('%-10s %12d' % (key, stats[key]))
+    return 1 if stats['errors'] else 0
@@ -1,5 +1,71 @@
+import sys
 import unittest
 
+try:
+    import msgpack
+except ImportError: # pragma: no cover
+    msgpack = None
+
+class DummyRequest:
+    def __init__(self):
+        self.callbacks = []
+        self.environ = {}
+
+    def add_response_callback(self, callback):
+        self.callbacks.append(callback)
+
+class DummyResponse:
+    def __init__(self):
+        self.headerlist = []
+
+class SessionFixture(object):
+    """ Helpers of the test cases of session factory options.
+    ``factory_options`` are the defaults of the factories created by
+    ``_makeFactory``."""
+    factory_options = {}
+
+    def _makeFactory(self, **options):
+        from pyramid_beaker import BeakerSessionFactoryConfig
+        for name, value in self.factory_options.items():
+            options.setdefault(name, value)
+        options.setdefault('type', 'memory')
+        return BeakerSessionFactoryConfig(**options)
+
+    def _request(self, factory, cookie=None, method=None, **data):
+        request = DummyRequest()
+        if cookie is not None:
+            request.environ['HTTP_COOKIE'] = cookie
+        if method is not None:
+            request.method = method
+        session = factory(request)
+        if data:
+            session.update(data)
+        return request, session
+
+    def _finish(self, request):
+        response = DummyResponse()
+        for callback in request.callbacks:
+            callback(request, response)
+        return response
+
+    def _cookie(self, response):
+        if response.headerlist:
+            return response.headerlist[0][1].split(';')[0]
+
+    def _save(self, factory, cookie=None, **data):
+        """ Save ``data`` in a new session, or in the session of
+        ``cookie``, and return the session cookie."""
+        request, session = self._request(factory, cookie, **data)
+        return self._cookie(self._finish(request)) or cookie
+
+    def _load(self, factory, cookie):
+        return self._request(factory, cookie)[1]
+
+    def _saved(self, factory, method=None, **data):
+        """ Save ``data`` in a new session and return a request sending
+        its cookie back, and the session of that request."""
+        return self._request(factory, self._save(factory, **data), method)
+
 class TestPyramidBeakerSessionObject(unittest.TestCase):
     def _makeOne(self, request, **options):
         from pyramid_beaker import BeakerSessionFactoryConfig
@@ -175,94 +241,3642 @@ class TestPyramidBeakerSessionObject(unittest.TestCase):
 
 
 
-class Test_session_factory_from_settings(unittest.TestCase):
-    def _callFUT(self, settings):
-        from pyramid_beaker import session_factory_from_settings
-        return session_factory_from_settings(settings)
+class TestChangeTracking(SessionFixture, unittest.TestCase):
+    def test_setdefault_existing_not_dirty(self):
+        request = DummyRequest()
+        session = self._makeFactory()(request)
+        session['a'] = 1
+        session.__dict__['_dirty'] = False
+        self.assertEqual(session.setdefault('a', 2), 1)
+        self.assertFalse(session.dirty())
 
-    def test_it(self):
-        settings = {'session.auto':'true', 'session.key':'foo'}
-        factory = self._callFUT(settings)
-        self.assertEqual(factory._options, {'auto':True, 'key':'foo'})
+    def test_pop_missing_not_dirty(self):
+        request = DummyRequest()
+        session = self._makeFactory()(request)
+        self.assertEqual(session.pop('a', 'default'), 'default')
+        self.assertFalse(session.dirty())
 
-    def test_cookie_on_exception_true(self):
-        settings = {'session.cookie_on_exception':'true'}
-        factory = self._callFUT(settings)
-        self.assertEqual(factory._cookie_on_exception, True)
+    def test_clear_empty_not_dirty(self):
+        request = DummyRequest()
+        session = self._makeFactory()(request)
+        session.clear()
+        self.assertFalse(session.dirty())
 
-    def test_cookie_on_exception_false(self):
-        settings = {'session.cookie_on_exception':'false'}
-        factory = self._callFUT(settings)
-        self.assertEqual(factory._cookie_on_exception, False)
+    def test_update_empty_not_dirty(self):
+        request = DummyRequest()
+        session = self._makeFactory()(request)
+        session.update({})
+        self.assertFalse(session.dirty())
 
-    def test_constant_csrf_token_set(self):
-        settings = {'session.constant_csrf_token':'foo'}
-        factory = self._callFUT(settings)
-        self.assertEqual(factory._constant_csrf_token, 'foo')
+    def test_assign_equal_value_avoids_write(self):
+        factory = self._makeFactory()
+        request, session = self._saved(factory, user='fred', count=1)
+        session['user'] = 'fred'
+        session['count'] = 1
+        self.assertTrue(session.dirty())
+        self.assertFalse(session._modified())
+        self._finish(request)
+        self.assertEqual(factory.write_stats['writes_avoided'], 1)
 
-    def test_constant_csrf_token_unset(self):
-        settings = {}
-        factory = self._callFUT(settings)
-        self.assertEqual(factory._constant_csrf_token, False)
+    def test_revert_avoids_write(self):
+        factory = self._makeFactory()
+        request, session = self._saved(factory, user='fred')
+        session['user'] = 'barney'
+        del session['user']
+        session['user'] = 'fred'
+        session['temp'] = 1
+        session.pop('temp')
+        self.assertFalse(session._modified())
 
+    def test_changed_value_is_written(self):
+        factory = self._makeFactory()
+        request, session = self._saved(factory, user='fred')
+        writes = factory.write_stats['writes']
+        session['user'] = 'barney'
+        self.assertTrue(session._modified())
+        self._finish(request)
+        self.assertEqual(factory.write_stats['writes'], writes + 1)
+        cookie = request.environ['HTTP_COOKIE']
+        self.assertEqual(self._load(factory, cookie)['user'], 'barney')
 
-class DummyRequest:
-    def __init__(self):
-        self.callbacks = []
-        self.environ = {}
+    def test_mutable_value_is_modified(self):
+        factory = self._makeFactory()
+        request, session = self._saved(factory, items=[1])
+        session['items'] = session['items']
+        self.assertTrue(session._modified())
 
-    def add_response_callback(self, callback):
-        self.callbacks.append(callback)
+    def test_changed_forces_write(self):
+        factory = self._makeFactory()
+        request, session = self._saved(factory, user='fred')
+        session.changed()
+        self.assertTrue(session._modified())
 
-class DummyResponse:
-    def __init__(self):
-        self.headerlist = []
+    def test_flash_existing_queue_is_modified(self):
+        factory = self._makeFactory()
+        request, session = self._saved(factory, _f_=['one'])
+        session.flash('two')
+        self.assertTrue(session._modified())
+        self.assertEqual(session['_f_'], ['one', 'two'])
 
-class Test_session_cookie_on_exception(unittest.TestCase):
+    def test_flash_duplicate_not_dirty(self):
+        factory = self._makeFactory()
+        request, session = self._saved(factory, _f_=['one'])
+        session.flash('one', allow_duplicate=False)
+        self.assertFalse(session.dirty())
+
+    def test_regenerate_id_is_modified(self):
+        factory = self._makeFactory()
+        request, session = self._saved(factory, user='fred')
+        session.regenerate_id()
+        session['user'] = 'fred'
+        self.assertTrue(session._modified())
+
+class Test_make_serializer(unittest.TestCase):
+    def _callFUT(self, serializer, fallback='none'):
+        from pyramid_beaker.serializers import make_serializer
+        return make_serializer(serializer, fallback)
+
+    def _roundtrip(self, serializer):
+        data = {'_f_': ['one', 'two'], '_csrft_': 'abc', 'user': {'id': 1}}
+        self.assertEqual(serializer.loads(serializer.dumps(data)), data)
+
+    def test_json(self):
+        from pyramid_beaker.serializers import JSONSerializer
+        serializer = self._callFUT('json')
+        self.assertTrue(isinstance(serializer, JSONSerializer))
+        self._roundtrip(serializer)
+
+    def test_pickle(self):
+        import pickle
+        serializer = self._callFUT('pickle')
+        self.assertEqual(serializer.protocol, pickle.HIGHEST_PROTOCOL)
+        self._roundtrip(serializer)
+
+    def test_pickle_protocol(self):
+        serializer = self._callFUT('pickle:2')
+        self.assertEqual(serializer.protocol, 2)
+        self._roundtrip(serializer)
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        self._roundtrip(self._callFUT('msgpack'))
+
+    def test_dotted_name(self):
+        from pyramid_beaker.serializers import JSONSerializer
+        serializer = self._callFUT('pyramid_beaker.serializers.JSONSerializer')
+        self.assertTrue(isinstance(serializer, JSONSerializer))
+
+    def test_object(self):
+        from pyramid_beaker.serializers import JSONSerializer
+        serializer = JSONSerializer()
+        self.assertTrue(self._callFUT(serializer) is serializer)
+
+    def test_invalid_object(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._callFUT, object())
+
+    def test_invalid_fallback(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._callFUT, 'json', 'yaml')
+
+    def test_pickle_fallback(self):
+        import pickle
+        serializer = self._callFUT('json', 'pickle')
+        self._roundtrip(serializer)
+        old = pickle.dumps({'a': 1}, 2)
+        self.assertEqual(serializer.loads(old), {'a': 1})
+
+    def test_json_fallback(self):
+        from beaker.util import JsonSerializer
+        serializer = self._callFUT('pickle', 'json')
+        old = JsonSerializer().dumps({'a': 1})
+        self.assertEqual(serializer.loads(old), {'a': 1})
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack_pickle_fallback(self):
+        import pickle
+        serializer = self._callFUT('msgpack', 'pickle')
+        old = pickle.dumps({'a': 1}, 2)
+        self.assertEqual(serializer.loads(old), {'a': 1})
+
+    def test_session_reads_old_format(self):
+        from pyramid_beaker import BeakerSessionFactoryConfig
+        old = BeakerSessionFactoryConfig(type='memory')
+        new = BeakerSessionFactoryConfig(type='memory', serializer='json')
+        request = DummyRequest()
+        session = old(request)
+        session['a'] = 1
+        response = DummyResponse()
+        request.callbacks[0](request, response)
+        cookie = response.headerlist[0][1]
+        request = DummyRequest()
+        request.environ['HTTP_COOKIE'] = cookie
+        session = new(request)
+        self.assertEqual(session['a'], 1)
+        session['a'] = 2
+        request.callbacks[0](request, DummyResponse())
+        request = DummyRequest()
+        request.environ['HTTP_COOKIE'] = cookie
+        self.assertEqual(new(request)['a'], 2)
+
+class TestWriteBehindQueue(unittest.TestCase):
+    def _makeOne(self, **kw):
+        from pyramid_beaker.writebehind import WriteBehindQueue
+        q = WriteBehindQueue(**kw)
+        self.addCleanup(q.shutdown)
+        return q
+
+    def test_invalid_policy(self):
+        from pyramid_beaker.writebehind import WriteBehindQueue
+        self.assertRaises(ValueError, WriteBehindQueue, policy='drop')
+
+    def test_ordered_per_key(self):
+        q = self._makeOne(workers=4)
+        written = []
+        for i in range(50):
+            q.submit('a', lambda i=i: written.append(('a', i)))
+            q.submit('b', lambda i=i: written.append(('b', i)))
+        q.flush()
+        for key in ('a', 'b'):
+            self.assertEqual([i for k, i in written if k == key],
+                             list(range(50)))
+        self.assertEqual(q.stats['written'], 100)
+
+    def test_full_queue_sync_policy(self):
+        import threading
+        q = self._makeOne(workers=1, queue_size=1)
+        started = threading.Event()
+        release = threading.Event()
+        written = []
+        def blocker():
+            started.set()
+            release.wait()
+        q.submit('a', blocker)
+        started.wait()
+        q.submit('b', lambda: written.append(1))
+        q.submit('c', lambda: written.append(2))
+        # the write for c did not fit in the queue and ran inline
+        self.assertEqual(written, [2])
+        self.assertEqual(q.stats['overflow'], 1)
+        release.set()
+        q.flush()
+        self.assertEqual(written, [2, 1])
+
+    def test_full_queue_sync_policy_keeps_order(self):
+        import threading
+        q = self._makeOne(workers=1, queue_size=1)
+        started = threading.Event()
+        release = threading.Event()
+        written = []
+        def blocker():
+            started.set()
+            release.wait()
+        q.submit('x', blocker)
+        started.wait()
+        q.submit('a', lambda: written.append('v1'))
+        submitted = threading.Event()
+        def submit():
+            q.submit('a', lambda: written.append('v2'))
+            submitted.set()
+        thread = threading.Thread(target=submit)
+        thread.start()
+        # v1 is still queued, so v2 waits for room instead of running now
+        self.assertFalse(submitted.wait(0.1))
+        self.assertEqual(written, [])
+        release.set()
+        thread.join(5)
+        q.flush()
+        self.assertEqual(written, ['v1', 'v2'])
+        self.assertEqual(q.stats['overflow'], 0)
+        self.assertEqual(q._pending, {})
+
+    def test_inline_write_not_overtaken(self):
+        import threading
+        q = self._makeOne(workers=1, queue_size=1)
+        started = threading.Event()
+        release = threading.Event()
+        written = []
+        def blocker():
+            started.set()
+            release.wait()
+        q.submit('x', blocker)
+        started.wait()
+        q.submit('y', lambda: None)
+        inline_started = threading.Event()
+        inline_release = threading.Event()
+        def v1():
+            inline_started.set()
+            inline_release.wait()
+            written.append('v1')
+        first = threading.Thread(target=q.submit, args=('a', v1))
+        first.start()
+        inline_started.wait()
+        self.assertEqual(q.stats['overflow'], 1)
+        release.set()
+        q.flush()
+        second = threading.Thread(
+            target=q.submit, args=('a', lambda: written.append('v2')))
+        second.start()
+        # v1 is still being written inline, so v2 waits for it
+        second.join(0.1)
+        self.assertTrue(second.is_alive())
+        self.assertEqual(written, [])
+        inline_release.set()
+        first.join(5)
+        second.join(5)
+        q.flush()
+        self.assertEqual(written, ['v1', 'v2'])
+        self.assertEqual(q._pending, {})
+
+    def test_failed_write_is_logged(self):
+        q = self._makeOne(workers=1)
+        def fail():
+            raise ValueError
+        q.submit('a', fail)
+        q.flush()
+        self.assertEqual(q.stats['failed'], 1)
+
+    def test_flush_write_behind(self):
+        from pyramid_beaker.writebehind import flush_write_behind
+        q = self._makeOne(workers=1)
+        written = []
+        q.submit('a', lambda: written.append(1))
+        flush_write_behind()
+        self.assertEqual(written, [1])
+
+
+class TestWriteBehindSession(SessionFixture, unittest.TestCase):
+    factory_options = {'write_behind': True}
+
+    def _makeFactory(self, **options):
+        factory = SessionFixture._makeFactory(self, **options)
+        self.addCleanup(factory.write_behind.shutdown)
+        return factory
+
+    def test_write_is_deferred(self):
+        factory = self._makeFactory()
+        request, session = self._request(factory)
+        session['a'] = 1
+        response = self._finish(request)
+        self.assertEqual(response.headerlist[0][0], 'Set-Cookie')
+        factory.write_behind.flush()
+        self.assertEqual(factory.write_behind.stats['written'], 1)
+        cookie = response.headerlist[0][1]
+        request, session = self._request(factory, cookie)
+        self.assertEqual(session['a'], 1)
+
+    def test_snapshot_taken_at_response_time(self):
+        factory = self._makeFactory()
+        request, session = self._request(factory)
+        session['a'] = 1
+        response = self._finish(request)
+        session['a'] = 2
+        factory.write_behind.flush()
+        request, session = self._request(factory, response.headerlist[0][1])
+        self.assertEqual(session['a'], 1)
+
+    def test_untouched_new_session_not_written(self):
+        factory = self._makeFactory()
+        request, session = self._request(factory)
+        session.get('a')
+        response = self._finish(request)
+        factory.write_behind.flush()
+        self.assertEqual(factory.write_behind.stats['queued'], 0)
+        self.assertEqual(response.headerlist, [])
+
+    def test_cookie_sessions_written_inline(self):
+        from pyramid_beaker import BeakerSessionFactoryConfig
+        factory = BeakerSessionFactoryConfig(
+            type='cookie', validate_key='secret', write_behind=True)
+        request, session = self._request(factory)
+        session['a'] = 1
+        response = self._finish(request)
+        self.assertEqual(response.headerlist[0][0], 'Set-Cookie')
+        self.assertEqual(factory.write_behind.stats['queued'], 0)
+
+class TestTouchInterval(SessionFixture, unittest.TestCase):
+    factory_options = {'timeout': 300, 'touch_interval': 60}
+
+    def test_recent_read_not_persisted(self):
+        factory = self._makeFactory()
+        request, session = self._saved(factory, a=1)
+        self.assertEqual(session['a'], 1)
+        response = self._finish(request)
+        self.assertEqual(response.headerlist, [])
+        self.assertEqual(factory.write_stats['touches_avoided'], 1)
+
+    def test_expired_interval_persisted(self):
+        factory = self._makeFactory()
+        request, session = self._saved(factory, a=1)
+        self.assertEqual(session['a'], 1)
+        session.__dict__['_sess'].last_accessed -= 120
+        self.assertFalse(session._touch_throttled())
+        self._finish(request)
+        self.assertEqual(factory.write_stats['touches_avoided'], 0)
+
+    def test_mutation_persisted(self):
+        factory = self._makeFactory()
+        request, session = self._saved(factory, a=1)
+        session['a'] = 2
+        self.assertFalse(session._touch_throttled())
+        self._finish(request)
+        self.assertEqual(factory.write_stats['touches_avoided'], 0)
+        self.assertEqual(factory.write_stats['writes'], 2)
+
+    def test_new_session_not_throttled(self):
+        factory = self._makeFactory()
+        request = DummyRequest()
+        session = factory(request)
+        session['a'] = 1
+        self.assertFalse(session._touch_throttled())
+
+    def test_cookie_session(self):
+        factory = self._makeFactory(type='cookie', validate_key='secret')
+        request, session = self._saved(factory, a=1)
+        self.assertEqual(session['a'], 1)
+        response = self._finish(request)
+        self.assertEqual(response.headerlist, [])
+
+    def test_cookie_session_expired_interval(self):
+        factory = self._makeFactory(type='cookie', validate_key='secret')
+        request, session = self._saved(factory, a=1)
+        self.assertEqual(session['a'], 1)
+        session.__dict__['_sess'].accessed_dict['_accessed_time'] -= 120
+        response = self._finish(request)
+        self.assertEqual(response.headerlist[0][0], 'Set-Cookie')
+
+    def test_interval_longer_than_timeout(self):
+        from pyramid.exceptions import ConfigurationError
+        from pyramid_beaker import BeakerSessionFactoryConfig
+        self.assertRaises(ConfigurationError, BeakerSessionFactoryConfig,
+                          timeout=60, touch_interval=60)
+
+class TestReadOnlySession(SessionFixture, unittest.TestCase):
+    factory_options = {'readonly_methods': 'GET HEAD'}
+
+    def _saved(self, factory, method='GET', **data):
+        return SessionFixture._saved(self, factory, method, **data)
+
+    def test_safe_method_mutation_raises(self):
+        from pyramid_beaker import ReadOnlySessionError
+        factory = self._makeFactory()
+        request, session = self._saved(factory, a=1)
+        self.assertEqual(session['a'], 1)
+        self.assertRaises(ReadOnlySessionError, session.__setitem__, 'a', 2)
+        self.assertRaises(ReadOnlySessionError, session.changed)
+        self.assertRaises(ReadOnlySessionError, session.flash, 'msg')
+
+    def test_noop_mutations_allowed(self):
+        factory = self._makeFactory()
+        request, session = self._saved(factory, a=1)
+        self.assertEqual(session.setdefault('a', 2), 1)
+        self.assertEqual(session.pop('b', None), None)
+        self.assertEqual(session.pop_flash(), [])
+
+    def test_unsafe_method_writable(self):
+        factory = self._makeFactory()
+        request, session = self._saved(factory, method='POST', a=1)
+        session['a'] = 2
+        self.assertTrue(session.dirty())
+
+    def test_not_persisted(self):
+        factory = self._makeFactory()
+        request, session = self._saved(factory, a=1)
+        self.assertEqual(session['a'], 1)
+        response = self._finish(request)
+        self.assertEqual(response.headerlist, [])
+        self.assertEqual(factory.write_stats['writes'], 1)
+
+    def test_log_violation(self):
+        factory = self._makeFactory(readonly_violation='log')
+        request, session = self._saved(factory, a=1)
+        session['a'] = 2
+        self.assertEqual(session['a'], 2)
+        self._finish(request)
+        self.assertEqual(factory.write_stats['writes'], 1)
+
+    def test_request_flag(self):
+        factory = self._makeFactory()
+        request, session = self._saved(factory, method='POST', a=1)
+        request.session_readonly = True
+        from pyramid_beaker import ReadOnlySessionError
+        self.assertRaises(ReadOnlySessionError, session.__setitem__, 'a', 2)
+
+    def test_request_flag_set_after_load(self):
+        factory = self._makeFactory(readonly_violation='log')
+        request, session = self._saved(factory, method='POST', a=1)
+        session['a'] = 2
+        request.session_readonly = True
+        self._finish(request)
+        self.assertEqual(factory.write_stats['writes'], 1)
+
+    def test_lock_free_file_load(self):
+        import shutil
+        import tempfile
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir)
+        factory = self._makeFactory(type='file', data_dir=data_dir)
+        request, session = self._saved(factory, a=1)
+        self.assertEqual(session['a'], 1)
+        namespace = session.__dict__['_sess'].namespace
+        self.assertTrue(type(namespace).__name__.startswith('LockFree'))
 
+    def test_cookie_session(self):
+        from pyramid_beaker import ReadOnlySessionError
+        factory = self._makeFactory(type='cookie', validate_key='secret')
+        request, session = self._saved(factory, a=1)
+        self.assertEqual(session['a'], 1)
+        self.assertRaises(ReadOnlySessionError, session.__setitem__, 'a', 2)
+        response = self._finish(request)
+        self.assertEqual(response.headerlist, [])
+
+    def test_access_time_saved(self):
+        factory = self._makeFactory(timeout=600)
+        request, session = self._saved(factory, a=1)
+        self.assertEqual(session['a'], 1)
+        sess = session.__dict__['_sess']
+        accessed = sess.accessed_dict['_accessed_time'] + 100
+        sess.accessed_dict['_accessed_time'] = accessed
+        self._finish(request)
+        cookie = request.environ['HTTP_COOKIE']
+        request, session = self._request(factory, cookie, 'GET')
+        self.assertEqual(session['a'], 1)
+        self.assertEqual(session.__dict__['_sess'].last_accessed, accessed)
+        self.assertEqual(factory.write_stats['writes'], 1)
+
+    def test_access_time_not_saved_without_timeout(self):
+        factory = self._makeFactory()
+        request, session = self._saved(factory, a=1)
+        self.assertEqual(session['a'], 1)
+        sess = session.__dict__['_sess']
+        written = sess.last_accessed
+        sess.accessed_dict['_accessed_time'] = written + 100
+        self._finish(request)
+        cookie = request.environ['HTTP_COOKIE']
+        request, session = self._request(factory, cookie, 'GET')
+        self.assertEqual(session['a'], 1)
+        self.assertEqual(session.__dict__['_sess'].last_accessed, written)
+
+    def test_access_time_throttled(self):
+        factory = self._makeFactory(timeout=600, touch_interval=60)
+        request, session = self._saved(factory, a=1)
+        self.assertEqual(session['a'], 1)
+        self._finish(request)
+        self.assertEqual(factory.write_stats['touches_avoided'], 1)
+
+    def test_cookie_session_access_time(self):
+        factory = self._makeFactory(type='cookie', validate_key='secret',
+                                    timeout=600)
+        request, session = self._saved(factory, a=1)
+        session['a']
+        session.__dict__['_sess']['a'] = 2
+        response = self._finish(request)
+        self.assertEqual(response.headerlist[0][0], 'Set-Cookie')
+        cookie = self._cookie(response)
+        self.assertEqual(self._load(factory, cookie)['a'], 1)
+
+    def test_lock_free_falls_back_to_lock(self):
+        from beaker.container import FileNamespaceManager
+        from pyramid_beaker import _lockfree_namespace
+        import shutil
+        import tempfile
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir)
+        cls = _lockfree_namespace({'type': 'file'})
+        self.assertTrue(issubclass(cls, FileNamespaceManager))
+        namespace = cls('ns', data_dir=data_dir)
+        calls = []
+        def do_open(flags, replace):
+            calls.append(flags)
+            if len(calls) == 1:
+                raise ValueError
+            namespace.flags = flags
+        namespace.do_open = do_open
+        namespace.acquire_read_lock()
+        namespace.release_read_lock()
+        self.assertEqual(calls, ['r', 'r'])
+
+    def test_view_option(self):
+        from pyramid.config import Configurator
+        from webob import Request
+        config = Configurator(settings={'session.type': 'memory'})
+        config.include('pyramid_beaker')
+        flags = []
+        def view(request):
+            flags.append(request.session_readonly)
+            return request.response
+        config.add_route('home', '/')
+        config.add_view(view, route_name='home', session_readonly=True)
+        app = config.make_wsgi_app()
+        Request.blank('/').get_response(app)
+        self.assertEqual(flags, [True])
+
+class TestHMACCSRF(SessionFixture, unittest.TestCase):
+    factory_options = {'lazy': True, 'csrf': 'hmac', 'secret': 'seekrit'}
+
+    def test_requires_secret(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._makeFactory, secret=None)
+
+    def test_csrf_secret(self):
+        import hashlib
+        import hmac
+        factory = self._makeFactory(secret=None, csrf_secret='other')
+        self.assertEqual(factory._csrf_secret, b'other')
+        self.assertFalse('csrf_secret' in factory._options)
+        # tokens are signed with a key derived from the secret
+        self.assertEqual(factory._csrf_key, hmac.new(
+            b'other', b'pyramid_beaker.csrf_token', hashlib.sha256).digest())
+
+    def test_unknown_mode(self):
+        from pyramid.exceptions import ConfigurationError
+        from pyramid_beaker import BeakerSessionFactoryConfig
+        self.assertRaises(ConfigurationError, BeakerSessionFactoryConfig,
+                          csrf='random')
+
+    def test_token_does_not_create_session(self):
+        factory = self._makeFactory()
+        request, session = self._request(factory)
+        token = session.get_csrf_token()
+        self.assertEqual(session.get_csrf_token(), token)
+        self.assertFalse(session.accessed())
+        response = self._finish(request)
+        self.assertEqual(len(response.headerlist), 1)
+        name, value = response.headerlist[0]
+        self.assertEqual(name, 'Set-Cookie')
+        self.assertTrue(value.startswith('beaker.session.id.csrf='))
+        self.assertTrue('HttpOnly' in value)
+
+    def test_token_stable_across_requests(self):
+        factory = self._makeFactory()
+        request = DummyRequest()
+        token = factory(request).get_csrf_token()
+        cookie = self._cookie(self._finish(request))
+        request, session = self._request(factory, cookie)
+        self.assertEqual(session.get_csrf_token(), token)
+        self.assertTrue(session.check_csrf_token(token))
+        self.assertFalse(session.check_csrf_token(token[:-1] + 'x'))
+        self.assertFalse(session.check_csrf_token(None))
+        self.assertEqual(self._finish(request).headerlist, [])
+
+    def _token(self, factory, *cookies):
+        return self._load(factory, '; '.join(cookies)).get_csrf_token()
+
+    def test_token_bound_to_session(self):
+        factory = self._makeFactory()
+        nonce = 'beaker.session.id.csrf=' + 'a' * 32
+        victim = self._save(factory, a=1)
+        attacker = self._save(factory, a=1)
+        # a token for the attacker's session is useless with the victim's
+        self.assertNotEqual(self._token(factory, nonce, attacker),
+                            self._token(factory, nonce, victim))
+        self.assertNotEqual(self._token(factory, nonce),
+                            self._token(factory, nonce, victim))
+        self.assertEqual(self._token(factory, nonce, victim),
+                         self._token(factory, nonce, victim))
+
+    def test_token_bound_to_loaded_session(self):
+        factory = self._makeFactory()
+        nonce = 'beaker.session.id.csrf=' + 'a' * 32
+        cookie = self._save(factory, a=1)
+        request, session = self._request(factory, '; '.join([nonce, cookie]))
+        token = session.get_csrf_token()
+        self.assertFalse(session.accessed())
+        self.assertEqual(session['a'], 1)
+        self.assertEqual(session.get_csrf_token(), token)
+        # a session created by this request is bound to the id sent
+        request, session = self._request(factory, nonce)
+        session['a'] = 1
+        token = session.get_csrf_token()
+        cookie = self._cookie(self._finish(request))
+        self.assertEqual(self._token(factory, nonce, cookie), token)
+
+    def test_forged_session_cookie_ignored(self):
+        factory = self._makeFactory()
+        nonce = 'beaker.session.id.csrf=' + 'a' * 32
+        forged = 'beaker.session.id=' + '0' * 72
+        self.assertEqual(self._token(factory, nonce, forged),
+                         self._token(factory, nonce))
+
+    def test_cookie_session(self):
+        factory = self._makeFactory(type='cookie', validate_key='secret')
+        nonce = 'beaker.session.id.csrf=' + 'a' * 32
+        cookie = self._save(factory, a=1)
+        request, session = self._request(factory, '; '.join([nonce, cookie]))
+        token = session.get_csrf_token()
+        self.assertNotEqual(token, self._token(factory, nonce))
+        self.assertEqual(self._token(factory, nonce, cookie), token)
+        self.assertEqual(session.id, session['_id'])
+
+    def test_nonce_cookie_does_not_load_session(self):
+        factory = self._makeFactory()
+        request, session = self._request(
+            factory, 'beaker.session.id.csrf=' + 'a' * 32)
+        self.assertEqual(session.get('a', 'default'), 'default')
+        self.assertFalse('a' in session)
+        self.assertFalse(session.accessed())
+
+    def test_token_depends_on_secret(self):
+        request = DummyRequest()
+        request.environ['HTTP_COOKIE'] = 'beaker.session.id.csrf=' + 'a' * 32
+        one = self._makeFactory()(request).get_csrf_token()
+        two = self._makeFactory(secret='other')(request).get_csrf_token()
+        self.assertNotEqual(one, two)
+
+    def test_invalid_nonce_ignored(self):
+        factory = self._makeFactory()
+        request, session = self._request(factory, 'beaker.session.id.csrf=foo')
+        session.get_csrf_token()
+        self.assertEqual(len(self._finish(request).headerlist), 1)
+
+    def test_new_csrf_token_rotates(self):
+        factory = self._makeFactory()
+        request, session = self._request(
+            factory, 'beaker.session.id.csrf=' + 'a' * 32)
+        token = session.get_csrf_token()
+        new_token = session.new_csrf_token()
+        self.assertNotEqual(token, new_token)
+        self.assertEqual(session.get_csrf_token(), new_token)
+        self.assertFalse('_csrft_' in session)
+        response = self._finish(request)
+        self.assertEqual(len(response.headerlist), 1)
+
+    def test_cookie_attributes(self):
+        factory = self._makeFactory(cookie_path='/app', cookie_domain='.ex.com',
+                                    secure=True, csrf_cookie='csrf')
+        request = DummyRequest()
+        factory(request).get_csrf_token()
+        value = self._finish(request).headerlist[0][1]
+        self.assertTrue(value.startswith('csrf='))
+        self.assertTrue('Path=/app' in value)
+        self.assertTrue('Domain=.ex.com' in value)
+        self.assertTrue('secure' in value)
+
+    def test_constant_csrf_token(self):
+        factory = self._makeFactory(constant_csrf_token='FOO')
+        request, session = self._request(factory)
+        self.assertEqual(session.get_csrf_token(), 'FOO')
+        self.assertEqual(session.new_csrf_token(), 'FOO')
+        self.assertEqual(request.callbacks, [])
+
+class TestLazySession(unittest.TestCase):
     def _makeOne(self, request, **options):
         from pyramid_beaker import BeakerSessionFactoryConfig
-        return BeakerSessionFactoryConfig(**options)(request)
+        return BeakerSessionFactoryConfig(lazy=True, **options)(request)
 
-    def test_default_cookie_on_exception_setting(self):
+    def test_no_callback_until_accessed(self):
         request = DummyRequest()
         session = self._makeOne(request)
-        self.assertEqual(session._cookie_on_exception, True)
+        self.assertEqual(request.callbacks, [])
+        self.assertFalse(session.accessed())
 
-    def test_cookie_on_exception_setting(self):
+    def test_cookieless_reads_do_not_create_session(self):
         request = DummyRequest()
-        session = self._makeOne(request, cookie_on_exception=False)
-        self.assertEqual(session._cookie_on_exception, False)
+        session = self._makeOne(request)
+        self.assertEqual(session.get('a', 'default'), 'default')
+        self.assertFalse('a' in session)
+        self.assertRaises(KeyError, session.__getitem__, 'a')
+        self.assertTrue(session.new)
+        self.assertEqual(session.pop('a', 'default'), 'default')
+        self.assertEqual(session.peek_flash(), [])
+        self.assertEqual(session.pop_flash(), [])
+        self.assertFalse(session.accessed())
+        self.assertEqual(request.callbacks, [])
 
-    def _assert_session_persisted(self, request, session, expected):
-        # Checking response headers not likely best method of asserting
-        # if Beaker's SessionObject.persist method was called.
-        # Not sure of best method of doing this.
-        request.exception = True
-        session['use it'] = True
+    def test_cookie_parsed_once(self):
+        from beaker.cookie import SimpleCookie
+        from pyramid_beaker import BeakerSessionFactoryConfig
+        factory = BeakerSessionFactoryConfig(type='memory', lazy=True)
+        request = DummyRequest()
+        factory(request)['a'] = 1
         response = DummyResponse()
         request.callbacks[0](request, response)
-        self.assertEqual(len(response.headerlist) == 1, expected)
+        request = DummyRequest()
+        request.environ['HTTP_COOKIE'] = 'beaker.session.id.csrf=x; ' + (
+            response.headerlist[0][1].split(';')[0])
+        parsed = []
+        load = SimpleCookie.load
+        def counting_load(cookie, rawdata):
+            parsed.append(rawdata)
+            return load(cookie, rawdata)
+        SimpleCookie.load = counting_load
+        try:
+            self.assertEqual(factory(request)['a'], 1)
+        finally:
+            SimpleCookie.load = load
+        # only by Beaker
+        self.assertEqual(len(parsed), 1)
 
-    def test_request_call_back_without_cookie_on_exception(self):
+    def test_cookie_key_matched_exactly(self):
         request = DummyRequest()
         session = self._makeOne(request)
-        self._assert_session_persisted(request, session, True)
+        for cookie, present in [
+            ('beaker.session.id=1', True),
+            ('a=1; beaker.session.id=1', True),
+            ('a=1;beaker.session.id =1', True),
+            ('beaker.session.id.csrf=1', False),
+            ('xbeaker.session.id=1', False),
+            ('a=beaker.session.id', False)]:
+            request.environ['HTTP_COOKIE'] = cookie
+            self.assertEqual(session._session_cookie(), present, cookie)
 
-    def test_request_call_back_with_cookie_on_exception(self):
+    def test_beaker_keys_create_session(self):
         request = DummyRequest()
-        session = self._makeOne(request, cookie_on_exception=False)
-        self._assert_session_persisted(request, session, False)
+        session = self._makeOne(request)
+        self.assertTrue(session.get('_creation_time'))
+        self.assertTrue(session.accessed())
 
-class TestCacheConfiguration(unittest.TestCase):
-    def _set_settings(self):
-        return {'cache.regions':'default_term, second, short_term, long_term',
-                'cache.type':'memory',
-                'cache.second.expire':'1',
-                'cache.short_term.expire':'60',
-                'cache.default_term.expire':'300',
-                'cache.long_term.expire':'3600',
-                }
+    def test_write_registers_shared_callback(self):
+        from pyramid_beaker import _lazy_session_callback
+        request = DummyRequest()
+        session = self._makeOne(request)
+        session['a'] = 1
+        self.assertEqual(request.callbacks, [_lazy_session_callback])
+        response = DummyResponse()
+        request.callbacks[0](request, response)
+        self.assertEqual(response.headerlist[0][0], 'Set-Cookie')
+
+    def test_callback_registered_once(self):
+        request = DummyRequest()
+        session = self._makeOne(request)
+        session['a'] = 1
+        session['b'] = 2
+        self.assertEqual(len(request.callbacks), 1)
+
+    def test_session_cookie_present_loads_session(self):
+        request = DummyRequest()
+        request.environ['HTTP_COOKIE'] = 'beaker.session.id=abc'
+        session = self._makeOne(request)
+        self.assertEqual(session.get('a'), None)
+        self.assertTrue(session.accessed())
+        self.assertEqual(len(request.callbacks), 1)
+
+    def test_other_cookies_do_not_load_session(self):
+        request = DummyRequest()
+        request.environ['HTTP_COOKIE'] = 'foo=bar'
+        session = self._makeOne(request, key='mykey')
+        self.assertEqual(session.get('a'), None)
+        self.assertFalse(session.accessed())
+
+    def test_roundtrip(self):
+        from pyramid_beaker import BeakerSessionFactoryConfig
+        factory = BeakerSessionFactoryConfig(lazy=True)
+        request = DummyRequest()
+        session = factory(request)
+        session['a'] = 1
+        response = DummyResponse()
+        request.callbacks[0](request, response)
+        cookie = response.headerlist[0][1].split(';')[0]
+        request = DummyRequest()
+        request.environ['HTTP_COOKIE'] = cookie
+        session = factory(request)
+        self.assertEqual(session['a'], 1)
+        self.assertFalse(session.new)
+
+class TestCompressingSerializer(unittest.TestCase):
+    def _makeOne(self, threshold=100):
+        from beaker.util import PickleSerializer
+        from pyramid_beaker.serializers import CompressingSerializer
+        return CompressingSerializer(PickleSerializer(), threshold)
+
+    def test_small_payload_not_compressed(self):
+        serializer = self._makeOne()
+        self.assertEqual(serializer.dumps({'a': 1}),
+                         serializer.serializer.dumps({'a': 1}))
+
+    def test_large_payload_compressed(self):
+        serializer = self._makeOne()
+        data = {'a': 'x' * 1000}
+        payload = serializer.dumps(data)
+        self.assertTrue(payload.startswith(b'\x00Z'))
+        self.assertTrue(len(payload) < 100)
+        self.assertEqual(serializer.loads(payload), data)
+
+    def test_reads_uncompressed_payload(self):
+        import pickle
+        serializer = self._makeOne()
+        data = {'a': 'x' * 1000}
+        self.assertEqual(serializer.loads(pickle.dumps(data)), data)
+
+
+class TestSpillingSerializer(unittest.TestCase):
+    def setUp(self):
+        import beaker.cache
+        self.regions = beaker.cache.cache_regions
+        beaker.cache.cache_regions = {
+            'spill': {'type': 'memory', 'expire': 60}}
+
+    def tearDown(self):
+        import beaker.cache
+        beaker.cache.cache_regions = self.regions
+
+    def _makeOne(self, max_size=200):
+        from beaker.util import PickleSerializer
+        from pyramid_beaker.serializers import SpillingSerializer
+        return SpillingSerializer(PickleSerializer(), 'spill', max_size)
+
+    def test_small_payload_kept(self):
+        serializer = self._makeOne()
+        data = {'a': 1}
+        self.assertEqual(serializer.loads(serializer.dumps(data)), data)
+        self.assertEqual(serializer.stats['spilled'], 0)
+
+    def test_largest_value_spilled(self):
+        from pyramid_beaker.serializers import _SPILLED
+        serializer = self._makeOne()
+        data = {'_id': 'abc', 'small': 1, 'big': 'x' * 1000}
+        payload = serializer.dumps(data)
+        self.assertTrue(len(payload) <= 200)
+        self.assertEqual(serializer.stats['spilled'], 1)
+        loaded = serializer.loads(payload)
+        self.assertEqual(list(loaded.pop(_SPILLED)), ['big'])
+        self.assertEqual(loaded, data)
+
+    def _cache(self, serializer):
+        import beaker.cache
+        return beaker.cache.Cache._get_cache(
+            serializer.namespace, beaker.cache.cache_regions['spill'])
+
+    def _entries(self, serializer):
+        return self._cache(serializer).namespace.keys()
+
+    def test_unchanged_value_not_rewritten(self):
+        serializer = self._makeOne()
+        self._cache(serializer).clear()
+        data = {'_id': 'abc', 'small': 1, 'big': 'x' * 1000}
+        payload = serializer.dumps(data)
+        for i in range(5):
+            payload = serializer.dumps(serializer.loads(payload))
+        self.assertEqual(serializer.stats['spilled'], 1)
+        self.assertEqual(serializer.stats['reused'], 5)
+        self.assertEqual(len(self._entries(serializer)), 1)
+
+    def test_replaced_value_removed(self):
+        serializer = self._makeOne()
+        self._cache(serializer).clear()
+        payload = serializer.dumps({'_id': 'abc', 'big': 'x' * 1000})
+        data = serializer.loads(payload)
+        data['big'] = 'y' * 1000
+        payload = serializer.dumps(data)
+        self.assertEqual(serializer.stats['removed'], 1)
+        self.assertEqual(len(self._entries(serializer)), 1)
+        data = serializer.loads(payload)
+        self.assertEqual(data['big'], 'y' * 1000)
+        data['big'] = 'small'
+        serializer.dumps(data)
+        self.assertEqual(len(self._entries(serializer)), 0)
+
+    def test_stale_reference_rewritten(self):
+        from pyramid_beaker.serializers import _SPILLED
+        serializer = self._makeOne()
+        data = serializer.loads(serializer.dumps(
+            {'_id': 'abc', 'big': 'x' * 1000}))
+        ref, stored_at = data[_SPILLED]['big']
+        data[_SPILLED]['big'] = (ref, stored_at - 31)
+        serializer.dumps(data)
+        self.assertEqual(serializer.stats['spilled'], 2)
+        self.assertEqual(serializer.stats['removed'], 0)
+
+    def test_missing_spilled_value_dropped(self):
+        import beaker.cache
+        serializer = self._makeOne()
+        payload = serializer.dumps({'small': 1, 'big': 'x' * 1000})
+        beaker.cache.Cache._get_cache(
+            serializer.namespace, beaker.cache.cache_regions['spill']).clear()
+        self.assertEqual(serializer.loads(payload), {'small': 1})
+        self.assertEqual(serializer.stats['missing'], 1)
+
+
+class TestCookieSize(SessionFixture, unittest.TestCase):
+    factory_options = {'type': 'cookie', 'validate_key': 'secret'}
+
+    def setUp(self):
+        import beaker.cache
+        self.regions = beaker.cache.cache_regions
+        beaker.cache.cache_regions = {
+            'spill': {'type': 'memory', 'expire': 60}}
+
+    def tearDown(self):
+        import beaker.cache
+        beaker.cache.cache_regions = self.regions
+
+    def _respond(self, factory, **data):
+        request = self._request(factory, **data)[0]
+        return request, self._finish(request)
+
+    def test_compressed_roundtrip(self):
+        plain = self._makeFactory()
+        compressed = self._makeFactory(compress_threshold=100)
+        _, plain_response = self._respond(plain, a='x' * 1000)
+        _, response = self._respond(compressed, a='x' * 1000)
+        self.assertTrue(len(response.headerlist[0][1]) <
+                        len(plain_response.headerlist[0][1]))
+        session = self._load(compressed, self._cookie(response))
+        self.assertEqual(session['a'], 'x' * 1000)
+
+    def test_compressed_reads_uncompressed_cookie(self):
+        plain = self._makeFactory()
+        compressed = self._makeFactory(compress_threshold=100)
+        _, response = self._respond(plain, a='x' * 1000)
+        session = self._load(compressed, self._cookie(response))
+        self.assertEqual(session['a'], 'x' * 1000)
+
+    def test_cookie_size_recorded(self):
+        factory = self._makeFactory()
+        request, response = self._respond(factory, a=1)
+        size = len(response.headerlist[0][1])
+        self.assertEqual(request.environ['pyramid_beaker.cookie_bytes'], size)
+        self.assertEqual(factory.write_stats['cookies'], 1)
+        self.assertEqual(factory.write_stats['cookie_bytes'], size)
+
+    def test_overflow_raise(self):
+        from pyramid_beaker import CookieTooLargeError
+        factory = self._makeFactory(cookie_max_size=500)
+        self.assertRaises(CookieTooLargeError, self._respond, factory,
+                          a='x' * 1000)
+
+    def test_overflow_log(self):
+        factory = self._makeFactory(cookie_max_size=500, cookie_overflow='log')
+        request, response = self._respond(factory, a='x' * 1000)
+        self.assertEqual(response.headerlist, [])
+        self.assertEqual(factory.write_stats['cookies_dropped'], 1)
+
+    def test_beaker_limit_log(self):
+        factory = self._makeFactory(cookie_overflow='log')
+        request, response = self._respond(factory, a='x' * 5000)
+        self.assertEqual(response.headerlist, [])
+        self.assertEqual(factory.write_stats['cookies_dropped'], 1)
+
+    def test_beaker_limit_raise(self):
+        from beaker.exceptions import BeakerException
+        factory = self._makeFactory()
+        self.assertRaises(BeakerException, self._respond, factory,
+                          a='x' * 5000)
+
+    def test_overflow_spill(self):
+        factory = self._makeFactory(cookie_max_size=1000,
+                                    cookie_overflow='spill',
+                                    cookie_spill_region='spill')
+        request, response = self._respond(factory, a=1, big='x' * 5000)
+        self.assertTrue(len(response.headerlist[0][1]) <= 1000)
+        session = self._load(factory, self._cookie(response))
+        self.assertEqual(session['big'], 'x' * 5000)
+        self.assertEqual(session['a'], 1)
+
+    def test_spill_requires_region(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._makeFactory,
+                          cookie_max_size=1000, cookie_overflow='spill')
+
+    def test_unknown_overflow_policy(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._makeFactory,
+                          cookie_overflow='truncate')
+
+class TestTieredSession(SessionFixture, unittest.TestCase):
+    factory_options = {'tiered': True}
+
+    def test_load_from_l1(self):
+        factory = self._makeFactory()
+        cookie = self._save(factory, a=1)
+        self.assertEqual(self._load(factory, cookie)['a'], 1)
+        self.assertEqual(factory.session_cache.stats['hits'], 1)
+        self.assertEqual(factory.session_cache.stats['stale'], 0)
+
+    def test_l1_copies_are_independent(self):
+        factory = self._makeFactory()
+        cookie = self._save(factory, a=[1])
+        self._load(factory, cookie)['a'].append(2)
+        self.assertEqual(self._load(factory, cookie)['a'], [1])
+
+    def test_write_in_other_process_invalidates(self):
+        factory = self._makeFactory()
+        other = self._makeFactory()
+        cookie = self._save(factory, a=1)
+        self._save(other, cookie, a=2)
+        self.assertEqual(self._load(factory, cookie)['a'], 2)
+        self.assertEqual(factory.session_cache.stats['stale'], 1)
+
+    def test_missing_stamp_reads_backend(self):
+        from pyramid_beaker import BeakerSessionFactoryConfig
+        factory = self._makeFactory()
+        cookie = self._save(BeakerSessionFactoryConfig(type='memory'), a=1)
+        self.assertEqual(self._load(factory, cookie)['a'], 1)
+        self.assertEqual(factory.session_cache.stats['hits'], 0)
+
+    def test_interleaved_saves_agree(self):
+        from beaker.container import MemoryNamespaceManager
+        from pyramid_beaker.tiered import STAMP_KEY
+        factory = self._makeFactory()
+        other = self._makeFactory()
+        cookie = self._save(factory, a=0)
+        self._load(other, cookie)['a']
+        setitem = MemoryNamespaceManager.__setitem__
+        def interleaved(namespace, key, value):
+            if key == STAMP_KEY:
+                # the other process saves between this payload and stamp
+                MemoryNamespaceManager.__setitem__ = setitem
+                self._save(other, cookie, a=2)
+            setitem(namespace, key, value)
+        MemoryNamespaceManager.__setitem__ = interleaved
+        try:
+            self._save(factory, cookie, a=1)
+        finally:
+            MemoryNamespaceManager.__setitem__ = setitem
+        self.assertEqual(self._load(factory, cookie)['a'], 1)
+        self.assertEqual(self._load(other, cookie)['a'], 1)
+        # the payload of the other save is left to expire
+        session_id = cookie.split('=')[1]
+        self.assertEqual(
+            len(MemoryNamespaceManager.namespaces[session_id]), 3)
+
+    def test_delete(self):
+        factory = self._makeFactory()
+        cookie = self._save(factory, a=1)
+        request, session = self._request(factory, cookie)
+        session.delete()
+        self._finish(request)
+        self.assertEqual(self._load(factory, cookie).get('a'), None)
+
+    def test_namespace_removal_forgets(self):
+        factory = self._makeFactory()
+        cookie = self._save(factory, a=1)
+        session = self._load(factory, cookie)
+        session['a']
+        session.__dict__['_sess'].namespace.remove()
+        self.assertEqual(len(factory.session_cache), 0)
+        self.assertEqual(self._load(factory, cookie).get('a'), None)
+
+    def test_max_items(self):
+        factory = self._makeFactory(tiered_max_items=1)
+        self._save(factory, a=1)
+        self._save(factory, a=2)
+        self.assertEqual(len(factory.session_cache), 1)
+
+    def test_not_tiered(self):
+        from pyramid_beaker import BeakerSessionFactoryConfig
+        self.assertEqual(BeakerSessionFactoryConfig().session_cache, None)
+
+    def test_cookie_type(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._makeFactory,
+                          type='cookie', validate_key='secret')
+
+    def test_open_resource_backend(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._makeFactory,
+                          type='file', data_dir='/tmp')
+
+class TestOptimisticSession(SessionFixture, unittest.TestCase):
+    factory_options = {'optimistic': True}
+
+    def _begin(self, factory, cookie):
+        request, session = self._request(factory, cookie)
+        session.accessed()
+        return request, session
+
+    def test_version(self):
+        factory = self._makeFactory()
+        cookie = self._save(factory, a=1)
+        session = self._load(factory, cookie)
+        self.assertEqual(session['_version'], 1)
+        self.assertEqual(session['_key_versions'], {'a': 1})
+
+    def test_disjoint_keys_merged(self):
+        factory = self._makeFactory()
+        cookie = self._save(factory, a=1, b=1)
+        first, first_session = self._begin(factory, cookie)
+        second, second_session = self._begin(factory, cookie)
+        first_session['a'] = 2
+        second_session['b'] = 2
+        self._finish(first)
+        self._finish(second)
+        session = self._load(factory, cookie)
+        self.assertEqual((session['a'], session['b']), (2, 2))
+        self.assertEqual(factory.write_stats['merges'], 1)
+
+    def test_deletion_merged(self):
+        factory = self._makeFactory()
+        cookie = self._save(factory, a=1, b=1)
+        first, first_session = self._begin(factory, cookie)
+        second, second_session = self._begin(factory, cookie)
+        first_session['a'] = 2
+        del second_session['b']
+        self._finish(first)
+        self._finish(second)
+        session = self._load(factory, cookie)
+        self.assertEqual(session['a'], 2)
+        self.assertFalse('b' in session)
+
+    def test_same_key_conflict(self):
+        from pyramid_beaker import SessionConflictError
+        factory = self._makeFactory()
+        cookie = self._save(factory, a=1)
+        first, first_session = self._begin(factory, cookie)
+        second, second_session = self._begin(factory, cookie)
+        first_session['a'] = 2
+        second_session['a'] = 3
+        self._finish(first)
+        try:
+            self._finish(second)
+        except SessionConflictError as e:
+            self.assertEqual(e.keys, ['a'])
+        else: # pragma: no cover
+            self.fail('SessionConflictError not raised')
+        self.assertEqual(self._load(factory, cookie)['a'], 2)
+        self.assertEqual(factory.write_stats['conflicts'], 1)
+
+    def test_same_value_no_conflict(self):
+        factory = self._makeFactory()
+        cookie = self._save(factory, a=1)
+        first, first_session = self._begin(factory, cookie)
+        second, second_session = self._begin(factory, cookie)
+        first_session['a'] = 2
+        second_session['a'] = 2
+        self._finish(first)
+        self._finish(second)
+        self.assertEqual(self._load(factory, cookie)['a'], 2)
+
+    def test_accessed_only_does_not_clobber(self):
+        factory = self._makeFactory()
+        cookie = self._save(factory, a=1)
+        first, first_session = self._begin(factory, cookie)
+        second, second_session = self._begin(factory, cookie)
+        first_session['a'] = 2
+        self._finish(first)
+        self._finish(second)
+        self.assertEqual(self._load(factory, cookie)['a'], 2)
+
+    def test_forced_save_conflicts(self):
+        from pyramid_beaker import SessionConflictError
+        factory = self._makeFactory()
+        cookie = self._save(factory, a=1)
+        first, first_session = self._begin(factory, cookie)
+        second, second_session = self._begin(factory, cookie)
+        first_session['a'] = 2
+        second_session.changed()
+        self._finish(first)
+        self.assertRaises(SessionConflictError, self._finish, second)
+
+    def test_file_backend(self):
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        try:
+            factory = self._makeFactory(type='file', data_dir=tmpdir)
+            cookie = self._save(factory, a=1, b=1)
+            first, first_session = self._begin(factory, cookie)
+            second, second_session = self._begin(factory, cookie)
+            first_session['a'] = 2
+            second_session['b'] = 2
+            self._finish(first)
+            self._finish(second)
+            session = self._load(factory, cookie)
+            self.assertEqual((session['a'], session['b']), (2, 2))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_readonly_methods(self):
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        try:
+            factory = self._makeFactory(type='file', data_dir=tmpdir,
+                                        readonly_methods='GET')
+            cookie = self._save(factory, a=1)
+            request, session = self._request(factory, cookie, 'GET')
+            self.assertEqual(session['a'], 1)
+            self._finish(request)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_cookie_type(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._makeFactory,
+                          type='cookie', validate_key='secret')
+
+    def test_write_behind(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._makeFactory,
+                          write_behind=True)
+
+    def test_memcached_requires_lock_dir(self):
+        import tempfile
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._makeFactory,
+                          type='ext:memcached', url='127.0.0.1:11211')
+        self._makeFactory(type='ext:memcached', url='127.0.0.1:11211',
+                          lock_dir=tempfile.gettempdir())
+
+class TestPrincipalIndex(SessionFixture, unittest.TestCase):
+    factory_options = {'principal_key': 'userid'}
+
+    def setUp(self):
+        from beaker.container import MemoryNamespaceManager
+        MemoryNamespaceManager.namespaces.clear()
+
+    def _commit(self, factory, request):
+        response = self._finish(request)
+        factory.principal_index.queue.flush()
+        return self._cookie(response)
+
+    def _login(self, factory, principal):
+        request, session = self._request(factory, userid=principal)
+        return session.id, self._commit(factory, request)
+
+    def test_login_indexed(self):
+        factory = self._makeFactory()
+        first = self._login(factory, 'fred')[0]
+        second = self._login(factory, 'fred')[0]
+        self._login(factory, 'barney')
+        self.assertEqual(factory.principal_index.session_ids('fred'),
+                         sorted([first, second]))
+
+    def test_unchanged_principal_not_rewritten(self):
+        factory = self._makeFactory()
+        session_id, cookie = self._login(factory, 'fred')
+        request, session = self._request(factory, cookie, a=1)
+        self._commit(factory, request)
+        self.assertEqual(factory.principal_index.stats['added'], 1)
+
+    def test_refresh(self):
+        from pyramid_beaker.principals import INDEX_KEY
+        factory = self._makeFactory(timeout=100)
+        session_id, cookie = self._login(factory, 'fred')
+        request, session = self._request(factory, cookie)
+        session[INDEX_KEY] = ('fred', session[INDEX_KEY][1] - 60)
+        self._commit(factory, request)
+        self.assertEqual(factory.principal_index.stats['added'], 2)
+
+    def test_logout(self):
+        factory = self._makeFactory()
+        session_id, cookie = self._login(factory, 'fred')
+        request, session = self._request(factory, cookie)
+        del session['userid']
+        self._commit(factory, request)
+        self.assertEqual(factory.principal_index.session_ids('fred'), [])
+
+    def test_regenerated_id(self):
+        factory = self._makeFactory()
+        session_id, cookie = self._login(factory, 'fred')
+        request, session = self._request(factory, cookie)
+        session.invalidate()
+        session['userid'] = 'fred'
+        self._commit(factory, request)
+        self.assertEqual(factory.principal_index.session_ids('fred'),
+                         [session.id])
+
+    def test_invalidate_sessions_for(self):
+        factory = self._makeFactory()
+        fred_id, fred_cookie = self._login(factory, 'fred')
+        self._login(factory, 'fred')
+        barney_id, barney_cookie = self._login(factory, 'barney')
+        self.assertEqual(factory.invalidate_sessions_for('fred'), 2)
+        self.assertEqual(factory.principal_index.session_ids('fred'), [])
+        self.assertEqual(
+            self._load(factory, fred_cookie).get('userid'), None)
+        self.assertEqual(
+            self._load(factory, barney_cookie).get('userid'), 'barney')
+
+    def test_session_saved_after_invalidation(self):
+        factory = self._makeFactory()
+        session_id, cookie = self._login(factory, 'bob')
+        request, session = self._request(factory, cookie)
+        self.assertEqual(session['userid'], 'bob')
+        self.assertEqual(factory.invalidate_sessions_for('bob'), 1)
+        # the request which loaded the session before saves it again
+        session['a'] = 1
+        self.assertEqual(self._commit(factory, request), None)
+        request, session = self._request(factory, cookie)
+        self.assertEqual(session.get('userid'), None)
+        self.assertNotEqual(session.id, session_id)
+        self.assertEqual(factory.principal_index.stats['rejected'], 1)
+        # the next login is valid again
+        session_id, cookie = self._login(factory, 'bob')
+        request, session = self._request(factory, cookie)
+        self.assertEqual(session['userid'], 'bob')
+        self.assertEqual(factory.invalidate_sessions_for('bob'), 1)
+
+    def test_refresh_keeps_generation(self):
+        from pyramid_beaker.principals import INDEX_KEY
+        factory = self._makeFactory(timeout=100)
+        session_id, cookie = self._login(factory, 'bob')
+        request, session = self._request(factory, cookie)
+        entry = session[INDEX_KEY]
+        factory.invalidate_sessions_for('bob')
+        session[INDEX_KEY] = (entry[0], entry[1] - 60, entry[2])
+        self._commit(factory, request)
+        self.assertEqual(factory.principal_index.stats['added'], 2)
+        request, session = self._request(factory, cookie)
+        self.assertEqual(session.get('userid'), None)
+
+    def test_invalidate_sessions_for_file(self):
+        import shutil
+        import tempfile
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir)
+        factory = self._makeFactory(type='file', data_dir=data_dir)
+        cookies = [self._login(factory, 'bob')[1] for i in range(3)]
+        self.assertEqual(factory.invalidate_sessions_for('bob'), 3)
+        self.assertEqual(factory.principal_index.stats['invalidated'], 3)
+        for cookie in cookies:
+            self.assertEqual(
+                self._load(factory, cookie).get('userid'), None)
+
+    def test_invalidate_sessions_for_request(self):
+        from pyramid import testing
+        from pyramid_beaker import invalidate_sessions_for
+        factory = self._makeFactory()
+        self._login(factory, 'fred')
+        config = testing.setUp()
+        try:
+            config.set_session_factory(factory)
+            request = testing.DummyRequest()
+            self.assertEqual(invalidate_sessions_for(request, 'fred'), 1)
+        finally:
+            testing.tearDown()
+
+    def test_expired_sessions_pruned(self):
+        from beaker.container import MemoryNamespaceManager
+        from pyramid_beaker import principals
+        factory = self._makeFactory()
+        session_id = self._login(factory, 'fred')[0]
+        del MemoryNamespaceManager.namespaces[session_id]['session']
+        grace = principals._PRUNE_GRACE
+        principals._PRUNE_GRACE = -1
+        try:
+            other = self._login(factory, 'fred')[0]
+        finally:
+            principals._PRUNE_GRACE = grace
+        self.assertEqual(factory.principal_index.session_ids('fred'),
+                         [other])
+        self.assertEqual(factory.principal_index.stats['pruned'], 1)
+
+    def test_not_configured(self):
+        from pyramid.exceptions import ConfigurationError
+        from pyramid_beaker import BeakerSessionFactoryConfig
+        factory = BeakerSessionFactoryConfig()
+        self.assertEqual(factory.principal_index, None)
+        self.assertRaises(ConfigurationError,
+                          factory.invalidate_sessions_for, 'fred')
+
+    def test_cookie_type(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._makeFactory,
+                          type='cookie', validate_key='secret')
+
+    def test_write_behind_queue_shared(self):
+        factory = self._makeFactory(write_behind=True)
+        self.assertTrue(factory.principal_index.queue is factory.write_behind)
+
+class TestSplitSession(SessionFixture, unittest.TestCase):
+    factory_options = {'split_threshold': 200}
+
+    def setUp(self):
+        from beaker.container import MemoryNamespaceManager
+        MemoryNamespaceManager.namespaces.clear()
+
+    def _stored(self, session_id):
+        from beaker.container import MemoryNamespaceManager
+        from beaker.util import PickleSerializer
+        import base64
+        payload = MemoryNamespaceManager.namespaces[session_id]['session']
+        return PickleSerializer().loads(base64.b64decode(payload))
+
+    def _save_id(self, factory, **data):
+        cookie = self._save(factory, **data)
+        return cookie, cookie.split('=', 1)[1]
+
+    def test_large_values_stored_apart(self):
+        from pyramid_beaker.split import placeholder
+        factory = self._makeFactory()
+        cookie, session_id = self._save_id(factory, userid='fred',
+                                        wizard='x' * 1000)
+        stored = self._stored(session_id)
+        self.assertEqual(stored['userid'], 'fred')
+        name, stored_at = placeholder(stored['wizard'])
+        self.assertTrue(name.startswith(session_id + '-split-'))
+        self.assertEqual(factory.split_store.stats['stored'], 1)
+
+    def test_lazy_load(self):
+        factory = self._makeFactory()
+        cookie = self._save(factory, userid='fred', wizard='x' * 1000)
+        stats = factory.split_store.stats
+        request, session = self._request(factory, cookie)
+        self.assertEqual(session['userid'], 'fred')
+        self.assertEqual(stats['loaded'], 0)
+        self.assertEqual(session['wizard'], 'x' * 1000)
+        self.assertEqual(session.get('wizard'), 'x' * 1000)
+        self.assertEqual(dict(session.items())['wizard'], 'x' * 1000)
+        self.assertEqual(stats['loaded'], 1)
+
+    def test_unchanged_value_not_rewritten(self):
+        factory = self._makeFactory()
+        cookie = self._save(factory, userid='fred', wizard='x' * 1000)
+        request, session = self._request(factory, cookie)
+        session['wizard']
+        session['userid'] = 'barney'
+        self._finish(request)
+        self.assertEqual(factory.split_store.stats['stored'], 1)
+        request, session = self._request(factory, cookie)
+        self.assertEqual((session['userid'], session['wizard']),
+                         ('barney', 'x' * 1000))
+
+    def test_changed_in_place(self):
+        factory = self._makeFactory()
+        cookie = self._save(factory, rows=['x' * 100] * 10)
+        request, session = self._request(factory, cookie)
+        session['rows'].append('y')
+        session.changed()
+        self._finish(request)
+        self.assertEqual(factory.split_store.stats['stored'], 2)
+        request, session = self._request(factory, cookie)
+        self.assertEqual(session['rows'][-1], 'y')
+
+    def test_flash(self):
+        factory = self._makeFactory()
+        cookie = self._save(factory, _f_=['x' * 1000])
+        request, session = self._request(factory, cookie)
+        session.flash('y')
+        self._finish(request)
+        request, session = self._request(factory, cookie)
+        self.assertEqual(session.pop_flash(), ['x' * 1000, 'y'])
+
+    def test_removed_and_shrunk(self):
+        from beaker.container import MemoryNamespaceManager
+        factory = self._makeFactory()
+        cookie, session_id = self._save_id(factory, a='x' * 1000, b='y' * 1000)
+        names = [name for name in MemoryNamespaceManager.namespaces.dict
+                 if name.startswith(session_id + '-split-')]
+        self.assertEqual(len(names), 2)
+        request, session = self._request(factory, cookie)
+        del session['a']
+        session['b'] = 'small'
+        self._finish(request)
+        self.assertEqual(factory.split_store.stats['removed'], 2)
+        for name in names:
+            self.assertFalse(
+                'value' in MemoryNamespaceManager.namespaces[name])
+        self.assertEqual(self._stored(session_id)['b'], 'small')
+
+    def test_refresh(self):
+        from pyramid_beaker.split import SPLIT_KEY
+        from pyramid_beaker.split import placeholder
+        factory = self._makeFactory(timeout=600)
+        cookie, session_id = self._save_id(factory, wizard='x' * 1000)
+        request, session = self._request(factory, cookie)
+        # entries older than the timeout are rewritten by any save
+        sess = session._session()
+        name, stored_at = placeholder(sess['wizard'])
+        sess['wizard'] = sess.accessed_dict['wizard'] = {
+            SPLIT_KEY: [name, stored_at - 700]}
+        self._finish(request)
+        self.assertEqual(factory.split_store.stats['refreshed'], 1)
+        self.assertTrue(
+            placeholder(self._stored(session_id)['wizard'])[1] >= stored_at)
+
+    def test_missing(self):
+        from beaker.container import MemoryNamespaceManager
+        factory = self._makeFactory()
+        cookie, session_id = self._save_id(factory, wizard='x' * 1000)
+        for name in list(MemoryNamespaceManager.namespaces.dict):
+            if name.startswith(session_id + '-split-'):
+                MemoryNamespaceManager.namespaces[name].clear()
+        request, session = self._request(factory, cookie)
+        self.assertEqual(session.get('wizard', 'gone'), 'gone')
+        self.assertRaises(KeyError, session.__getitem__, 'wizard')
+        self.assertFalse('wizard' in session)
+        self.assertEqual(factory.split_store.stats['missing'], 1)
+
+    def test_write_behind(self):
+        factory = self._makeFactory(write_behind=True)
+        cookie = self._save(factory, wizard='x' * 1000)
+        factory.write_behind.flush()
+        request, session = self._request(factory, cookie)
+        self.assertEqual(session['wizard'], 'x' * 1000)
+
+    def test_cookie_sessions_refused(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._makeFactory,
+                          type='cookie', validate_key='secret')
+
+    def test_optimistic_refused(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._makeFactory,
+                          optimistic=True)
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        import beaker.cache
+        from pyramid_beaker.instrumentation import MemorySink
+        from pyramid_beaker.instrumentation import add_sink
+        self.regions = beaker.cache.cache_regions
+        beaker.cache.cache_regions = {
+            'short_term': {'type': 'memory', 'expire': 60}}
+        self.sink = MemorySink()
+        add_sink(self.sink)
+
+    def tearDown(self):
+        import beaker.cache
+        from pyramid_beaker.instrumentation import remove_sink
+        beaker.cache.cache_regions = self.regions
+        remove_sink(self.sink)
+
+    def _names(self):
+        return [event.name for event in self.sink.events]
+
+    def test_session_events(self):
+        from pyramid_beaker import BeakerSessionFactoryConfig
+        factory = BeakerSessionFactoryConfig(
+            type='cookie', validate_key='secret', instrument=True)
+        request = DummyRequest()
+        factory(request)['a'] = 1
+        response = DummyResponse()
+        request.callbacks[0](request, response)
+        self.assertEqual(self._names(), ['session.load', 'session.serialize',
+                                         'session.persist', 'session.cookie'])
+        self.assertEqual(self.sink.events[-1].size,
+                         len(response.headerlist[0][1]))
+        self.sink.clear()
+        request = DummyRequest()
+        request.environ['HTTP_COOKIE'] = response.headerlist[0][1]
+        factory(request)['a']
+        self.assertEqual(self._names()[0], 'session.deserialize')
+        self.assertEqual(self._names()[-1], 'session.load')
+        self.assertTrue(self.sink.events[0].size > 0)
+
+    def test_session_not_instrumented(self):
+        from pyramid_beaker import BeakerSessionFactoryConfig
+        factory = BeakerSessionFactoryConfig(type='cookie',
+                                             validate_key='secret')
+        request = DummyRequest()
+        factory(request)['a'] = 1
+        request.callbacks[0](request, DummyResponse())
+        self.assertEqual(self.sink.events, [])
+
+    def test_cache_events(self):
+        from pyramid_beaker.regions import get_cache
+        cache = get_cache('short_term', 'instrumented')
+        cache.clear()
+        cache.get('a', createfunc=lambda: 1)
+        cache.get('a', createfunc=lambda: 1)
+        self.assertRaises(KeyError, cache.get, 'b')
+        cache.put('b', 2)
+        cache.get_multi(['a', 'c'])
+        self.assertEqual(self._names(), ['cache.regenerate', 'cache.miss',
+                                         'cache.hit', 'cache.miss',
+                                         'cache.set', 'cache.get_multi'])
+        event = self.sink.events[-1]
+        self.assertEqual(event.tags, {'region': 'short_term',
+                                      'namespace': 'instrumented',
+                                      'hits': 1, 'misses': 1})
+
+    def test_failing_sink(self):
+        from pyramid_beaker.instrumentation import add_sink
+        from pyramid_beaker.instrumentation import emit
+        from pyramid_beaker.instrumentation import remove_sink
+        def sink(event):
+            raise ValueError
+        add_sink(sink)
+        try:
+            emit('test')
+        finally:
+            remove_sink(sink)
+        self.assertEqual(self._names(), ['test'])
+
+    def test_tween_totals(self):
+        from pyramid_beaker.instrumentation import emit
+        from pyramid_beaker.instrumentation import instrumentation_tween_factory
+        def handler(request):
+            emit('session.load', 0.5)
+            emit('session.serialize', 0.25, 100)
+            emit('session.serialize', 0.25, 50)
+            return 'response'
+        tween = instrumentation_tween_factory(handler, None)
+        request = DummyRequest()
+        request.finished_callbacks = []
+        request.add_finished_callback = request.finished_callbacks.append
+        self.assertEqual(tween(request), 'response')
+        emit('session.persist', 0.5)
+        request.finished_callbacks[0](request)
+        emit('session.load', 0.5)
+        self.assertEqual(request.environ['pyramid_beaker.metrics'], {
+            'session.load': {'count': 1, 'duration': 0.5, 'size': 0},
+            'session.serialize': {'count': 2, 'duration': 0.5, 'size': 150},
+            'session.persist': {'count': 1, 'duration': 0.5, 'size': 0},
+            })
+
+    def test_logging_sink(self):
+        import logging
+        from pyramid_beaker.instrumentation import Event
+        from pyramid_beaker.instrumentation import LoggingSink
+        records = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+        logger = logging.getLogger('pyramid_beaker.tests.instrumentation')
+        logger.addHandler(Handler())
+        LoggingSink(logger, logging.WARNING)(Event('session.load', 0.5))
+        self.assertEqual(records, ['session.load duration=0.5 size=None {}'])
+
+    def test_statsd_sink(self):
+        from pyramid_beaker.instrumentation import Event
+        from pyramid_beaker.instrumentation import StatsdSink
+        sink = StatsdSink(prefix='app')
+        sent = []
+        class DummySocket(object):
+            def sendto(self, data, address):
+                sent.append((data, address))
+        sink.socket = DummySocket()
+        sink(Event('session.serialize', 0.002, 120))
+        self.assertEqual(sent, [(b'app.session.serialize:1|c\n'
+                                 b'app.session.serialize.time:2.000|ms\n'
+                                 b'app.session.serialize.size:120|h',
+                                 ('127.0.0.1', 8125))])
+
+    def test_includeme_adds_tween(self):
+        from pyramid import testing
+        from pyramid.interfaces import ITweens
+        from pyramid_beaker import includeme
+        config = testing.setUp(settings={'session.instrument': 'true'})
+        try:
+            includeme(config)
+            config.commit()
+            tweens = config.registry.getUtility(ITweens)
+            self.assertTrue(
+                'pyramid_beaker.instrumentation.instrumentation_tween_factory'
+                in [name for name, factory in tweens.implicit()])
+        finally:
+            testing.tearDown()
+
+    def test_sinks_from_settings(self):
+        from pyramid_beaker.instrumentation import LoggingSink
+        from pyramid_beaker.instrumentation import MemorySink
+        from pyramid_beaker.instrumentation import StatsdSink
+        from pyramid_beaker.instrumentation import sinks_from_settings
+        sinks = sinks_from_settings({
+            'pyramid_beaker.sinks':
+                'logging statsd '
+                'pyramid_beaker.instrumentation.MemorySink',
+            'pyramid_beaker.statsd_port': '9125'})
+        self.assertTrue(isinstance(sinks[0], LoggingSink))
+        self.assertTrue(isinstance(sinks[1], StatsdSink))
+        self.assertEqual(sinks[1].address, ('127.0.0.1', 9125))
+        self.assertTrue(isinstance(sinks[2], MemorySink))
+
+class Test_session_factory_from_settings(unittest.TestCase):
+    def _callFUT(self, settings):
+        from pyramid_beaker import session_factory_from_settings
+        return session_factory_from_settings(settings)
+
+    def test_it(self):
+        settings = {'session.auto':'true', 'session.key':'foo'}
+        factory = self._callFUT(settings)
+        self.assertEqual(factory._options, {'auto':True, 'key':'foo'})
+
+    def test_cookie_on_exception_true(self):
+        settings = {'session.cookie_on_exception':'true'}
+        factory = self._callFUT(settings)
+        self.assertEqual(factory._cookie_on_exception, True)
+
+    def test_cookie_on_exception_false(self):
+        settings = {'session.cookie_on_exception':'false'}
+        factory = self._callFUT(settings)
+        self.assertEqual(factory._cookie_on_exception, False)
+
+    def test_constant_csrf_token_set(self):
+        settings = {'session.constant_csrf_token':'foo'}
+        factory = self._callFUT(settings)
+        self.assertEqual(factory._constant_csrf_token, 'foo')
+
+    def test_constant_csrf_token_unset(self):
+        settings = {}
+        factory = self._callFUT(settings)
+        self.assertEqual(factory._constant_csrf_token, False)
+
+    def test_serializer(self):
+        from pyramid_beaker.serializers import FallbackSerializer
+        from pyramid_beaker.serializers import JSONSerializer
+        settings = {'session.serializer':'json'}
+        factory = self._callFUT(settings)
+        serializer = factory._options['data_serializer']
+        self.assertTrue(isinstance(serializer, FallbackSerializer))
+        self.assertTrue(isinstance(serializer.serializer, JSONSerializer))
+
+    def test_serializer_no_fallback(self):
+        from pyramid_beaker.serializers import JSONSerializer
+        settings = {'session.serializer':'json',
+                    'session.serializer_fallback':'none'}
+        factory = self._callFUT(settings)
+        serializer = factory._options['data_serializer']
+        self.assertTrue(isinstance(serializer, JSONSerializer))
+
+    def test_write_behind(self):
+        settings = {'session.write_behind':'true',
+                    'session.write_behind_workers':'3',
+                    'session.write_behind_queue_size':'10',
+                    'session.write_behind_policy':'block'}
+        factory = self._callFUT(settings)
+        self.assertEqual(factory.write_behind.workers, 3)
+        self.assertEqual(factory.write_behind.queue_size, 10)
+        self.assertEqual(factory.write_behind.policy, 'block')
+        self.assertEqual(factory._options, {})
+
+    def test_write_behind_unset(self):
+        factory = self._callFUT({})
+        self.assertEqual(factory.write_behind, None)
+
+    def test_touch_interval(self):
+        settings = {'session.touch_interval':'60'}
+        factory = self._callFUT(settings)
+        self.assertEqual(factory._touch_interval, 60)
+
+    def test_readonly_methods(self):
+        settings = {'session.readonly_methods':'get\nhead options'}
+        factory = self._callFUT(settings)
+        self.assertEqual(factory._readonly_methods,
+                         frozenset(['GET', 'HEAD', 'OPTIONS']))
+
+    def test_csrf_hmac(self):
+        settings = {'session.csrf':'hmac', 'session.secret':'seekrit'}
+        factory = self._callFUT(settings)
+        self.assertEqual(factory._csrf, 'hmac')
+        self.assertEqual(factory._csrf_secret, b'seekrit')
+        self.assertEqual(factory._options, {'secret':'seekrit'})
+
+    def test_lazy(self):
+        settings = {'session.lazy':'true'}
+        factory = self._callFUT(settings)
+        self.assertEqual(factory._lazy, True)
+        self.assertEqual(factory._options, {})
+
+    def test_tiered(self):
+        settings = {'session.tiered':'true',
+                    'session.tiered_max_items':'10'}
+        factory = self._callFUT(settings)
+        self.assertEqual(factory.session_cache.max_items, 10)
+        self.assertEqual(factory._options['namespace_class'].l1,
+                         factory.session_cache)
+
+    def test_principal_key(self):
+        settings = {'session.principal_key':'userid'}
+        factory = self._callFUT(settings)
+        self.assertEqual(factory._principal_key, 'userid')
+        self.assertNotEqual(factory.principal_index, None)
+
+    def test_split_threshold(self):
+        settings = {'session.split_threshold':'4096'}
+        factory = self._callFUT(settings)
+        self.assertEqual(factory.split_store.threshold, 4096)
+
+    def test_optimistic(self):
+        settings = {'session.optimistic':'true'}
+        factory = self._callFUT(settings)
+        self.assertEqual(factory._optimistic, True)
+        self.assertTrue(
+            factory._options['namespace_class'].__name__.startswith(
+                'LockFree'))
+
+    def test_cookie_size(self):
+        from pyramid_beaker.serializers import CompressingSerializer
+        settings = {'session.compress_threshold':'512',
+                    'session.compress_level':'9',
+                    'session.cookie_max_size':'4000',
+                    'session.cookie_overflow':'log'}
+        factory = self._callFUT(settings)
+        serializer = factory._options['data_serializer']
+        self.assertTrue(isinstance(serializer, CompressingSerializer))
+        self.assertEqual(serializer.threshold, 512)
+        self.assertEqual(serializer.level, 9)
+        self.assertEqual(factory._cookie_max_size, 4000)
+        self.assertEqual(factory._cookie_overflow, 'log')
+
+
+class DummySecurityPolicy(object):
+    def identity(self, request):
+        return request.headers.get('X-User')
+
+    def authenticated_userid(self, request):
+        return self.identity(request)
+
+    def permits(self, request, context, permission):
+        return True
+
+    def remember(self, request, userid, **kw):
+        return []
+
+    def forget(self, request, **kw):
+        return []
+
+class Test_session_cookie_on_exception(unittest.TestCase):
+
+    def _makeOne(self, request, **options):
+        from pyramid_beaker import BeakerSessionFactoryConfig
+        return BeakerSessionFactoryConfig(**options)(request)
+
+    def test_default_cookie_on_exception_setting(self):
+        request = DummyRequest()
+        session = self._makeOne(request)
+        self.assertEqual(session._cookie_on_exception, True)
+
+    def test_cookie_on_exception_setting(self):
+        request = DummyRequest()
+        session = self._makeOne(request, cookie_on_exception=False)
+        self.assertEqual(session._cookie_on_exception, False)
+
+    def _assert_session_persisted(self, request, session, expected):
+        # Checking response headers not likely best method of asserting
+        # if Beaker's SessionObject.persist method was called.
+        # Not sure of best method of doing this.
+        request.exception = True
+        session['use it'] = True
+        response = DummyResponse()
+        request.callbacks[0](request, response)
+        self.assertEqual(len(response.headerlist) == 1, expected)
+
+    def test_request_call_back_without_cookie_on_exception(self):
+        request = DummyRequest()
+        session = self._makeOne(request)
+        self._assert_session_persisted(request, session, True)
+
+    def test_request_call_back_with_cookie_on_exception(self):
+        request = DummyRequest()
+        session = self._makeOne(request, cookie_on_exception=False)
+        self._assert_session_persisted(request, session, False)
+
+class TestLRUDict(unittest.TestCase):
+    def _makeOne(self, max_items=None, max_bytes=None):
+        from pyramid_beaker.memory import LRUDict
+        return LRUDict(max_items, max_bytes)
+
+    def test_evicts_least_recently_used(self):
+        d = self._makeOne(max_items=2)
+        d['a'] = 1
+        d['b'] = 2
+        d['a']
+        d['c'] = 3
+        self.assertEqual(sorted(d.keys()), ['a', 'c'])
+        self.assertEqual(d.stats['evictions'], 1)
+
+    def test_max_bytes(self):
+        d = self._makeOne(max_bytes=250)
+        d['a'] = 'x' * 100
+        d['b'] = 'x' * 100
+        d['c'] = 'x' * 100
+        self.assertEqual(sorted(d.keys()), ['b', 'c'])
+        self.assertTrue(d.size <= 250)
+
+    def test_oversized_value_not_stored(self):
+        d = self._makeOne(max_bytes=50)
+        d['a'] = 1
+        d['b'] = 'x' * 100
+        self.assertEqual(d.keys(), ['a'])
+        self.assertEqual(d.stats['evictions'], 1)
+
+    def test_threads(self):
+        import threading
+        d = self._makeOne(max_items=50)
+        def work(n):
+            for i in range(500):
+                d[(n, i % 80)] = i
+                try:
+                    d[(n, (i * 7) % 80)]
+                except KeyError:
+                    pass
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(d), 50)
+
+    def test_replace_updates_size(self):
+        d = self._makeOne(max_bytes=1000)
+        d['a'] = 'x' * 100
+        size = d.size
+        d['a'] = 'x' * 10
+        self.assertTrue(d.size < size)
+        self.assertEqual(len(d), 1)
+
+    def test_hits_and_misses(self):
+        d = self._makeOne()
+        d['a'] = 1
+        self.assertEqual(d['a'], 1)
+        self.assertRaises(KeyError, d.__getitem__, 'b')
+        self.assertEqual(d.stats, {'hits': 1, 'misses': 1, 'evictions': 0})
+
+    def test_delete_and_clear(self):
+        d = self._makeOne(max_bytes=1000)
+        d['a'] = 1
+        d['b'] = 2
+        del d['a']
+        self.assertFalse('a' in d)
+        d.clear()
+        self.assertEqual(len(d), 0)
+        self.assertEqual(d.size, 0)
+
+class TestLFUDict(TestLRUDict):
+    def _makeOne(self, max_items=None, max_bytes=None):
+        from pyramid_beaker.memory import LFUDict
+        return LFUDict(max_items, max_bytes)
+
+    def test_evicts_least_frequently_used(self):
+        d = self._makeOne(max_items=2)
+        d['a'] = 1
+        d['b'] = 2
+        d['a']
+        d['a']
+        d['b']
+        d['c'] = 3
+        d['c']
+        d['c']
+        d['c']
+        d['d'] = 4
+        self.assertEqual(sorted(d.keys()), ['c', 'd'])
+        self.assertEqual(d.stats['evictions'], 2)
+
+class TestBoundedMemoryNamespaceManager(unittest.TestCase):
+    def setUp(self):
+        import beaker.cache
+        self.regions = beaker.cache.cache_regions
+
+    def tearDown(self):
+        import beaker.cache
+        from pyramid_beaker.memory import BoundedMemoryNamespaceManager
+        beaker.cache.cache_regions = self.regions
+        BoundedMemoryNamespaceManager.namespaces.clear()
+
+    def test_region(self):
+        import beaker.cache
+        from pyramid_beaker import set_cache_regions_from_settings
+        from pyramid_beaker.memory import cache_stats
+        beaker.cache.cache_regions = {}
+        set_cache_regions_from_settings({
+            'cache.regions': 'short_term',
+            'cache.short_term.type': 'bounded_memory',
+            'cache.short_term.expire': '60',
+            'cache.short_term.max_items': '2',
+            'cache.short_term.eviction': 'lfu',
+            })
+        cache = beaker.cache.Cache._get_cache(
+            'bounded_test', beaker.cache.cache_regions['short_term'])
+        for key in 'abc':
+            cache.put(key, key.upper())
+        self.assertEqual(cache.get('c'), 'C')
+        self.assertRaises(KeyError, cache.get, 'a')
+        stats = cache_stats()['bounded_test']
+        self.assertEqual(stats['items'], 2)
+        self.assertEqual(stats['evictions'], 1)
+
+    def test_unknown_eviction_policy(self):
+        from pyramid_beaker.memory import BoundedMemoryNamespaceManager
+        self.assertRaises(ValueError, BoundedMemoryNamespaceManager,
+                          'bounded_test', eviction='random')
+
+class TestStaleTTL(unittest.TestCase):
+    def setUp(self):
+        import beaker.cache
+        self.regions = beaker.cache.cache_regions
+        beaker.cache.cache_regions = {
+            'short_term': {'type': 'memory', 'expire': 10, 'stale_ttl': 30}}
+
+    def tearDown(self):
+        import beaker.cache
+        beaker.cache.cache_regions = self.regions
+
+    def _getCache(self):
+        from pyramid_beaker.regions import get_cache
+        cache = get_cache('short_term', 'stale_test')
+        cache.clear()
+        return cache
+
+    def _store(self, cache, value, age):
+        import time
+        cache._get_value('key').set_value(value, time.time() - age)
+
+    def test_fresh_value(self):
+        cache = self._getCache()
+        self._store(cache, 'old', 5)
+        self.assertEqual(cache.get('key', createfunc=lambda: 'new'), 'old')
+
+    def test_stale_value_served_while_regenerating(self):
+        import threading
+        cache = self._getCache()
+        self._store(cache, 'old', 20)
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+        def regenerate():
+            started.set()
+            release.wait(5)
+            return 'new'
+        def worker():
+            results.append(cache.get('key', createfunc=regenerate))
+        thread = threading.Thread(target=worker)
+        thread.start()
+        started.wait(5)
+        calls = []
+        value = cache.get('key', createfunc=lambda: calls.append(1) or 'other')
+        release.set()
+        thread.join()
+        self.assertEqual(value, 'old')
+        self.assertEqual(calls, [])
+        self.assertEqual(results, ['new'])
+        self.assertEqual(cache.get('key'), 'new')
+
+    def test_expired_grace_regenerates(self):
+        cache = self._getCache()
+        self._store(cache, 'old', 60)
+        self.assertEqual(cache.get('key', createfunc=lambda: 'new'), 'new')
+
+    def test_expired_grace_without_createfunc(self):
+        cache = self._getCache()
+        self._store(cache, 'old', 60)
+        self.assertRaises(KeyError, cache.get, 'key')
+        self.assertFalse('key' in cache)
+
+    def test_no_stale_ttl(self):
+        import beaker.cache
+        from pyramid_beaker.regions import get_cache
+        beaker.cache.cache_regions['short_term'] = {
+            'type': 'memory', 'expire': 10}
+        cache = get_cache('short_term', 'stale_test')
+        self.assertEqual(cache.stale_ttl, 0)
+        cache.put('key', 'value')
+        self.assertEqual(cache.get('key'), 'value')
+
+    def test_backend_expiry_includes_grace(self):
+        from pyramid_beaker.regions import RegionCache
+        cache = RegionCache('stale_test', type='memory', expire=10,
+                            stale_ttl=30)
+        calls = []
+        def set_value(key, value, expiretime=None):
+            calls.append(expiretime)
+        cache.namespace.set_value = set_value
+        cache.put('key', 'value')
+        self.assertEqual(calls, [40])
+
+    def test_unknown_region(self):
+        from beaker.exceptions import BeakerException
+        from pyramid_beaker.regions import get_cache
+        self.assertRaises(BeakerException, get_cache, 'missing', 'ns')
+
+    def test_cache_region_decorator(self):
+        from pyramid_beaker.regions import cache_region
+        calls = []
+        @cache_region('short_term', 'load')
+        def load(a, b=1):
+            calls.append((a, b))
+            return a + b
+        self.assertEqual(load(1, b=2), 3)
+        self.assertEqual(load(1, b=2), 3)
+        self.assertEqual(load(2), 3)
+        self.assertEqual(calls, [(1, 2), (2, 1)])
+
+    def test_cache_region_decorator_disabled(self):
+        import beaker.cache
+        from pyramid_beaker.regions import cache_region
+        beaker.cache.cache_regions['short_term']['enabled'] = False
+        calls = []
+        @cache_region('short_term')
+        def load(a):
+            calls.append(a)
+            return a
+        load(1)
+        load(1)
+        self.assertEqual(calls, [1, 1])
+
+class TestMultiKey(unittest.TestCase):
+    def setUp(self):
+        import beaker.cache
+        self.regions = beaker.cache.cache_regions
+        beaker.cache.cache_regions = {
+            'short_term': {'type': 'memory', 'expire': 60}}
+
+    def tearDown(self):
+        import beaker.cache
+        beaker.cache.cache_regions = self.regions
+
+    def _getCache(self):
+        from pyramid_beaker.regions import get_cache
+        cache = get_cache('short_term', 'multi_test')
+        cache.clear()
+        return cache
+
+    def test_fallback_loop(self):
+        cache = self._getCache()
+        cache.set_multi({'a': 1, 'b': 2})
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get_multi(['a', 'b', 'c']), {'a': 1, 'b': 2})
+        cache.delete_multi(['a', 'c'])
+        self.assertEqual(cache.get_multi(['a', 'b']), {'b': 2})
+
+    def test_native(self):
+        from pyramid_beaker import regions
+        cache = self._getCache()
+        client = DummyMultiClient()
+        class DummyNamespace(object):
+            pass
+        cache.namespace = namespace = DummyNamespace()
+        namespace.namespace = 'multi_test'
+        namespace._format_key = lambda key: 'ns_' + key.decode('ascii')
+        namespace.mc = client
+        multi_backends = regions.multi_backends
+        regions.multi_backends = [(DummyNamespace, regions.MemcachedMulti)]
+        try:
+            cache.set_multi({'a': 1, 'b': 2})
+            self.assertEqual(client.calls, [('set_multi', 60)])
+            self.assertEqual(sorted(client.data), ['ns_a', 'ns_b'])
+            self.assertEqual(cache.get_multi(['a', 'b', 'c']),
+                             {'a': 1, 'b': 2})
+            cache.delete_multi(['a'])
+            self.assertEqual(cache.get_multi(['a', 'b']), {'b': 2})
+            stored, expire, value = client.data['ns_b']
+            client.data['ns_b'] = (stored - 120, expire, value)
+            self.assertEqual(cache.get_multi(['b']), {})
+            self.assertEqual([call[0] for call in client.calls],
+                             ['set_multi', 'get_multi', 'delete_multi',
+                              'get_multi', 'get_multi'])
+        finally:
+            regions.multi_backends = multi_backends
+
+    def test_cache_region_multi(self):
+        from pyramid_beaker.regions import cache_region_multi
+        calls = []
+        @cache_region_multi('short_term', 'square')
+        def square(numbers, offset=0):
+            calls.append(list(numbers))
+            return dict((n, n * n + offset) for n in numbers if n != 3)
+        self.assertEqual(square([1, 2]), {1: 1, 2: 4})
+        self.assertEqual(square([2, 3, 4]), {2: 4, 4: 16})
+        self.assertEqual(square([2, 3], offset=1), {2: 5})
+        self.assertEqual(calls, [[1, 2], [3, 4], [2, 3]])
+
+    def test_cache_region_multi_method(self):
+        from pyramid_beaker.regions import cache_region_multi
+        calls = []
+        class Loader(object):
+            @cache_region_multi('short_term')
+            def load(self, ids):
+                calls.append(ids)
+                return dict((i, str(i)) for i in ids)
+        self.assertEqual(Loader().load([1, 2]), {1: '1', 2: '2'})
+        self.assertEqual(Loader().load([1, 2]), {1: '1', 2: '2'})
+        self.assertEqual(calls, [[1, 2]])
+
+class DummyMultiClient(object):
+    def __init__(self):
+        self.data = {}
+        self.calls = []
+
+    def get_multi(self, keys):
+        self.calls.append(('get_multi', None))
+        return dict((key, self.data[key]) for key in keys if key in self.data)
+
+    def set_multi(self, mapping, time=0):
+        self.calls.append(('set_multi', time))
+        self.data.update(mapping)
+
+    def delete_multi(self, keys):
+        self.calls.append(('delete_multi', None))
+        for key in keys:
+            self.data.pop(key, None)
+
+class TestRequestCache(unittest.TestCase):
+    def setUp(self):
+        import beaker.cache
+        self.regions = beaker.cache.cache_regions
+        beaker.cache.cache_regions = {
+            'short_term': {'type': 'memory', 'expire': 60}}
+
+    def tearDown(self):
+        import beaker.cache
+        beaker.cache.cache_regions = self.regions
+
+    def _makeRequest(self):
+        request = DummyRequest()
+        request.finished_callbacks = []
+        request.add_finished_callback = request.finished_callbacks.append
+        return request
+
+    def _callFUT(self, request):
+        from pyramid_beaker.regions import region_cache
+        cache = region_cache(request, 'short_term', 'request_test')
+        return cache
+
+    def test_repeat_reads_return_same_object(self):
+        request = self._makeRequest()
+        cache = self._callFUT(request)
+        cache.cache.clear()
+        cache.cache.put('a', {'x': 1})
+        calls = []
+        get = cache.cache.get
+        cache.cache.get = lambda key, **kw: calls.append(key) or get(key, **kw)
+        try:
+            first = cache.get('a')
+            self.assertTrue(cache['a'] is first)
+        finally:
+            del cache.cache.get
+        self.assertEqual(calls, ['a'])
+
+    def test_write_through(self):
+        from pyramid_beaker.regions import get_cache
+        request = self._makeRequest()
+        cache = self._callFUT(request)
+        cache['a'] = 1
+        cache.set_multi({'b': 2, 'c': 3})
+        shared = get_cache('short_term', 'request_test')
+        self.assertEqual(shared.get_multi(['a', 'b', 'c']),
+                         {'a': 1, 'b': 2, 'c': 3})
+        del cache['a']
+        cache.delete_multi(['b'])
+        self.assertFalse('a' in shared)
+        self.assertRaises(KeyError, cache.get, 'a')
+        self.assertEqual(cache.get_multi(['a', 'b', 'c']), {'c': 3})
+
+    def test_shared_per_request(self):
+        request = self._makeRequest()
+        cache = self._callFUT(request)
+        self.assertTrue(self._callFUT(request) is cache)
+        self.assertFalse(self._callFUT(self._makeRequest()) is cache)
+        self.assertEqual(len(request.finished_callbacks), 1)
+
+    def test_discarded_at_request_end(self):
+        request = self._makeRequest()
+        cache = self._callFUT(request)
+        request.finished_callbacks[0](request)
+        self.assertFalse(self._callFUT(request) is cache)
+
+    def test_includeme_adds_request_method(self):
+        from pyramid import testing
+        from pyramid.interfaces import IRequestExtensions
+        from pyramid_beaker import includeme
+        config = testing.setUp(settings={})
+        try:
+            includeme(config)
+            config.commit()
+            extensions = config.registry.getUtility(IRequestExtensions)
+            self.assertTrue('region_cache' in extensions.methods)
+        finally:
+            testing.tearDown()
+
+class TestTags(unittest.TestCase):
+    def setUp(self):
+        import beaker.cache
+        from pyramid_beaker import regions
+        self.regions = beaker.cache.cache_regions
+        beaker.cache.cache_regions = {
+            'short_term': {'type': 'memory', 'expire': 60},
+            'long_term': {'type': 'memory', 'expire': 3600},
+            'tags': {'type': 'memory', 'expire': None}}
+        regions.set_tag_region('tags')
+        for region in beaker.cache.cache_regions:
+            regions.get_cache(region, 'tag_test').clear()
+        regions.get_cache('tags', regions._TAG_NAMESPACE).clear()
+
+    def tearDown(self):
+        import beaker.cache
+        from pyramid import testing
+        from pyramid_beaker import regions
+        beaker.cache.cache_regions = self.regions
+        regions.set_tag_region(None)
+        testing.tearDown()
+
+    def _cache(self, region):
+        from pyramid_beaker.regions import get_cache
+        return get_cache(region, 'tag_test')
+
+    def test_invalidate_across_regions(self):
+        from pyramid_beaker.regions import invalidate_tags
+        short_term = self._cache('short_term')
+        long_term = self._cache('long_term')
+        short_term.put('a', 1, tags=['product:42'])
+        long_term.put('b', 2, tags=['product:42', 'catalog'])
+        long_term.put('c', 3, tags=['product:43'])
+        self.assertEqual(short_term.get('a'), 1)
+        self.assertEqual(long_term.get('b'), 2)
+        invalidate_tags('product:42')
+        self.assertRaises(KeyError, short_term.get, 'a')
+        self.assertRaises(KeyError, long_term.get, 'b')
+        self.assertEqual(long_term.get('c'), 3)
+
+    def test_regenerated_after_invalidation(self):
+        from pyramid_beaker.regions import invalidate_tags
+        cache = self._cache('short_term')
+        calls = []
+        def create():
+            calls.append(1)
+            return len(calls)
+        self.assertEqual(cache.get('a', createfunc=create, tags=['t']), 1)
+        self.assertEqual(cache.get('a', createfunc=create, tags=['t']), 1)
+        invalidate_tags('t')
+        self.assertEqual(cache.get('a', createfunc=create, tags=['t']), 2)
+
+    def test_untagged_values(self):
+        cache = self._cache('short_term')
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+
+    def test_get_multi(self):
+        from pyramid_beaker.regions import invalidate_tags
+        cache = self._cache('short_term')
+        cache.set_multi({'a': 1, 'b': 2}, tags=['x'])
+        cache.put('c', 3, tags=['y'])
+        cache.put('d', 4)
+        self.assertEqual(cache.get_multi(['a', 'b', 'c', 'd']),
+                         {'a': 1, 'b': 2, 'c': 3, 'd': 4})
+        invalidate_tags('x')
+        self.assertEqual(cache.get_multi(['a', 'b', 'c', 'd']),
+                         {'c': 3, 'd': 4})
+
+    def test_evicted_generation_is_stale(self):
+        from pyramid_beaker import regions
+        cache = self._cache('short_term')
+        cache.put('a', 1, tags=['t'])
+        regions.get_cache('tags', regions._TAG_NAMESPACE).clear()
+        self.assertRaises(KeyError, cache.get, 'a')
+
+    def test_generations_read_once_per_request(self):
+        from pyramid import testing
+        from pyramid_beaker import regions
+        cache = self._cache('short_term')
+        cache.put('a', 1, tags=['t', 'u'])
+        generations = regions.get_cache('tags', regions._TAG_NAMESPACE)
+        calls = []
+        get_multi = generations.get_multi
+        generations.get_multi = lambda keys: (calls.append(sorted(keys))
+                                              or get_multi(keys))
+        try:
+            testing.setUp(request=testing.DummyRequest())
+            cache.get('a')
+            cache.get('a')
+            regions.invalidate_tags('t')
+            self.assertRaises(KeyError, cache.get, 'a')
+        finally:
+            del generations.get_multi
+        self.assertEqual(calls, [['t', 'u']])
+
+    def test_cache_region_tags(self):
+        from pyramid_beaker.regions import cache_region
+        from pyramid_beaker.regions import invalidate_tags
+        calls = []
+        @cache_region('short_term', tags=lambda id: ['product:%s' % id])
+        def load_tagged_product(id):
+            calls.append(id)
+            return id
+        load = load_tagged_product
+        load(1)
+        load(1)
+        load(2)
+        invalidate_tags('product:1')
+        load(1)
+        load(2)
+        self.assertEqual(calls, [1, 2, 1])
+
+    def test_cache_region_unknown_option(self):
+        from pyramid_beaker.regions import cache_region
+        self.assertRaises(TypeError, cache_region, 'short_term', tag=['x'])
+
+    def test_without_tag_region(self):
+        from pyramid.exceptions import ConfigurationError
+        from pyramid_beaker import regions
+        regions.set_tag_region(None)
+        cache = self._cache('short_term')
+        self.assertRaises(ConfigurationError, cache.put, 'a', 1, tags=['t'])
+        self.assertRaises(ConfigurationError, regions.invalidate_tags, 't')
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+
+class TestSingleFlight(unittest.TestCase):
+    def _makeOne(self):
+        from pyramid_beaker.singleflight import SingleFlight
+        return SingleFlight()
+
+    def _run(self, count, target):
+        import threading
+        threads = [threading.Thread(target=target) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def test_concurrent_calls_coalesced(self):
+        import threading
+        import time
+        flights = self._makeOne()
+        release = threading.Event()
+        calls = []
+        results = []
+        def compute():
+            calls.append(1)
+            release.wait(5)
+            return 42
+        def call():
+            results.append(flights.do('key', compute))
+        threads = self._run(1, call)
+        while not calls:
+            pass
+        threads += self._run(4, call)
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [(42, False)] * 4 + [(42, True)])
+        self.assertEqual(flights.stats['leaders'], 1)
+        self.assertEqual(flights.stats['followers'], 4)
+        self.assertEqual(len(flights), 0)
+
+    def test_exception_shared(self):
+        import threading
+        import time
+        flights = self._makeOne()
+        release = threading.Event()
+        errors = []
+        def compute():
+            release.wait(5)
+            raise ValueError('boom')
+        def call():
+            try:
+                flights.do('key', compute)
+            except ValueError as e:
+                errors.append(e)
+        threads = self._run(1, call)
+        while not len(flights):
+            pass
+        threads += self._run(2, call)
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 3)
+        self.assertTrue(errors[0] is errors[1] is errors[2])
+        self.assertEqual(len(flights), 0)
+
+    def test_timeout(self):
+        import threading
+        flights = self._makeOne()
+        release = threading.Event()
+        def compute():
+            release.wait(5)
+            return 1
+        threads = self._run(1, lambda: flights.do('key', compute))
+        while not len(flights):
+            pass
+        try:
+            self.assertEqual(flights.do('key', lambda: 2, timeout=0.01),
+                             (2, True))
+        finally:
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(flights.stats['timeouts'], 1)
+
+    def test_distinct_keys(self):
+        flights = self._makeOne()
+        self.assertEqual(flights.do('a', lambda: 1), (1, True))
+        self.assertEqual(flights.do('b', lambda: 2), (2, True))
+        self.assertEqual(flights.stats['leaders'], 2)
+
+class TestSingleFlightRegion(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        import shutil
+        import beaker.cache
+        self.regions = beaker.cache.cache_regions
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        beaker.cache.cache_regions = {
+            'short_term': {'type': 'memory', 'expire': 60,
+                           'singleflight': True},
+            'file_term': {'type': 'file', 'expire': 60,
+                          'data_dir': self.data_dir,
+                          'lock_dir': self.data_dir,
+                          'singleflight': True},
+            'timeout_term': {'type': 'memory', 'expire': 60,
+                             'singleflight': True,
+                             'singleflight_timeout': 0.1},
+            }
+
+    def tearDown(self):
+        import beaker.cache
+        beaker.cache.cache_regions = self.regions
+
+    def _concurrent_gets(self, region, create, count=4):
+        import threading
+        import time
+        from pyramid_beaker.regions import get_cache
+        cache = get_cache(region, 'singleflight_test')
+        cache.clear()
+        results = []
+        def get():
+            results.append(cache.get('key', createfunc=create))
+        threads = [threading.Thread(target=get) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        return cache, threads, results
+
+    def _test_create_once(self, region):
+        import threading
+        from pyramid_beaker.regions import flights
+        followers = flights.stats['followers']
+        release = threading.Event()
+        calls = []
+        def create():
+            calls.append(1)
+            release.wait(5)
+            return 'value'
+        cache, threads, results = self._concurrent_gets(region, create)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['value'] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flights.stats['followers'] - followers, 3)
+        self.assertEqual(cache.get('key'), 'value')
+
+    def test_concurrent_misses_create_once(self):
+        self._test_create_once('short_term')
+
+    def test_concurrent_misses_create_once_file(self):
+        self._test_create_once('file_term')
+
+    def test_timeout(self):
+        import threading
+        import time
+        from pyramid_beaker.regions import flights
+        timeouts = flights.stats['timeouts']
+        release = threading.Event()
+        calls = []
+        def create():
+            calls.append(1)
+            if len(calls) == 1:
+                release.wait(5)
+            return len(calls)
+        cache, threads, results = self._concurrent_gets(
+            'timeout_term', create, count=2)
+        start = time.time()
+        threads[1].join(2)
+        # the follower did not wait for the leader's creation lock
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(results, [2])
+        self.assertEqual(flights.stats['timeouts'] - timeouts, 1)
+        release.set()
+        threads[0].join()
+
+    def test_stale_bypasses_flight(self):
+        import beaker.cache
+        from pyramid_beaker.regions import flights
+        from pyramid_beaker.regions import get_cache
+        beaker.cache.cache_regions['short_term']['stale_ttl'] = 60
+        cache = get_cache('short_term', 'singleflight_test')
+        cache.put('key', 1, expiretime=-1)
+        leaders = flights.stats['leaders']
+        self.assertEqual(cache.get('key', createfunc=lambda: 2), 2)
+        self.assertEqual(flights.stats['leaders'], leaders)
+
+    def test_hit(self):
+        from pyramid_beaker.regions import get_cache
+        cache = get_cache('short_term', 'singleflight_test')
+        cache.put('key', 1)
+        self.assertEqual(cache.get('key', createfunc=lambda: 2), 1)
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        import beaker.cache
+        self.regions = beaker.cache.cache_regions
+
+    def tearDown(self):
+        import beaker.cache
+        beaker.cache.cache_regions = self.regions
+
+    def _makeApp(self, view=None, **options):
+        from pyramid.config import Configurator
+        from pyramid_beaker.regions import get_cache
+        from pyramid_beaker.viewcache import _NAMESPACE
+        config = Configurator(settings={
+            'session.type': 'memory',
+            'cache.regions': 'views',
+            'cache.type': 'memory',
+            'cache.views.expire': '60'})
+        config.include('pyramid_beaker')
+        config.set_security_policy(DummySecurityPolicy())
+        self.calls = []
+        def page(request):
+            self.calls.append(request.path_info)
+            request.response.text = u'page %s %s' % (
+                request.matchdict['id'], request.GET.get('q', ''))
+            return request.response
+        view = view or page
+        options.setdefault('response_cache', 'views')
+        config.add_route('page', '/page/{id}')
+        config.add_view(view, route_name='page', **options)
+        get_cache('views', '%s:%s.%s' % (
+            _NAMESPACE, view.__module__, view.__name__)).clear()
+        return config.make_wsgi_app()
+
+    def _get(self, app, path, **kw):
+        from webob import Request
+        request = Request.blank(path, **kw)
+        return request.get_response(app), request.environ
+
+    def test_hit(self):
+        app = self._makeApp()
+        first, environ = self._get(app, '/page/1')
+        self.assertEqual(environ['pyramid_beaker.response_cache'], 'miss')
+        second, environ = self._get(app, '/page/1')
+        self.assertEqual(environ['pyramid_beaker.response_cache'], 'hit')
+        self.assertEqual(second.body, first.body)
+        self.assertEqual(second.etag, first.etag)
+        self.assertEqual(second.content_type, 'text/html')
+        self.assertEqual(self.calls, ['/page/1'])
+
+    def test_vary(self):
+        app = self._makeApp()
+        self._get(app, '/page/1')
+        self._get(app, '/page/2')
+        self._get(app, '/page/1?q=x')
+        self._get(app, '/page/1?q=x')
+        self.assertEqual(self.calls, ['/page/1', '/page/2', '/page/1'])
+
+    def test_vary_header(self):
+        app = self._makeApp(response_cache_vary='route header:Accept-Language')
+        self._get(app, '/page/1', headers={'Accept-Language': 'en'})
+        self._get(app, '/page/2', headers={'Accept-Language': 'en'})
+        self._get(app, '/page/1', headers={'Accept-Language': 'fr'})
+        self.assertEqual(self.calls, ['/page/1', '/page/1'])
+
+    def test_not_modified(self):
+        app = self._makeApp()
+        first = self._get(app, '/page/1')[0]
+        headers = {'If-None-Match': first.headers['ETag']}
+        response = self._get(app, '/page/1', headers=headers)[0]
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.etag, first.etag)
+        self.assertEqual(response.body, b'')
+        self.assertEqual(self.calls, ['/page/1'])
+
+    def test_not_modified_on_miss(self):
+        app = self._makeApp()
+        etag = self._get(app, '/page/1')[0].headers['ETag']
+        self._makeApp()
+        response = self._get(app, '/page/1',
+                             headers={'If-None-Match': etag})[0]
+        self.assertEqual(response.status_int, 304)
+
+    def test_post_not_cached(self):
+        app = self._makeApp()
+        self._get(app, '/page/1', method='POST')
+        self._get(app, '/page/1', method='POST')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_uncacheable_responses(self):
+        def not_found(request):
+            self.calls.append(1)
+            request.response.status = 404
+            return request.response
+        def cookie(request):
+            self.calls.append(1)
+            request.response.set_cookie('a', 'b')
+            return request.response
+        def no_store(request):
+            self.calls.append(1)
+            request.response.cache_control.no_store = True
+            return request.response
+        for view in (not_found, cookie, no_store):
+            app = self._makeApp(view)
+            self._get(app, '/page/1')
+            self._get(app, '/page/1')
+            self.assertEqual(len(self.calls), 2)
+
+    def test_session_not_cached(self):
+        def token(request):
+            self.calls.append(1)
+            request.response.text = request.session.get_csrf_token()
+            return request.response
+        app = self._makeApp(token)
+        first, environ = self._get(app, '/page/1')
+        second, environ = self._get(app, '/page/1')
+        self.assertEqual(environ['pyramid_beaker.response_cache'], 'miss')
+        self.assertNotEqual(second.body, first.body)
+        self.assertTrue('Set-Cookie' in second.headers)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_response_callbacks_not_cached(self):
+        def callback(request):
+            self.calls.append(1)
+            request.add_response_callback(lambda request, response: None)
+            return request.response
+        app = self._makeApp(callback)
+        self._get(app, '/page/1')
+        self._get(app, '/page/1')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_vary_principal_by_default(self):
+        def user(request):
+            self.calls.append(1)
+            request.response.text = u'hello %s' % request.authenticated_userid
+            return request.response
+        app = self._makeApp(user)
+        self._get(app, '/page/1', headers={'X-User': 'fred'})
+        response = self._get(app, '/page/1', headers={'X-User': 'barney'})[0]
+        self.assertEqual(response.text, u'hello barney')
+        response = self._get(app, '/page/1', headers={'X-User': 'fred'})[0]
+        self.assertEqual(response.text, u'hello fred')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_authenticated_not_cached_without_principal(self):
+        app = self._makeApp(response_cache_vary='route matchdict')
+        self._get(app, '/page/1', headers={'X-User': 'fred'})
+        self._get(app, '/page/1', headers={'X-User': 'fred'})
+        self._get(app, '/page/1')
+        environ = self._get(app, '/page/1')[1]
+        self.assertEqual(environ['pyramid_beaker.response_cache'], 'hit')
+        self.assertEqual(len(self.calls), 3)
+
+    def test_not_configured(self):
+        from pyramid_beaker.viewcache import response_cache_view
+        class Info(object):
+            options = {}
+        view = object()
+        self.assertTrue(response_cache_view(view, Info()) is view)
+
+    def test_unknown_vary(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._makeApp,
+                          response_cache_vary=['cookie'])
+
+class TestSweeper(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _makeOne(self, **kw):
+        from pyramid_beaker.sweeper import Sweeper
+        return Sweeper(**kw)
+
+    def _save_session(self, **options):
+        from pyramid_beaker import BeakerSessionFactoryConfig
+        options.setdefault('type', 'file')
+        options.setdefault('data_dir', self.tmpdir + '/sessions')
+        factory = BeakerSessionFactoryConfig(**options)
+        request = DummyRequest()
+        session = factory(request)
+        session['a'] = 1
+        request.callbacks[0](request, DummyResponse())
+        return session.id
+
+    def _files(self, root):
+        import os
+        result = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            result.extend(os.path.join(dirpath, name) for name in filenames)
+        return result
+
+    def _age(self, paths, seconds=3600):
+        import os
+        import time
+        for path in paths:
+            then = time.time() - seconds
+            os.utime(path, (then, then))
+
+    def test_expired_sessions_removed(self):
+        self._save_session()
+        old = self._files(self.tmpdir + '/sessions/container_file')
+        self._age(old)
+        self._save_session()
+        sweeper = self._makeOne()
+        sweeper.add_sessions(self.tmpdir + '/sessions', 600)
+        stats = sweeper.sweep()
+        self.assertEqual(stats['sessions'], 1)
+        # two session files and their two lock files
+        self.assertEqual(stats['scanned'], 4)
+        self.assertTrue(stats['bytes'] > 0)
+        remaining = self._files(self.tmpdir + '/sessions/container_file')
+        self.assertEqual(len(remaining), 1)
+        self.assertFalse(old[0] in remaining)
+        # the lock file of the removed session goes with it
+        self.assertEqual(stats['locks'], 1)
+        self.assertEqual(
+            len(self._files(self.tmpdir + '/sessions/container_file_lock')),
+            1)
+
+    def test_live_session_lock_kept(self):
+        import os
+        session_id = self._save_session()
+        locks = self._files(self.tmpdir + '/sessions/container_file_lock')
+        self.assertEqual(len(locks), 1)
+        # Beaker never touches lock files after creating them
+        self._age(locks)
+        sweeper = self._makeOne()
+        sweeper.add_sessions(self.tmpdir + '/sessions', 600)
+        self.assertEqual(sweeper.sweep()['locks'], 0)
+        self.assertTrue(os.path.exists(locks[0]))
+        # until the session file is gone
+        for path in self._files(self.tmpdir + '/sessions/container_file'):
+            os.unlink(path)
+        sweeper = self._makeOne()
+        sweeper.add_sessions(self.tmpdir + '/sessions', 600)
+        self.assertEqual(sweeper.sweep()['locks'], 1)
+        self.assertFalse(os.path.exists(locks[0]))
+
+    def test_principal_index_lock_kept(self):
+        from pyramid_beaker import BeakerSessionFactoryConfig
+        request = DummyRequest()
+        factory = BeakerSessionFactoryConfig(
+            type='file', data_dir=self.tmpdir + '/sessions',
+            principal_key='a')
+        factory(request)['a'] = 'fred'
+        request.callbacks[0](request, DummyResponse())
+        factory.principal_index.queue.flush()
+        locks = self._files(self.tmpdir + '/sessions/container_file_lock')
+        self._age(locks)
+        sweeper = self._makeOne()
+        sweeper.add_sessions(self.tmpdir + '/sessions', 600)
+        self.assertEqual(sweeper.sweep()['locks'], 0)
+        self.assertEqual(
+            sorted(self._files(self.tmpdir + '/sessions/container_file_lock')),
+            sorted(locks))
+
+    def test_cache_locks(self):
+        import beaker.cache
+        namespace = beaker.cache.Cache(
+            'sweeper_test', type='file', data_dir=self.tmpdir + '/cache',
+            expire=60)
+        namespace.get('key', createfunc=lambda: 1)
+        root = self.tmpdir + '/cache/container_file_lock'
+        locks = self._files(root)
+        # the namespace lock and the creation lock of key
+        self.assertEqual(len(locks), 2)
+        self._age(locks)
+        sweeper = self._makeOne()
+        sweeper.add_cache(self.tmpdir + '/cache', 600)
+        self.assertEqual(sweeper.sweep()['locks'], 0)
+        self._age(self._files(self.tmpdir + '/cache/container_file'))
+        sweeper = self._makeOne()
+        sweeper.add_cache(self.tmpdir + '/cache', 600)
+        stats = sweeper.sweep()
+        self.assertEqual(stats['cache'], 1)
+        # creation locks cannot be matched to their namespace
+        self.assertEqual(stats['locks'], 1)
+        self.assertEqual(len(self._files(root)), 1)
+
+    def test_split_values_kept_longer(self):
+        import os
+        from pyramid_beaker import BeakerSessionFactoryConfig
+        factory = BeakerSessionFactoryConfig(
+            type='file', data_dir=self.tmpdir + '/sessions',
+            split_threshold=200)
+        request = DummyRequest()
+        factory(request)['wizard'] = 'x' * 1000
+        request.callbacks[0](request, DummyResponse())
+        root = self.tmpdir + '/sessions/container_file'
+        files = self._files(root)
+        split = [path for path in files
+                 if '-split-' in os.path.basename(path)]
+        self.assertEqual(len(split), 1)
+        self._age(files, 900)
+        sweeper = self._makeOne()
+        sweeper.add_sessions(self.tmpdir + '/sessions', 600)
+        self.assertEqual(sweeper.sweep()['sessions'], 1)
+        self.assertEqual(self._files(root), split)
+        self._age(split, 1300)
+        sweeper = self._makeOne()
+        sweeper.add_sessions(self.tmpdir + '/sessions', 600)
+        self.assertEqual(sweeper.sweep()['sessions'], 1)
+        self.assertEqual(self._files(root), [])
+
+    def test_dbm_sessions_removed(self):
+        self._save_session(type='dbm')
+        self._age(self._files(self.tmpdir + '/sessions/container_dbm'))
+        sweeper = self._makeOne()
+        sweeper.add_sessions(self.tmpdir + '/sessions', 600)
+        self.assertEqual(sweeper.sweep()['sessions'], 1)
+        self.assertEqual(
+            self._files(self.tmpdir + '/sessions/container_dbm'), [])
+
+    def test_dry_run(self):
+        self._save_session()
+        self._age(self._files(self.tmpdir + '/sessions/container_file'))
+        sweeper = self._makeOne(dry_run=True)
+        sweeper.add_sessions(self.tmpdir + '/sessions', 600)
+        self.assertEqual(sweeper.sweep()['sessions'], 1)
+        self.assertEqual(
+            len(self._files(self.tmpdir + '/sessions/container_file')), 1)
+
+    def test_batches_and_rate(self):
+        for i in range(5):
+            self._save_session()
+        self._age(self._files(self.tmpdir + '/sessions/container_file'))
+        sweeper = self._makeOne(workers=2, batch_size=2, rate=1000)
+        sweeper.add_sessions(self.tmpdir + '/sessions', 600)
+        self.assertEqual(sweeper.sweep()['sessions'], 5)
+
+    def test_held_lock_kept(self):
+        import fcntl
+        import os
+        lock_dir = self.tmpdir + '/locks'
+        os.makedirs(lock_dir)
+        held = os.path.join(lock_dir, 'held.lock')
+        free = os.path.join(lock_dir, 'free.lock')
+        for path in (held, free):
+            open(path, 'w').close()
+        self._age([held, free])
+        fd = os.open(held, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            sweeper = self._makeOne()
+            sweeper.add_locks(lock_dir, 600, sessions=True)
+            self.assertEqual(sweeper.sweep()['locks'], 1)
+        finally:
+            os.close(fd)
+        self.assertEqual(self._files(lock_dir), [held])
+
+    def test_from_settings(self):
+        from pyramid_beaker.sweeper import sweeper_from_settings
+        settings = {'session.type': 'file',
+                    'session.data_dir': self.tmpdir + '/sessions',
+                    'session.lock_dir': self.tmpdir + '/locks',
+                    'session.timeout': '1200',
+                    'cache.regions': 'short, long, remote',
+                    'cache.type': 'file',
+                    'cache.data_dir': self.tmpdir + '/cache',
+                    'cache.short.expire': '60',
+                    'cache.long.expire': '3600',
+                    'cache.long.stale_ttl': '60',
+                    'cache.remote.type': 'ext:memcached',
+                    'cache.remote.url': '127.0.0.1:11211'}
+        sweeper = sweeper_from_settings(settings)
+        targets = dict((root[len(self.tmpdir) + 1:], (kind, max_age))
+                       for kind, root, max_age in sweeper.targets)
+        self.assertEqual(targets, {
+            'sessions/container_file': ('sessions', 1200),
+            'sessions/container_dbm': ('sessions', 1200),
+            'locks': ('locks', 1200),
+            'cache/container_file': ('cache', 3660),
+            'cache/container_dbm': ('cache', 3660),
+            'cache/container_file_lock': ('locks', 3660),
+            'cache/container_dbm_lock': ('locks', 3660),
+            })
+
+    def test_from_settings_no_timeout(self):
+        from pyramid_beaker.sweeper import sweeper_from_settings
+        settings = {'session.type': 'file',
+                    'session.data_dir': self.tmpdir + '/sessions'}
+        self.assertEqual(sweeper_from_settings(settings).targets, [])
+        sweeper = sweeper_from_settings(settings, max_age=60)
+        self.assertEqual(len(sweeper.targets), 4)
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio needs Python 3.5')
+class TestAsync(unittest.TestCase):
+    def setUp(self):
+        import beaker.cache
+        self.regions = beaker.cache.cache_regions
+        beaker.cache.cache_regions = {
+            'short_term': {'type': 'memory', 'expire': 60}}
+
+    def tearDown(self):
+        import beaker.cache
+        beaker.cache.cache_regions = self.regions
+
+    def _run(self, awaitable):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            if callable(awaitable):
+                awaitable = awaitable()
+            return loop.run_until_complete(awaitable)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def _getCache(self, adapter=None):
+        from pyramid_beaker.aio import AsyncRegionCache
+        from pyramid_beaker.regions import get_cache
+        cache = get_cache('short_term', 'async_test')
+        cache.clear()
+        return AsyncRegionCache(cache, adapter)
+
+    def test_thread_fallback(self):
+        import asyncio
+        cache = self._getCache()
+        self.assertEqual(cache.adapter, None)
+        def go():
+            return asyncio.gather(
+                cache.set_multi({'a': 1, 'b': 2}),
+                cache.put('c', 3))
+        self._run(go)
+        self.assertEqual(self._run(cache.get('a')), 1)
+        self.assertEqual(self._run(cache.get_multi(['a', 'c', 'd'])),
+                         {'a': 1, 'c': 3})
+        self._run(cache.delete_multi(['a']))
+        self.assertRaises(KeyError, self._run, cache.get('a'))
+        # shared with the synchronous cache
+        self.assertEqual(cache.cache.get('b'), 2)
+
+    def test_create_awaitable(self):
+        import asyncio
+        cache = self._getCache()
+        calls = []
+        def create():
+            calls.append(1)
+            return asyncio.sleep(0.01, 'value')
+        def go():
+            return asyncio.gather(*[cache.get('key', createfunc=create)
+                                    for i in range(4)])
+        self.assertEqual(self._run(go), ['value'] * 4)
+        self.assertEqual(calls, [1])
+        self.assertEqual(cache._creating, {})
+        self.assertEqual(cache.cache.get('key'), 'value')
+
+    def test_create_error(self):
+        import asyncio
+        cache = self._getCache()
+        def create():
+            future = asyncio.get_running_loop().create_future()
+            future.set_exception(ValueError('boom'))
+            return future
+        self.assertRaises(ValueError, self._run,
+                          cache.get('key', createfunc=create))
+        self.assertEqual(cache._creating, {})
+        self.assertRaises(KeyError, cache.cache.get, 'key')
+
+    def test_tags(self):
+        import asyncio
+        from pyramid_beaker import regions
+        from pyramid_beaker.regions import invalidate_tags
+        regions.set_tag_region('short_term')
+        self.addCleanup(regions.set_tag_region, None)
+        cache = self._getCache()
+        self._run(cache.put('a', 1, tags=['async_tag']))
+        self.assertEqual(self._run(cache.get('a')), 1)
+        invalidate_tags('async_tag')
+        self.assertRaises(KeyError, self._run, cache.get('a'))
+        value = self._run(cache.get(
+            'a', createfunc=lambda: asyncio.sleep(0, 2), tags=['async_tag']))
+        self.assertEqual(value, 2)
+        self.assertEqual(cache.cache.get('a'), 2)
+
+    def test_adapter(self):
+        from pyramid_beaker.aio import AsyncRedisAdapter
+        client = DummyAsyncRedis()
+        class DummyNamespace(object):
+            timeout = None
+            _format_key = staticmethod(lambda key: 'ns_' + key.decode())
+        cache = self._getCache(AsyncRedisAdapter(DummyNamespace(), client))
+        self._run(cache.set_multi({'a': 1, 'b': 2}))
+        self.assertEqual(sorted(client.data), ['ns_a', 'ns_b'])
+        self.assertEqual(client.expires, {'ns_a': 60, 'ns_b': 60})
+        self.assertEqual(self._run(cache.get_multi(['a', 'b', 'c'])),
+                         {'a': 1, 'b': 2})
+        self._run(cache.remove_value('a'))
+        self.assertEqual(self._run(cache.get_multi(['a', 'b'])), {'b': 2})
+        self.assertEqual(client.calls, ['pipeline', 'mget', 'delete', 'mget'])
+        # the synchronous cache was not used
+        self.assertRaises(KeyError, cache.cache.get, 'b')
+
+    def test_get_async_cache(self):
+        import asyncio
+        from pyramid_beaker.aio import get_async_cache
+        def get(loop):
+            # called back by the running loop
+            future = loop.create_future()
+            loop.call_soon(lambda: future.set_result(
+                get_async_cache('short_term', 'async_test')))
+            return loop.run_until_complete(future)
+        first, second = asyncio.new_event_loop(), asyncio.new_event_loop()
+        try:
+            cache = get(first)
+            self.assertTrue(get(first) is cache)
+            self.assertEqual(cache.cache.namespace_name, 'async_test')
+            self.assertTrue(get(second) is not cache)
+        finally:
+            first.close()
+            second.close()
+        self.assertRaises(RuntimeError, get_async_cache, 'short_term',
+                          'async_test')
+
+    def test_session(self):
+        from pyramid_beaker import BeakerSessionFactoryConfig
+        factory = BeakerSessionFactoryConfig(type='memory')
+        request = DummyRequest()
+        session = factory(request)
+        self.assertTrue(self._run(session.load_async()) is session)
+        session['a'] = 1
+        self._run(session.persist_async())
+        writes = []
+        session._sess.save = lambda *args, **kw: writes.append(1)
+        response = DummyResponse()
+        request.callbacks[0](request, response)
+        self.assertEqual(writes, [])
+        self.assertEqual(response.headerlist[0][0], 'Set-Cookie')
+        cookie = response.headerlist[0][1].split(';')[0]
+        request = DummyRequest()
+        request.environ['HTTP_COOKIE'] = cookie
+        self.assertEqual(factory(request)['a'], 1)
+
+class DummyAsyncRedis(object):
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.calls = []
+
+    def _result(self, value=None):
+        import asyncio
+        return asyncio.sleep(0, value)
+
+    def mget(self, keys):
+        self.calls.append('mget')
+        return self._result([self.data.get(key) for key in keys])
+
+    def delete(self, *keys):
+        self.calls.append('delete')
+        for key in keys:
+            self.data.pop(key, None)
+        return self._result()
+
+    def pipeline(self, transaction=True):
+        self.calls.append('pipeline')
+        client = self
+        class Pipeline(object):
+            def setex(self, key, expire, value):
+                client.data[key] = value
+                client.expires[key] = expire
+            def set(self, key, value):
+                client.data[key] = value
+            def execute(self):
+                return client._result()
+        return Pipeline()
+
+class StandInServer(object):
+    """ A local TCP server answering ``PING`` with ``PONG``."""
+    def __init__(self):
+        import socket
+        import threading
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.address = self.listener.getsockname()
+        self.accepted = 0
+        self.clients = []
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _serve(self):
+        import threading
+        while True:
+            try:
+                client, address = self.listener.accept()
+            except OSError:
+                return
+            self.accepted += 1
+            self.clients.append(client)
+            thread = threading.Thread(target=self._handle, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, client):
+        try:
+            while client.recv(64):
+                client.sendall(b'PONG\r\n')
+        except OSError:
+            pass
+
+    def drop(self):
+        import socket
+        for client in self.clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.close()
+        self.clients = []
+
+    def close(self):
+        self.drop()
+        self.listener.close()
+
+    def connect(self):
+        import socket
+        return socket.create_connection(self.address, timeout=1)
+
+def ping(conn):
+    conn.sendall(b'PING\r\n')
+    return conn.recv(64) == b'PONG\r\n'
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def _makeOne(self, **kw):
+        from pyramid_beaker.pool import ConnectionPool
+        kw.setdefault('check', ping)
+        return ConnectionPool(self.server.connect, close=lambda c: c.close(),
+                              **kw)
+
+    def test_reuse(self):
+        pool = self._makeOne()
+        for i in range(3):
+            with pool.connection() as conn:
+                self.assertTrue(ping(conn))
+        self.assertEqual(self.server.accepted, 1)
+        self.assertEqual(pool.stats['created'], 1)
+        self.assertEqual(pool.stats['reused'], 2)
+        pool.dispose()
+        self.assertEqual(len(pool), 0)
+
+    def test_size_and_timeout(self):
+        from pyramid_beaker.pool import PoolTimeoutError
+        pool = self._makeOne(size=2, timeout=0.05)
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertRaises(PoolTimeoutError, pool.acquire)
+        self.assertEqual(pool.stats['timeouts'], 1)
+        pool.release(first)
+        self.assertTrue(pool.acquire() is first)
+        pool.release(first)
+        pool.release(second)
+        self.assertEqual(self.server.accepted, 2)
+
+    def test_waiters_get_released_connections(self):
+        import threading
+        pool = self._makeOne(size=1, timeout=5)
+        conn = pool.acquire()
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(pool.acquire()))
+        thread.start()
+        pool.release(conn)
+        thread.join(5)
+        self.assertEqual(acquired, [conn])
+        self.assertEqual(pool.stats['waited'], 1)
+
+    def test_health_check(self):
+        pool = self._makeOne(health_check_interval=0)
+        with pool.connection() as conn:
+            self.assertTrue(ping(conn))
+        self.server.drop()
+        with pool.connection() as replacement:
+            self.assertTrue(ping(replacement))
+        self.assertFalse(replacement is conn)
+        self.assertEqual(pool.stats['failed_checks'], 1)
+        self.assertEqual(pool.stats['discarded'], 1)
+        self.assertEqual(len(pool), 1)
+
+    def test_health_check_interval(self):
+        pool = self._makeOne(health_check_interval=60)
+        with pool.connection():
+            pass
+        with pool.connection():
+            pass
+        self.assertEqual(pool.stats['checks'], 0)
+
+    def test_errors_discard(self):
+        pool = self._makeOne(size=1)
+        def fail():
+            with pool.connection():
+                raise OSError('connection reset')
+        self.assertRaises(OSError, fail)
+        self.assertEqual(len(pool), 0)
+        def other():
+            with pool.connection():
+                raise ValueError
+        self.assertRaises(ValueError, other)
+        self.assertEqual(pool.stats['discarded'], 1)
+        self.assertEqual(pool.stats['reused'], 0)
+        with pool.connection():
+            pass
+        self.assertEqual(pool.stats['reused'], 1)
+
+    def test_connect_failure(self):
+        pool = self._makeOne(size=1)
+        self.server.close()
+        self.assertRaises(OSError, pool.acquire)
+        self.assertEqual(len(pool), 0)
+
+    def test_fork(self):
+        pool = self._makeOne(size=1, timeout=0.05)
+        parent = pool.acquire()
+        pool.pid = -1
+        child = pool.acquire()
+        self.assertFalse(child is parent)
+        self.assertEqual(pool.stats['forks'], 1)
+        pool.release(child)
+        pool.pid = -1
+        # connections of the parent are neither reused nor closed
+        pool.release(child)
+        again = pool.acquire()
+        self.assertFalse(again is child)
+        self.assertEqual(pool.stats['forks'], 2)
+        self.assertTrue(ping(child))
+
+    def test_pooled_client(self):
+        from pyramid_beaker.pool import ConnectionPool
+        from pyramid_beaker.pool import PooledClient
+        pool = ConnectionPool(DummyPooledClient, size=1)
+        client = PooledClient(pool)
+        client.set('a', 1)
+        self.assertEqual(client.get('a'), 1)
+        self.assertEqual(pool.stats['created'], 1)
+        self.assertEqual(len(pool._idle), 1)
+
+class DummyPooledClient(object):
+    data = {}
+    created = 0
+
+    def __init__(self, servers=None):
+        self.servers = servers
+        DummyPooledClient.created += 1
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, time=0):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def get_stats(self):
+        return [(self.servers, {})]
+
+class DummyMemcacheModule(object):
+    Client = DummyPooledClient
+
+class DummyRedisPool(object):
+    def __init__(self, url, **options):
+        self.url = url
+        self.options = options
+        self.disconnected = False
+
+    @classmethod
+    def from_url(cls, url, **options):
+        return cls(url, **options)
+
+    def disconnect(self):
+        self.disconnected = True
+
+class DummyRedis(object):
+    data = {}
+
+    def __init__(self, connection_pool):
+        self.connection_pool = connection_pool
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def setex(self, key, time, value):
+        self.data[key] = value
+
+    def exists(self, key):
+        return key in self.data
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+class DummyRedisModule(object):
+    BlockingConnectionPool = DummyRedisPool
+    StrictRedis = DummyRedis
+
+class TestPooledBackends(unittest.TestCase):
+    def setUp(self):
+        import sys
+        import beaker.cache
+        from pyramid_beaker import pool
+        self.regions = beaker.cache.cache_regions
+        self.options = dict(pool._pool_options)
+        sys.modules['pooled_test'] = DummyMemcacheModule
+        DummyPooledClient.data.clear()
+        DummyPooledClient.created = 0
+        pool.dispose_pools()
+
+    def tearDown(self):
+        import sys
+        import beaker.cache
+        from pyramid_beaker import pool
+        beaker.cache.cache_regions = self.regions
+        pool._pool_options.update(self.options)
+        pool.dispose_pools()
+        del sys.modules['pooled_test']
+
+    def test_shared_by_sessions_and_regions(self):
+        import beaker.cache
+        from pyramid_beaker import session_factory_from_settings
+        from pyramid_beaker import set_cache_regions_from_settings
+        from pyramid_beaker.pool import configure_pools
+        from pyramid_beaker.pool import pools
+        configure_pools(size=3)
+        settings = {
+            'session.type': 'pooled_memcached',
+            'session.url': '127.0.0.1:11211',
+            'session.memcache_module': 'pooled_test',
+            'cache.regions': 'short_term, long_term',
+            'cache.type': 'pooled_memcached',
+            'cache.url': '127.0.0.1:11211',
+            'cache.short_term.expire': '60',
+            'cache.short_term.memcache_module': 'pooled_test',
+            'cache.long_term.expire': '3600',
+            'cache.long_term.memcache_module': 'pooled_test',
+            }
+        beaker.cache.cache_regions = {}
+        set_cache_regions_from_settings(settings)
+        factory = session_factory_from_settings(settings)
+        request = DummyRequest()
+        session = factory(request)
+        session['userid'] = 'fred'
+        request.callbacks[0](request, DummyResponse())
+        for region in ('short_term', 'long_term'):
+            cache = beaker.cache.Cache._get_cache(
+                'pooled_test', beaker.cache.cache_regions[region])
+            cache.put('a', region)
+            self.assertEqual(cache.get('a'), region)
+        shared = pools()
+        self.assertEqual(list(shared),
+                         [('memcached', 'pooled_test', '127.0.0.1:11211')])
+        pool = list(shared.values())[0]
+        self.assertEqual(pool.size, 3)
+        self.assertEqual(DummyPooledClient.created, 1)
+        self.assertEqual(pool.stats['created'], 1)
+
+    def _fake_redis(self):
+        import sys
+        from beaker.ext import redisnm
+        saved = sys.modules.get('redis'), redisnm.redis
+        def restore():
+            if saved[0] is None:
+                sys.modules.pop('redis', None)
+            else:
+                sys.modules['redis'] = saved[0]
+            redisnm.redis = saved[1]
+        self.addCleanup(restore)
+        sys.modules['redis'] = redisnm.redis = DummyRedisModule
+        DummyRedis.data.clear()
+
+    def test_pooled_redis(self):
+        from pyramid_beaker.pool import PooledRedisNamespaceManager
+        from pyramid_beaker.pool import configure_pools
+        from pyramid_beaker.pool import dispose_pools
+        from pyramid_beaker.pool import pools
+        self._fake_redis()
+        configure_pools(size=3, timeout=2.5, health_check_interval=30)
+        url = 'redis://127.0.0.1:6379/0'
+        first = PooledRedisNamespaceManager('first', url)
+        second = PooledRedisNamespaceManager('second', url, timeout=60)
+        first['a'] = 1
+        second['a'] = 2
+        self.assertEqual(first['a'], 1)
+        self.assertEqual(second['a'], 2)
+        pool = pools()[('redis', url)]
+        self.assertEqual(list(pools()), [('redis', url)])
+        self.assertTrue(first.client.connection_pool is pool)
+        self.assertTrue(second.client.connection_pool is pool)
+        self.assertEqual(pool.url, url)
+        self.assertEqual(pool.options['max_connections'], 3)
+        self.assertEqual(pool.options['timeout'], 2.5)
+        self.assertEqual(pool.options['health_check_interval'], 30)
+        dispose_pools()
+        self.assertTrue(pool.disconnected)
+
+    def test_redis_unavailable(self):
+        import sys
+        from pyramid_beaker.pool import PooledRedisNamespaceManager
+        saved = sys.modules.get('redis')
+        sys.modules['redis'] = None
+        try:
+            self.assertRaises(RuntimeError, PooledRedisNamespaceManager,
+                              'pooled_test', 'redis://127.0.0.1:6379/0')
+        finally:
+            if saved is None:
+                del sys.modules['redis']
+            else:
+                sys.modules['redis'] = saved
+
+    def test_pool_options_from_settings(self):
+        from pyramid_beaker.pool import pool_options_from_settings
+        options = pool_options_from_settings({
+            'pyramid_beaker.pool_size': '4',
+            'pyramid_beaker.pool_timeout': '2.5',
+            'pyramid_beaker.pool_health_check_interval': '10',
+            })
+        self.assertEqual(options, {'size': 4, 'timeout': 2.5,
+                                   'health_check_interval': 10.0})
+
+    def test_invalid_pool_setting(self):
+        from pyramid.exceptions import ConfigurationError
+        from pyramid_beaker.pool import pool_options_from_settings
+        self.assertRaises(ConfigurationError, pool_options_from_settings,
+                          {'pyramid_beaker.pool_size': 'ten'})
+
+    def test_unknown_pool_option(self):
+        from pyramid_beaker.pool import configure_pools
+        self.assertRaises(TypeError, configure_pools, max_size=3)
+
+class TestCacheConfiguration(unittest.TestCase):
+    def _set_settings(self):
+        return {'cache.regions':'default_term, second, short_term, long_term',
+                'cache.type':'memory',
+                'cache.second.expire':'1',
+                'cache.short_term.expire':'60',
+                'cache.default_term.expire':'300',
+                'cache.long_term.expire':'3600',
+                }
+
+    def test_add_cache_stale_ttl(self):
+        from pyramid_beaker import set_cache_regions_from_settings
+        import beaker
+        settings = self._set_settings()
+        beaker.cache.cache_regions = {}
+        settings['cache.short_term.stale_ttl'] = '30'
+        set_cache_regions_from_settings(settings)
+        short_term = beaker.cache.cache_regions.get('short_term')
+        self.assertEqual(short_term['stale_ttl'], 30)
+
+    def test_add_cache_singleflight(self):
+        from pyramid_beaker import set_cache_regions_from_settings
+        import beaker
+        settings = self._set_settings()
+        beaker.cache.cache_regions = {}
+        settings['cache.short_term.singleflight'] = 'true'
+        settings['cache.short_term.singleflight_timeout'] = '2.5'
+        set_cache_regions_from_settings(settings)
+        short_term = beaker.cache.cache_regions.get('short_term')
+        self.assertEqual(short_term['singleflight'], True)
+        self.assertEqual(short_term['singleflight_timeout'], 2.5)
+
+    def test_add_cache_tag_region(self):
+        from pyramid_beaker import set_cache_regions_from_settings
+        from pyramid_beaker import regions
+        import beaker
+        settings = self._set_settings()
+        beaker.cache.cache_regions = {}
+        settings['cache.tag_region'] = 'default_term'
+        set_cache_regions_from_settings(settings)
+        try:
+            self.assertEqual(regions.tag_region, 'default_term')
+        finally:
+            regions.set_tag_region(None)
+
+    def test_add_cache_unknown_tag_region(self):
+        from pyramid.exceptions import ConfigurationError
+        from pyramid_beaker import set_cache_regions_from_settings
+        import beaker
+        settings = self._set_settings()
+        beaker.cache.cache_regions = {}
+        settings['cache.tag_region'] = 'unknown'
+        self.assertRaises(ConfigurationError,
+                          set_cache_regions_from_settings, settings)
 
     def test_add_cache_no_regions(self):
         from pyramid_beaker import set_cache_regions_from_settings
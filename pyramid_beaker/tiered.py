@@ -0,0 +1,155 @@
+""" Tiered session storage.
+
+Sessions loaded or saved by a process are kept in an in-process LRU (the
+L1) in front of the configured backend (the L2).  Every save stores the
+payload under a new key named after a random stamp, then the stamp itself
+under a fixed key.  A load reads only the stamp from the backend, and uses
+the L1 copy when the stamps match; otherwise it reads the payload the stamp
+names.  As a payload key is never rewritten and the stamp is a single
+backend value, the stamp always names a complete payload, even when saves
+of several processes interleave on backends without write locks.  Only the
+stored payload is cached, so each request still works on its own copy of
+the session data.
+
+A save thus costs two backend writes (and the removal of the payload it
+replaces), and a load one read when the L1 copy is current, two otherwise.
+"""
+import uuid
+
+from beaker.container import OpenResourceNamespaceManager
+
+from pyramid.exceptions import ConfigurationError
+
+from pyramid_beaker.memory import LRUDict
+
+STAMP_KEY = 'session_stamp'
+
+# prefix of the keys of the payloads named by stamps
+PAYLOAD_PREFIX = 'session.'
+
+
+class SessionL1(LRUDict):
+    """ The in-process tier: an :class:`pyramid_beaker.memory.LRUDict`
+    mapping session ids to ``(stamp, payload)`` pairs.
+
+    Besides the ``hits``, ``misses`` and ``evictions`` of the LRU, its
+    ``stats`` count the ``stale`` hits whose stamp no longer matched the
+    backend."""
+    def __init__(self, max_items=1000):
+        LRUDict.__init__(self, max_items)
+        self.stats['stale'] = 0
+
+
+class _TieredNamespace(object):
+    """ Namespace mixin consulting the class's ``l1`` before reading the
+    session payload from the backend."""
+    l1 = None
+    # the stamp last read or written by this namespace
+    _seen_stamp = None
+
+    def _stamp(self):
+        try:
+            return super(_TieredNamespace, self).__getitem__(STAMP_KEY)
+        except KeyError:
+            return None
+
+    def _payload(self, stamp):
+        return super(_TieredNamespace, self).__getitem__(
+            PAYLOAD_PREFIX + stamp)
+
+    def __getitem__(self, key):
+        if key != 'session':
+            return super(_TieredNamespace, self).__getitem__(key)
+        stamp = self._stamp()
+        if stamp is None:
+            # saved by a process without tiered sessions
+            return super(_TieredNamespace, self).__getitem__(key)
+        self._seen_stamp = stamp
+        try:
+            cached_stamp, payload = self.l1[self.namespace]
+        except KeyError:
+            pass
+        else:
+            if cached_stamp == stamp:
+                return payload
+            self.l1.stats['stale'] += 1
+        try:
+            payload = self._payload(stamp)
+        except KeyError:
+            # replaced and removed by a save since the stamp was read
+            stamp = self._stamp()
+            if stamp is None:
+                raise KeyError(key)
+            self._seen_stamp = stamp
+            payload = self._payload(stamp)
+        self.l1[self.namespace] = (stamp, payload)
+        return payload
+
+    def __setitem__(self, key, value):
+        if key != 'session':
+            super(_TieredNamespace, self).__setitem__(key, value)
+            return
+        previous = self._seen_stamp
+        if previous is None:
+            try:
+                previous = self.l1[self.namespace][0]
+            except KeyError:
+                pass
+        stamp = uuid.uuid4().hex
+        super(_TieredNamespace, self).__setitem__(
+            PAYLOAD_PREFIX + stamp, value)
+        # written last, so that it never names a missing payload
+        super(_TieredNamespace, self).__setitem__(STAMP_KEY, stamp)
+        self._seen_stamp = stamp
+        self.l1[self.namespace] = (stamp, value)
+        if previous is not None:
+            self._discard(PAYLOAD_PREFIX + previous)
+
+    def __contains__(self, key):
+        if key == 'session' and self._stamp() is not None:
+            return True
+        return super(_TieredNamespace, self).__contains__(key)
+
+    def has_key(self, key):
+        return self.__contains__(key)
+
+    def __delitem__(self, key):
+        if key != 'session':
+            super(_TieredNamespace, self).__delitem__(key)
+            return
+        stamp = self._stamp()
+        self._forget()
+        if stamp is None:
+            super(_TieredNamespace, self).__delitem__(key)
+        else:
+            self._discard(PAYLOAD_PREFIX + stamp)
+
+    def do_remove(self):
+        self._forget()
+        super(_TieredNamespace, self).do_remove()
+
+    def _discard(self, key):
+        try:
+            super(_TieredNamespace, self).__delitem__(key)
+        except KeyError:
+            pass
+
+    def _forget(self):
+        self._seen_stamp = None
+        try:
+            del self.l1[self.namespace]
+        except KeyError:
+            pass
+        self._discard(STAMP_KEY)
+
+
+def tiered_namespace(cls, l1):
+    """ Return a subclass of the Beaker namespace manager class ``cls``
+    which keeps session payloads in ``l1``, a :class:`SessionL1`."""
+    if issubclass(cls, OpenResourceNamespaceManager):
+        # file, dbm and database namespaces read the whole namespace
+        # when opened, so there is no cheaper stamp to validate against
+        raise ConfigurationError(
+            'Tiered sessions require a key-value session backend such as '
+            'ext:memcached or ext:redis, not %s' % cls.__name__)
+    return type('Tiered' + cls.__name__, (_TieredNamespace, cls), {'l1': l1})
@@ -0,0 +1,194 @@
+""" Caching of rendered view responses in cache regions.
+
+Views configured with the ``response_cache`` view option, naming a cache
+region, have their responses to ``GET`` and ``HEAD`` requests stored in
+that region and served from it without calling the view::
+
+    config.add_view(product_page, route_name='product',
+                    renderer='templates/product.pt',
+                    response_cache='long_term',
+                    response_cache_vary=('route', 'matchdict',
+                                         'header:Accept-Language'))
+
+Cached responses carry an ``ETag`` computed from their body, and requests
+whose ``If-None-Match`` matches it are answered with ``304 Not Modified``.
+The option is handled by a view deriver registered by including
+``pyramid_beaker``; it runs after the view's permission is checked, so
+responses of protected views are varied by ``principal`` by default.
+"""
+import hashlib
+
+from pyramid.exceptions import ConfigurationError
+from pyramid.response import Response
+
+from pyramid_beaker.regions import get_cache
+
+ENVIRON_KEY = 'pyramid_beaker.response_cache'
+
+DEFAULT_VARY = ('route', 'matchdict', 'params', 'principal')
+
+_NAMESPACE = 'pyramid_beaker.views'
+
+# headers which are never replayed from the cache
+_UNCACHED_HEADERS = frozenset(['set-cookie', 'date'])
+
+
+def _vary_route(request):
+    route = getattr(request, 'matched_route', None)
+    return route.name if route is not None else request.path_info
+
+
+def _vary_path(request):
+    return request.path_info
+
+
+def _vary_matchdict(request):
+    return sorted((request.matchdict or {}).items())
+
+
+def _vary_params(request):
+    return sorted(request.GET.items())
+
+
+def _vary_principal(request):
+    return getattr(request, 'authenticated_userid', None)
+
+
+_vary_functions = {
+    'route': _vary_route,
+    'path': _vary_path,
+    'matchdict': _vary_matchdict,
+    'params': _vary_params,
+    'principal': _vary_principal,
+    }
+
+
+def _vary_function(name):
+    if name.startswith('header:'):
+        header = name[len('header:'):]
+        return lambda request: request.headers.get(header)
+    try:
+        return _vary_functions[name]
+    except KeyError:
+        raise ConfigurationError('Unknown response_cache_vary %r' % (name,))
+
+
+def _view_namespace(info):
+    view = info.original_view
+    name = '%s.%s' % (getattr(view, '__module__', ''),
+                      getattr(view, '__name__', view.__class__.__name__))
+    attr = info.options.get('attr')
+    if attr:
+        name += '.' + attr
+    return '%s:%s' % (_NAMESPACE, name)
+
+
+def _etag(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+def _cacheable(response):
+    if response.status_int != 200:
+        return False
+    if 'Set-Cookie' in response.headers:
+        return False
+    if response.cache_control.no_store:
+        return False
+    return True
+
+
+def _request_cacheable(request):
+    # the session cookie and other per-visitor headers are added by
+    # response callbacks, after the view returned
+    if 'session' in request.__dict__ and request.session.accessed():
+        return False
+    if getattr(request, 'response_callbacks', None):
+        return False
+    return True
+
+
+def _not_modified(etag, headers):
+    response = Response(status=304)
+    response.etag = etag
+    for name, value in headers:
+        if name.lower() in ('cache-control', 'expires', 'vary'):
+            response.headers[name] = value
+    return response
+
+
+def response_cache_view(view, info):
+    """ View deriver caching the responses of views configured with the
+    ``response_cache`` option, varying them by the items of
+    ``response_cache_vary``:
+
+    ``route``
+      The name of the matched route (or the path if there is none).
+    ``path``
+      The request path.
+    ``matchdict``
+      The values matched by the route pattern.
+    ``params``
+      The query string parameters.
+    ``principal``
+      The ``request.authenticated_userid``.
+    ``header:<name>``
+      The value of the request header ``<name>``.
+
+    The default is ``route``, ``matchdict``, ``params`` and ``principal``.
+    Only ``200 OK`` responses without ``Set-Cookie`` or ``Cache-Control:
+    no-store`` headers are cached, and only if the view neither used the
+    session nor registered response callbacks.  Unless they vary by
+    ``principal``, responses to authenticated requests are not cached
+    either.  An authentication policy reading the session uses it for
+    ``principal`` too, so that views varying by ``principal`` are never
+    cached with it.  ``request.environ['pyramid_beaker.response_cache']``
+    is set to ``hit`` or ``miss``."""
+    region = info.options.get('response_cache')
+    if not region:
+        return view
+    vary = info.options.get('response_cache_vary') or DEFAULT_VARY
+    if isinstance(vary, str):
+        vary = vary.split()
+    per_principal = 'principal' in vary
+    vary = [(name, _vary_function(name)) for name in vary]
+    namespace = _view_namespace(info)
+
+    def key(request):
+        parts = ['%s=%r' % (name, fn(request)) for name, fn in vary]
+        return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def wrapper(context, request):
+        if request.method not in ('GET', 'HEAD'):
+            return view(context, request)
+        cache = get_cache(region, namespace)
+        cache_key = key(request)
+        try:
+            entry = cache.get(cache_key)
+        except KeyError:
+            entry = None
+        if entry is not None:
+            request.environ[ENVIRON_KEY] = 'hit'
+            status, headers, body, etag = entry
+            if etag in request.if_none_match:
+                return _not_modified(etag, headers)
+            return Response(body=body, status=status,
+                            headerlist=list(headers))
+        request.environ[ENVIRON_KEY] = 'miss'
+        response = view(context, request)
+        if not _cacheable(response) or not _request_cacheable(request):
+            return response
+        if not per_principal and _vary_principal(request) is not None:
+            # rendered for this user, and served to anyone else otherwise
+            return response
+        body = response.body
+        if response.etag is None:
+            response.etag = _etag(body)
+        headers = [(name, value) for name, value in response.headerlist
+                   if name.lower() not in _UNCACHED_HEADERS]
+        cache.put(cache_key, (response.status, headers, body, response.etag))
+        if response.etag in request.if_none_match:
+            return _not_modified(response.etag, headers)
+        return response
+    return wrapper
+
+response_cache_view.options = ('response_cache', 'response_cache_vary')
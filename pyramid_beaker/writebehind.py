@@ -0,0 +1,187 @@
+""" Write-behind persistence of session data.
+
+Session payloads are serialized on the request thread and written to the
+backend by a small pool of worker threads once the response has been
+handed back.  Writes for the same session id always go to the same worker,
+so they reach the backend in the order they were submitted.
+"""
+import atexit
+import logging
+import os
+import threading
+import weakref
+
+try:
+    import queue
+except ImportError: # pragma: no cover
+    import Queue as queue
+
+log = logging.getLogger(__name__)
+
+_queues = weakref.WeakSet()
+
+
+class WriteBehindQueue(object):
+    """ A bounded pool of ``workers`` threads, each with a queue holding up
+    to ``queue_size`` pending writes.
+
+    ``policy`` decides what happens when a queue is full: ``sync`` (the
+    default) performs the write on the calling thread, unless writes for
+    the same session are still queued, in which case it waits for room in
+    the queue like ``block`` always does.  A write submitted while another
+    of the same session is performed on a calling thread waits for it to
+    end."""
+    def __init__(self, workers=2, queue_size=1000, policy='sync'):
+        if policy not in ('sync', 'block'):
+            raise ValueError('Unknown write-behind policy %r' % (policy,))
+        self.workers = int(workers)
+        self.queue_size = int(queue_size)
+        self.policy = policy
+        self.stats = {'queued': 0, 'written': 0, 'failed': 0, 'overflow': 0}
+        self._lock = threading.Condition()
+        self._pid = None
+        self._queues = []
+        # number of queued or running writes per key
+        self._pending = {}
+        # keys being written on a submitting thread
+        self._inline = set()
+        _queues.add(self)
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            # threads do not survive a fork; start a fresh pool in the child
+            if self._pid != os.getpid():
+                self._queues = []
+                self._pending = {}
+                self._inline = set()
+                for i in range(self.workers):
+                    q = queue.Queue(self.queue_size)
+                    thread = threading.Thread(
+                        target=self._run, args=(q,),
+                        name='pyramid_beaker-write-behind-%d' % i)
+                    thread.daemon = True
+                    thread.start()
+                    self._queues.append(q)
+                self._pid = os.getpid()
+        finally:
+            self._lock.release()
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            try:
+                if item is None:
+                    return
+                key, job = item
+                self._write(job)
+                self._done(key)
+            finally:
+                q.task_done()
+
+    def _done(self, key):
+        self._lock.acquire()
+        try:
+            count = self._pending.pop(key) - 1
+            if count:
+                self._pending[key] = count
+        finally:
+            self._lock.release()
+
+    def _write(self, job):
+        try:
+            job()
+        except Exception:
+            self.stats['failed'] += 1
+            log.exception('Write-behind session write failed')
+        else:
+            self.stats['written'] += 1
+
+    def submit(self, key, job):
+        """ Schedule ``job``, a callable performing a backend write, for
+        the session identified by ``key``."""
+        if self._pid != os.getpid():
+            self._start()
+        q = self._queues[hash(key) % self.workers]
+        inline = False
+        self._lock.acquire()
+        try:
+            # a write of the same key running on another thread must end
+            # before this one is queued, or it could overwrite this one
+            while key in self._inline:
+                self._lock.wait()
+            # counted before the put, as the worker may run the job at once
+            pending = self._pending.get(key, 0)
+            self._pending[key] = pending + 1
+            # an inline write must not overtake writes of the same key
+            # which are still queued, so only the first may overflow
+            wait = self.policy == 'block' or pending > 0
+            if not wait:
+                try:
+                    q.put((key, job), False)
+                except queue.Full:
+                    self._inline.add(key)
+                    inline = True
+        finally:
+            self._lock.release()
+        if wait:
+            q.put((key, job))
+        if not inline:
+            self.stats['queued'] += 1
+            return
+        self.stats['overflow'] += 1
+        try:
+            self._write(job)
+        finally:
+            self._lock.acquire()
+            try:
+                self._inline.discard(key)
+                self._done(key)
+                self._lock.notify_all()
+            finally:
+                self._lock.release()
+
+    def flush(self):
+        """ Wait until every write submitted so far has completed."""
+        if self._pid == os.getpid():
+            for q in self._queues:
+                q.join()
+
+    def shutdown(self):
+        """ Flush pending writes and stop the worker threads."""
+        if self._pid == os.getpid():
+            self.flush()
+            for q in self._queues:
+                q.put(None)
+        self._pid = None
+        self._queues = []
+
+
+def flush_write_behind():
+    """ Wait for the pending writes of every write-behind queue in this
+    process.  Registered with :mod:`atexit` so that writes are not lost
+    when the interpreter shuts down."""
+    for q in list(_queues):
+        q.flush()
+
+
+def session_write_job(session, payload):
+    """ Return a job which stores ``payload``, an already serialized
+    session dictionary, as the data of the Beaker ``session``."""
+    namespace_class = session.namespace_class
+    id = session.id
+    kw = dict(session.namespace_args)
+    kw['data_dir'] = session.data_dir
+    kw['digest_filenames'] = False
+
+    def job():
+        namespace = namespace_class(id, **kw)
+        namespace.acquire_write_lock(replace=True)
+        try:
+            namespace['session'] = payload
+        finally:
+            namespace.release_write_lock()
+    return job
+
+
+atexit.register(flush_write_behind)
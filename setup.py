@@ -69,4 +69,12 @@ setup(name='pyramid_beaker',
           'docs':docs_extras,
           },
       test_suite="pyramid_beaker",
+      entry_points = """\
+      [console_scripts]
+      pyramid_beaker_sweep = pyramid_beaker.sweeper:main
+      [beaker.backends]
+      bounded_memory = pyramid_beaker.memory:BoundedMemoryNamespaceManager
+      pooled_redis = pyramid_beaker.pool:PooledRedisNamespaceManager
+      pooled_memcached = pyramid_beaker.pool:PooledMemcachedNamespaceManager
+      """,
       )